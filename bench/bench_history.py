@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Read-path benchmark: revision history as ORM objects versus records.
+
+Usage
+-----
+  PYTHONPATH=. python bench/bench_history.py [rows] [columns]
+'''
+import sys
+import time
+import tracemalloc
+
+import sqlalchemy as sa
+from sqlalchemy.ext.declarative import declarative_base
+
+from sqlalchemy_audit.versioned import Versioned
+
+
+def make_model(Base, ncols):
+  attrs = {
+    '__tablename__': 'widget',
+    'id': sa.Column(sa.Integer, primary_key=True),
+  }
+  for i in range(ncols):
+    attrs['col_%d' % i] = sa.Column(sa.Integer)
+  return type('Widget', (Versioned, Base), attrs)
+
+
+def measure(read):
+  tracemalloc.start()
+  start = time.time()
+  rows = read()
+  elapsed = time.time() - start
+  size = tracemalloc.get_traced_memory()[0]
+  tracemalloc.stop()
+  return len(rows), elapsed, size
+
+
+def run(rows=20000, ncols=20):
+  engine = sa.create_engine('sqlite://')
+  Base = declarative_base()
+  Widget = make_model(Base, ncols)
+  Base.metadata.create_all(engine)
+  session = sa.orm.Session(engine)
+  objs = [Widget(id=n, **dict(('col_%d' % i, n) for i in range(ncols)))
+          for n in range(rows)]
+  session.add_all(objs)
+  session.commit()
+  session.close()
+
+  print('%d revisions x %d columns' % (rows, ncols))
+  for name, read in (
+      ('orm objects', lambda: session.query(Widget.Revision).all()),
+      ('records', lambda: list(
+        Widget.Revision.iter_history(engine, batch_size=5000)))):
+    count, elapsed, size = measure(read)
+    session.close()
+    print('  %-12s %8.2f us/row %8d bytes/row'
+          % (name, elapsed / count * 1e6, size // count))
+
+
+if __name__ == '__main__':
+  run(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Benchmark suite for the overhead of auditing: every scenario runs against a
+plain model and the same model inheriting Versioned, and the report shows
+the time per row of both and their ratio.
+
+Scenarios: insert, update, no-op update and delete flushes of narrow and
+wide tables, one large flush, and reading history (`as_of` and
+`iter_history` against a plain SELECT of the live table).
+
+Usage
+-----
+  PYTHONPATH=. python bench/bench_overhead.py [--url URL] [--rows N]
+      [--repeat N] [--narrow N] [--wide N] [--max-overhead RATIO]
+
+`--url` defaults to a SQLite file in a temporary directory; pass e.g.
+``postgresql://localhost/bench`` to run against a local PostgreSQL (its
+tables are dropped afterwards). Every scenario is repeated and the best run
+is kept. With `--max-overhead`, the exit status is 1 if any scenario is
+more than RATIO times slower audited than plain, so it can guard against
+regressions in the mapper handlers.
+'''
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+import sqlalchemy as sa
+from sqlalchemy.ext.declarative import declarative_base
+
+from sqlalchemy_audit.versioned import Versioned
+
+
+def make_model(Base, ncols, versioned):
+  attrs = {
+    '__tablename__': 'widget',
+    'id': sa.Column(sa.String(36), primary_key=True),
+  }
+  for i in range(ncols):
+    attrs['col_%d' % i] = sa.Column(sa.Integer)
+  bases = (Versioned, Base) if versioned else (Base,)
+  return type('Widget', bases, attrs)
+
+
+class Fixture(object):
+  '''
+  A fresh schema holding `rows` widgets of `ncols` columns.
+  '''
+
+  def __init__(self, engine, ncols, versioned):
+    self.engine = engine
+    self.ncols = ncols
+    self.Base = declarative_base()
+    self.Widget = make_model(self.Base, ncols, versioned)
+    self.Base.metadata.create_all(engine)
+    self.session = sa.orm.Session(engine)
+
+  def widgets(self, rows):
+    return [self.Widget(id=str(uuid.uuid4()),
+                        **dict(('col_%d' % i, n) for i in range(self.ncols)))
+            for n in range(rows)]
+
+  def close(self):
+    self.session.close()
+    self.Base.metadata.drop_all(self.engine)
+    sa.orm.clear_mappers()
+
+
+def timed(fixture, prepare, action):
+  '''
+  Returns the seconds `action(fixture, state)` takes, `state` being what
+  `prepare(fixture)` returned.
+  '''
+  state = prepare(fixture)
+  start = time.time()
+  action(fixture, state)
+  return time.time() - start
+
+
+def flush(fixture, state):
+  fixture.session.flush()
+  fixture.session.commit()
+
+
+def prepare_insert(rows):
+  def prepare(fixture):
+    fixture.session.add_all(fixture.widgets(rows))
+  return prepare
+
+
+def prepare_loaded(rows, change):
+  def prepare(fixture):
+    fixture.session.add_all(fixture.widgets(rows))
+    fixture.session.commit()
+    objs = fixture.session.query(fixture.Widget).all()
+    for obj in objs:
+      change(fixture, obj)
+    return objs
+  return prepare
+
+
+def bump(fixture, obj):
+  obj.col_0 += 1
+
+
+def touch(fixture, obj):
+  # dirty, but no value changes
+  obj.col_0 = obj.col_0
+
+
+def delete(fixture, obj):
+  fixture.session.delete(obj)
+
+
+def prepare_history(rows):
+  def prepare(fixture):
+    fixture.session.add_all(fixture.widgets(rows))
+    fixture.session.commit()
+    for obj in fixture.session.query(fixture.Widget):
+      obj.col_0 += 1
+    fixture.session.commit()
+    fixture.session.expunge_all()
+  return prepare
+
+
+def read_live(fixture, state):
+  fixture.session.execute(
+    sa.select([fixture.Widget.__table__])).fetchall()
+
+
+def read_as_of(fixture, state):
+  Widget = fixture.Widget
+  if 'Revision' not in Widget.__dict__:
+    return read_live(fixture, state)
+  fixture.session.execute(
+    Widget.as_of(fixture.session, time.time()).statement).fetchall()
+
+
+def read_history(fixture, state):
+  Widget = fixture.Widget
+  if 'Revision' not in Widget.__dict__:
+    return read_live(fixture, state)
+  for record in Widget.Revision.iter_history(fixture.session):
+    pass
+
+
+def scenarios(rows, narrow, wide):
+  '''
+  Yields (name, columns, rows, prepare, action) per scenario.
+  '''
+  for ncols, label in ((narrow, 'narrow'), (wide, 'wide')):
+    yield ('insert %s' % label, ncols, rows, prepare_insert(rows), flush)
+    yield ('update %s' % label, ncols, rows, prepare_loaded(rows, bump),
+           flush)
+    yield ('no-op update %s' % label, ncols, rows,
+           prepare_loaded(rows, touch), flush)
+    yield ('delete %s' % label, ncols, rows, prepare_loaded(rows, delete),
+           flush)
+  large = rows * 10
+  yield ('large flush', narrow, large, prepare_insert(large), flush)
+  yield ('as_of read', narrow, rows, prepare_history(rows), read_as_of)
+  yield ('history read', narrow, rows, prepare_history(rows), read_history)
+
+
+def measure(engine, ncols, prepare, action, versioned, repeat):
+  best = None
+  for _ in range(repeat):
+    fixture = Fixture(engine, ncols, versioned)
+    try:
+      elapsed = timed(fixture, prepare, action)
+    finally:
+      fixture.close()
+    best = elapsed if best is None else min(best, elapsed)
+  return best
+
+
+def run(url=None, rows=2000, repeat=3, narrow=5, wide=50, max_overhead=None):
+  tmpdir = None
+  if url is None:
+    tmpdir = tempfile.mkdtemp()
+    url = 'sqlite:///%s' % os.path.join(tmpdir, 'bench.db')
+  engine = sa.create_engine(url)
+  try:
+    print('%s, %d rows, best of %d' % (engine.url, rows, repeat))
+    print('  %-20s %12s %12s %9s' % (
+      'scenario', 'plain us/row', 'audit us/row', 'overhead'))
+    worst = 0
+    for name, ncols, count, prepare, action in scenarios(rows, narrow, wide):
+      plain = measure(engine, ncols, prepare, action, False, repeat)
+      audited = measure(engine, ncols, prepare, action, True, repeat)
+      ratio = audited / plain if plain else float('inf')
+      worst = max(worst, ratio)
+      print('  %-20s %12.2f %12.2f %8.2fx' % (
+        name, plain / count * 1e6, audited / count * 1e6, ratio))
+  finally:
+    engine.dispose()
+    if tmpdir is not None:
+      shutil.rmtree(tmpdir)
+  if max_overhead is not None and worst > max_overhead:
+    print('overhead %.2fx exceeds %.2fx' % (worst, max_overhead))
+    return 1
+  return 0
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+  parser.add_argument('--url', help='database URL (default: SQLite file)')
+  parser.add_argument('--rows', type=int, default=2000)
+  parser.add_argument('--repeat', type=int, default=3)
+  parser.add_argument('--narrow', type=int, default=5,
+                      help='columns of narrow tables')
+  parser.add_argument('--wide', type=int, default=50,
+                      help='columns of wide tables')
+  parser.add_argument('--max-overhead', type=float,
+                      help='fail if audited/plain exceeds this ratio')
+  args = parser.parse_args(argv)
+  return run(args.url, args.rows, args.repeat, args.narrow, args.wide,
+             args.max_overhead)
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Compares rev_id generators and storage formats: insert throughput and the
+on-disk size of the revision table and its indexes (SQLite file database).
+
+Usage
+-----
+  PYTHONPATH=. python bench/bench_rev_id.py [rows] [batch]
+'''
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import sqlalchemy as sa
+from sqlalchemy.ext.declarative import declarative_base
+
+from sqlalchemy_audit import revid
+from sqlalchemy_audit.versioned import Versioned
+
+
+VARIANTS = (
+  ('uuid4', 'text'),
+  ('uuid7', 'text'),
+  ('uuid4', 'binary'),
+  ('uuid7', 'binary'),
+)
+
+
+def run_variant(path, generator, format, rows, batch):
+  engine = sa.create_engine('sqlite:///' + path)
+  Base = declarative_base()
+  class Widget(Versioned, Base):
+    __tablename__ = 'widget'
+    __rev_id_generator__ = staticmethod(getattr(revid, generator))
+    __rev_id_format__ = format
+    id = sa.Column(sa.Integer, primary_key=True)
+    name = sa.Column(sa.String(20))
+  Base.metadata.create_all(engine)
+
+  session = sa.orm.Session(engine)
+  start = time.time()
+  for offset in range(0, rows, batch):
+    session.add_all(
+      Widget(id=n, name='widget %d' % n) for n in range(offset, offset + batch))
+    session.commit()
+    session.expunge_all()
+  elapsed = time.time() - start
+
+  sizes = dict(engine.execute(
+    'SELECT name, SUM(pgsize) FROM dbstat GROUP BY name').fetchall())
+  # revision table plus all of its indexes
+  rev_bytes = sum(size for name, size in sizes.items() if 'widget_rev' in name)
+  index_bytes = sum(size for name, size in sizes.items()
+                    if name.startswith('sqlite_autoindex_widget_rev'))
+  session.close()
+  engine.dispose()
+  return rows / elapsed, rev_bytes, index_bytes
+
+
+def run(rows=100000, batch=1000):
+  print('%d rows, %d per transaction' % (rows, batch))
+  print('  %-7s %-7s %12s %14s %14s'
+        % ('id', 'format', 'rows/s', 'rev total KiB', 'pk index KiB'))
+  tmp = tempfile.mkdtemp()
+  try:
+    for generator, format in VARIANTS:
+      path = os.path.join(tmp, '%s_%s.db' % (generator, format))
+      throughput, rev_bytes, index_bytes = run_variant(
+        path, generator, format, rows, batch)
+      print('  %-7s %-7s %12.0f %14.0f %14.0f'
+            % (generator, format, throughput, rev_bytes / 1024.0,
+               index_bytes / 1024.0))
+  finally:
+    shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+  run(*[int(arg) for arg in sys.argv[1:]])
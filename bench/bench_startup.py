@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Startup benchmark: declaring many versioned models.
+
+Versioned models are registered as they are declared; their revision
+classes are only built when mappers are configured (or on first access).
+This times the declaration, which is what an import pays, separately from
+that deferred work.
+
+Usage
+-----
+  PYTHONPATH=. python bench/bench_startup.py [models] [columns]
+'''
+import sys
+import time
+
+import sqlalchemy as sa
+from sqlalchemy.ext.declarative import declarative_base
+
+from sqlalchemy_audit.versioned import Versioned
+
+
+def make_models(Base, models, ncols):
+  classes = []
+  for n in range(models):
+    attrs = {
+      '__tablename__': 'widget_%d' % n,
+      'id': sa.Column(sa.Integer, primary_key=True),
+    }
+    for i in range(ncols):
+      attrs['col_%d' % i] = sa.Column(sa.Integer)
+    classes.append(type('Widget%d' % n, (Versioned, Base), attrs))
+  return classes
+
+
+def run(models=400, ncols=20):
+  Base = declarative_base()
+  start = time.time()
+  make_models(Base, models, ncols)
+  declare = time.time() - start
+
+  start = time.time()
+  Versioned.configure_revisions()
+  build = time.time() - start
+
+  start = time.time()
+  sa.orm.configure_mappers()
+  configure = time.time() - start
+  sa.orm.clear_mappers()
+
+  print('%d models x %d columns' % (models, ncols))
+  print('  declare models:      %8.2f ms' % (declare * 1e3))
+  print('  build revisions:     %8.2f ms (deferred)' % (build * 1e3))
+  print('  configure mappers:   %8.2f ms (deferred)' % (configure * 1e3))
+
+
+if __name__ == '__main__':
+  run(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Micro-benchmark for the per-row cost of revision snapshots.
+
+Usage
+-----
+  PYTHONPATH=. python bench/bench_versioned.py [rows] [columns]
+'''
+import sys
+import time
+import uuid
+
+import sqlalchemy as sa
+from sqlalchemy.ext.declarative import declarative_base
+
+from sqlalchemy_audit.versioned import Versioned
+
+
+def make_model(Base, ncols):
+  attrs = {
+    '__tablename__': 'widget',
+    'id': sa.Column(sa.String(36), primary_key=True),
+  }
+  for i in range(ncols):
+    attrs['col_%d' % i] = sa.Column(sa.Integer)
+  return type('Widget', (Versioned, Base), attrs)
+
+
+def run(rows=5000, ncols=20):
+  engine = sa.create_engine('sqlite://')
+  Base = declarative_base()
+  Widget = make_model(Base, ncols)
+  Base.metadata.create_all(engine)
+  session = sa.orm.Session(engine)
+
+  objs = []
+  for n in range(rows):
+    obj = Widget(id=str(uuid.uuid4()))
+    for i in range(ncols):
+      setattr(obj, 'col_%d' % i, n)
+    objs.append(obj)
+  session.add_all(objs)
+  start = time.time()
+  session.flush()
+  insert = time.time() - start
+
+  for obj in objs:
+    obj.col_0 += 1
+  start = time.time()
+  session.flush()
+  update = time.time() - start
+  session.commit()
+
+  # no-op update: every object is dirty but no value changes
+  objs = session.query(Widget).all()
+  for obj in objs:
+    obj.col_0 = obj.col_0
+  start = time.time()
+  session.flush()
+  noop = time.time() - start
+  session.commit()
+
+  # isolate the snapshot itself from the unit of work
+  mapper = Widget.__mapper__
+  objs = session.query(Widget).all()
+  start = time.time()
+  for obj in objs:
+    Versioned.before_db_change(mapper, None, obj, 'update')
+  snapshot = time.time() - start
+  session.rollback()
+
+  print('%d rows x %d columns' % (rows, ncols))
+  print('  insert flush: %8.2f us/row' % (insert / rows * 1e6))
+  print('  update flush: %8.2f us/row' % (update / rows * 1e6))
+  print('  no-op update: %8.2f us/row' % (noop / rows * 1e6))
+  print('  snapshot:     %8.2f us/row' % (snapshot / rows * 1e6))
+
+
+if __name__ == '__main__':
+  run(*[int(arg) for arg in sys.argv[1:]])
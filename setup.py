@@ -9,10 +9,13 @@ with open(os.path.join(here, 'README.rst')) as f:
   README = f.read()
 
 requires = [
-  'sqlalchemy >= 0.8.2',
-  'aadict >= 0.2.2',
+  'sqlalchemy >= 1.2, < 2.0',
   ]
 
+extras_require = {
+  'arrow': ['pyarrow'],
+  }
+
 test_requires = [
   'nose >= 1.3.0',
   'morph >= 0.1.2',
@@ -43,5 +46,6 @@ setup(
   zip_safe=True,
   test_suite='sqlalchemy_audit/test',
   install_requires=requires,
+  extras_require=extras_require,
   tests_require=test_requires,
 )
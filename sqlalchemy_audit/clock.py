@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+'''
+Representations of ``rev_created``.
+
+A versioned class picks one with ``__rev_created_type__``:
+
+  'float'      seconds since the epoch as a float (default); read per object
+  'integer'    microseconds since the epoch as a BIGINT
+  'timestamp'  a naive UTC DATETIME
+
+With 'integer' and 'timestamp', every revision of a transaction shares a
+single clock read and gets a ``rev_seq`` number, so revisions order stably by
+(rev_created, rev_seq) instead of relying on distinct float timestamps.
+'''
+import calendar
+import datetime
+import threading
+import time
+
+import sqlalchemy as sa
+
+
+TYPES = ('float', 'integer', 'timestamp')
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def rev_created_type(kind):
+  '''
+  Returns the column type storing `kind` timestamps.
+  '''
+  if kind == 'float':
+    return sa.Float
+  if kind == 'integer':
+    return sa.BigInteger
+  if kind == 'timestamp':
+    return sa.DateTime
+  raise ValueError('unknown rev_created type %r, expected one of %r'
+                   % (kind, TYPES))
+
+
+_lock = threading.Lock()
+_last = [0]
+
+def now_micros():
+  '''
+  Current time in microseconds since the epoch, strictly increasing within
+  the process even if the wall clock steps back.
+  '''
+  micros = int(time.time() * 1000000)
+  with _lock:
+    if micros <= _last[0]:
+      micros = _last[0] + 1
+    _last[0] = micros
+  return micros
+
+
+def from_micros(kind, micros):
+  if kind == 'integer':
+    return micros
+  if kind == 'timestamp':
+    return EPOCH + datetime.timedelta(microseconds=micros)
+  return micros / 1000000.0
+
+
+def to_micros(value):
+  '''
+  Converts seconds since the epoch or a datetime (naive ones are UTC) to
+  microseconds since the epoch.
+  '''
+  if isinstance(value, datetime.datetime):
+    return (calendar.timegm(value.utctimetuple()) * 1000000
+            + value.microsecond)
+  return int(round(value * 1000000))
+
+
+def to_column(table, value):
+  '''
+  Converts `value` (seconds since the epoch or a datetime) to the
+  representation of revision `table`'s rev_created column.
+  '''
+  kind = table.info.get('rev_created', 'float')
+  if kind == 'float' and not isinstance(value, datetime.datetime):
+    return value
+  return from_micros(kind, to_micros(value))
+
+
+def to_datetime(table, value):
+  '''
+  Converts a rev_created value of revision `table` to a naive UTC datetime.
+  '''
+  if isinstance(value, datetime.datetime):
+    return value
+  if table.info.get('rev_created') == 'integer':
+    return EPOCH + datetime.timedelta(microseconds=value)
+  return EPOCH + datetime.timedelta(microseconds=to_micros(value))
+
+
+CLOCK = 'sqlalchemy_audit.clock'
+
+def tick(connection, kind):
+  '''
+  Returns the (rev_created, rev_seq) pair of the next revision written in
+  `connection`'s current transaction. The clock lives in the connection's
+  `info` until the transaction ends, so ORM flushes and statements audited
+  by `core.audit_statements` share one timeline.
+  '''
+  clock = connection.info.get(CLOCK)
+  if clock is None:
+    clock = connection.info[CLOCK] = [now_micros(), 0, {}]
+  clock[1] += 1
+  value = clock[2].get(kind)
+  if value is None:
+    value = clock[2][kind] = from_micros(kind, clock[0])
+  return value, clock[1]
+
+
+def _reset(connection):
+  connection.info.pop(CLOCK, None)
+
+def _checkin(dbapi_connection, connection_record):
+  # returned to the pool, possibly without a commit or rollback event
+  if connection_record is not None:
+    connection_record.info.pop(CLOCK, None)
+
+
+for _event in ('begin', 'commit', 'rollback'):
+  sa.event.listen(sa.engine.Engine, _event, _reset)
+sa.event.listen(sa.pool.Pool, 'checkin', _checkin)
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+'''
+Transaction-level audit context: who changed things, and why.
+
+A versioned class opts in with ``__audit_context__ = True``; its revision
+table then gets a ``rev_txn_id`` column referencing a shared
+``audit_transaction`` table:
+
+  class Reservation(Versioned, Base):
+    __tablename__ = 'reservations'
+    __audit_context__ = True
+    ...
+
+  audit_context(session, user='alice', request_id=request.id,
+                reason='rebooking', ticket=1234)
+  ...
+  session.commit()
+
+The context is written once, as a single ``audit_transaction`` row, on the
+first flush of the transaction that writes revisions of an opted-in class.
+Every revision of the transaction then only stores that row's id, however
+many rows it touches. The context applies until the transaction commits or
+rolls back; savepoints do not end it. Keyword arguments beyond `user`,
+`request_id` and `reason` are stored in the JSON ``data`` column.
+
+`revisions` (``ReservationRev.in_context``) finds what a user or request
+changed with one join on the indexed ``rev_txn_id``.
+'''
+import datetime
+
+import sqlalchemy as sa
+import sqlalchemy.orm
+
+from . import core
+
+
+TABLE_NAME = 'audit_transaction'
+CONTEXT = 'sqlalchemy_audit.context'
+CONTEXT_ID = 'sqlalchemy_audit.context_id'
+
+
+def transaction_table(metadata):
+  '''
+  Returns the ``audit_transaction`` table of `metadata`, defining it on
+  first use.
+  '''
+  table = metadata.tables.get(TABLE_NAME)
+  if table is None:
+    table = sa.Table(
+      TABLE_NAME, metadata,
+      sa.Column('id', sa.Integer, primary_key=True),
+      sa.Column('created', sa.DateTime, nullable=False,
+                default=datetime.datetime.utcnow),
+      sa.Column('user', sa.String(255), index=True),
+      sa.Column('request_id', sa.String(255), index=True),
+      sa.Column('reason', sa.Text),
+      sa.Column('data', sa.JSON),
+    )
+  return table
+
+
+def context_column(metadata):
+  '''
+  Returns the ``rev_txn_id`` column of revision tables that record the
+  audit context.
+  '''
+  return sa.Column(
+    'rev_txn_id', sa.Integer,
+    sa.ForeignKey(transaction_table(metadata).c.id),
+    nullable=True, index=True)
+
+
+def audit_context(session, user=None, request_id=None, reason=None, **data):
+  '''
+  Sets the audit context of `session`'s current transaction. Setting it
+  again before the first flush replaces it; later calls are ignored, since
+  the transaction's revisions already point at the written context.
+  '''
+  session.info[CONTEXT] = {
+    'user': user, 'request_id': request_id, 'reason': reason,
+    'data': data or None}
+
+
+def context_id(session, connection, metadata):
+  '''
+  Returns the ``audit_transaction`` id of `session`'s current transaction,
+  writing its context to the table of `metadata` on `connection` first if
+  needed, or None without a context.
+  '''
+  written = session.info.get(CONTEXT_ID)
+  if written is None:
+    context = session.info.get(CONTEXT)
+    if context is None:
+      return None
+    ident = connection.execute(
+      transaction_table(metadata).insert(), context).inserted_primary_key[0]
+    # remember the (savepoint) transaction the row belongs to
+    written = session.info[CONTEXT_ID] = (
+      ident, core.real_transaction(session.transaction))
+  return written[0]
+
+
+def clear_context(session):
+  '''
+  Session `after_commit` and `after_rollback` handler ending the context
+  with the outermost transaction.
+  '''
+  if core.is_outermost(session):
+    session.info.pop(CONTEXT, None)
+    session.info.pop(CONTEXT_ID, None)
+
+
+def discard_context_id(session, previous_transaction):
+  '''
+  Session `after_soft_rollback` handler forgetting a context row written
+  within a rolled back savepoint, so that it is written again.
+  '''
+  written = session.info.get(CONTEXT_ID)
+  if written is not None and core.within(written[1], previous_transaction):
+    session.info.pop(CONTEXT_ID, None)
+
+
+def revisions(session, rev_cls, **criteria):
+  '''
+  Returns a query of the revisions of `rev_cls` written in transactions
+  whose context matches `criteria` (e.g. ``user='alice'``), in timeline
+  order.
+  '''
+  table = rev_cls.__table__
+  context = transaction_table(table.metadata)
+  query = session.query(rev_cls).join(
+    context, table.c.rev_txn_id == context.c.id)
+  for name, value in criteria.items():
+    query = query.filter(context.c[name] == value)
+  order = [table.c.rev_created]
+  if 'rev_seq' in table.c:
+    order.append(table.c.rev_seq)
+  return query.order_by(*order)
+
+
+sa.event.listen(sa.orm.Session, 'after_commit', clear_context)
+sa.event.listen(sa.orm.Session, 'after_rollback', clear_context)
+sa.event.listen(sa.orm.Session, 'after_soft_rollback', discard_context_id)
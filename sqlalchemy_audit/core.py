@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+'''
+Auditing of writes that bypass the ORM unit of work.
+
+`Session.bulk_insert_mappings`, `bulk_update_mappings`, `Query.update()`,
+`Query.delete()` and Core ``insert()``/``update()``/``delete()`` statements
+never fire the mapper events `Versioned` listens to. `audit_statements`
+installs engine-level hooks that catch these statements on versioned tables
+and record their revisions set-based, with ``INSERT INTO x_rev ... SELECT ...
+FROM x`` statements in the same transaction:
+
+  - single-statement UPDATEs snapshot the new row values (computed from the
+    SET clause) before the UPDATE runs, and the UPDATE then points each
+    row's rev_id at its new revision;
+  - DELETEs snapshot delete revisions of the matching rows before they go;
+  - INSERTs and executemany UPDATEs get a fresh rev_id per row and are
+    copied over by rev_id right after they run.
+
+UPDATEs only setting columns left out of the revisions write none.
+
+Statements issued by an ORM flush are left to the mapper handlers.
+'''
+import warnings
+
+import sqlalchemy as sa
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql import dml
+
+from . import clock, history
+
+
+FLUSHING = 'sqlalchemy_audit.flushing'
+_AFTER = 'sqlalchemy_audit.after_execute'
+
+# rev_id IN (...) lists are chunked to stay below bind parameter limits
+CHUNK = 500
+
+
+class UnauditedStatementWarning(UserWarning):
+  '''
+  Emitted for writes to versioned tables that cannot be audited set-based
+  (INSERT ... SELECT, positional parameters and deduplicated columns).
+  '''
+
+
+def audit_statements(engine):
+  '''
+  Audits Core-level and bulk ORM writes to versioned tables on `engine`.
+  '''
+  if not sa.event.contains(engine, 'before_execute', before_execute):
+    sa.event.listen(engine, 'before_execute', before_execute, retval=True)
+    sa.event.listen(engine, 'after_execute', after_execute)
+    sa.event.listen(engine, 'commit', _reset)
+    sa.event.listen(engine, 'rollback', _reset)
+    # a flush failing within a savepoint never reaches its after_* events
+    sa.event.listen(engine, 'rollback_savepoint', _reset_savepoint)
+
+
+def begin_flush(connection):
+  '''
+  Marks `connection` as executing an ORM flush (set by the mapper handlers).
+  '''
+  connection.info[FLUSHING] = True
+
+def end_flush(connection):
+  connection.info.pop(FLUSHING, None)
+
+def _reset(connection):
+  connection.info.pop(FLUSHING, None)
+  connection.info.pop(_AFTER, None)
+
+def _reset_savepoint(connection, name, context):
+  _reset(connection)
+
+
+def is_outermost(session):
+  '''
+  Whether the transaction `session` is ending (in `after_commit` and
+  `after_rollback`) is its outermost one rather than a savepoint.
+  '''
+  transaction = session.transaction
+  return transaction is None or real_transaction(transaction).parent is None
+
+
+def real_transaction(transaction):
+  # skip the subtransactions of flush() and begin(subtransactions=True)
+  while transaction.parent is not None and not transaction.nested:
+    transaction = transaction.parent
+  return transaction
+
+
+def within(transaction, ancestor):
+  while transaction is not None:
+    if transaction is ancestor:
+      return True
+    transaction = transaction.parent
+  return False
+
+
+class new_rev_id(sa.sql.functions.FunctionElement):
+  '''
+  SQL expression generating a random rev_id in the given storage format.
+  '''
+  name = 'new_rev_id'
+
+  def __init__(self, format='text'):
+    super(new_rev_id, self).__init__()
+    self.format = format
+
+_PG_RANDOM = "md5(random()::text || clock_timestamp()::text)"
+_SQLITE_UUID4 = (
+  "lower(hex(randomblob(4)) || '-' || hex(randomblob(2)) || '-4' || "
+  "substr(hex(randomblob(2)), 2) || '-' || "
+  "substr('89ab', 1 + (abs(random()) % 4), 1) || "
+  "substr(hex(randomblob(2)), 2) || '-' || hex(randomblob(6)))")
+
+@compiles(new_rev_id)
+def _new_rev_id_default(element, compiler, **kw):
+  raise sa.exc.CompileError(
+    'no server-side rev_id generator for dialect %r' % compiler.dialect.name)
+
+@compiles(new_rev_id, 'sqlite')
+def _new_rev_id_sqlite(element, compiler, **kw):
+  if element.format == 'text':
+    return _SQLITE_UUID4
+  return 'randomblob(16)'
+
+@compiles(new_rev_id, 'postgresql')
+def _new_rev_id_postgresql(element, compiler, **kw):
+  if element.format == 'text':
+    return 'CAST(CAST(%s AS UUID) AS VARCHAR)' % _PG_RANDOM
+  if element.format == 'native':
+    return 'CAST(%s AS UUID)' % _PG_RANDOM
+  return "decode(%s, 'hex')" % _PG_RANDOM
+
+@compiles(new_rev_id, 'mysql')
+def _new_rev_id_mysql(element, compiler, **kw):
+  if element.format == 'text':
+    return 'UUID()'
+  return "UNHEX(REPLACE(UUID(), '-', ''))"
+
+
+def before_execute(conn, clauseelement, multiparams, params):
+  '''
+  Engine `before_execute` handler (retval=True).
+  '''
+  if (not isinstance(clauseelement, dml.UpdateBase)
+      or conn.info.get(FLUSHING)):
+    return clauseelement, multiparams, params
+  cls = clauseelement.table.info.get('versioned')
+  if cls is None or cls.__audit_triggers__:
+    return clauseelement, multiparams, params
+
+  paramsets = _distill(multiparams, params)
+  if paramsets is None:
+    warnings.warn('positional parameters on %s are not audited'
+                  % clauseelement.table.name, UnauditedStatementWarning)
+    return clauseelement, multiparams, params
+
+  if isinstance(clauseelement, dml.Delete):
+    for paramset in paramsets:
+      _snapshot(conn, cls, _where(clauseelement, paramset), delete=True)
+    return clauseelement, multiparams, params
+
+  if isinstance(clauseelement, dml.Update):
+    # executemany parameter sets all have the keys of the first one
+    values = _set_values(clauseelement, paramsets[0])
+    if not any(name in cls.Revision.__table__.c for name in values):
+      # only sets columns left out of the revisions
+      return clauseelement, multiparams, params
+
+  if isinstance(clauseelement, dml.Update) and len(paramsets) == 1:
+    primary_key = cls.Revision.__table__.info['primary_key']
+    if (conn.dialect.name == 'mysql'
+        and any(name in values for name in primary_key)):
+      # MySQL assigns the SET clause left to right, so the new rev_id
+      # cannot be matched to the rewritten primary key
+      warnings.warn('primary key updates on %s are not audited'
+                    % clauseelement.table.name, UnauditedStatementWarning)
+      return clauseelement, multiparams, params
+    created = _snapshot(
+      conn, cls, _where(clauseelement, paramsets[0]), values=values)
+    return (clauseelement.values(rev_id=_latest_rev_id(cls, created, values)),
+            multiparams, params)
+
+  if isinstance(clauseelement, dml.Insert):
+    if clauseelement.select is not None:
+      warnings.warn('INSERT ... SELECT on %s is not audited'
+                    % clauseelement.table.name, UnauditedStatementWarning)
+      return clauseelement, multiparams, params
+    if clauseelement._has_multi_parameters:
+      return _tag_rows(conn, cls, clauseelement), multiparams, params
+
+  # INSERT or executemany UPDATE: tag every row with a fresh rev_id
+  rev_ids = []
+  tagged = []
+  for paramset in paramsets:
+    rev_id = str(cls.__rev_id_generator__())
+    rev_ids.append(rev_id)
+    tagged.append(dict(paramset, rev_id=rev_id))
+  conn.info.setdefault(_AFTER, []).append((clauseelement, cls, rev_ids))
+  if len(tagged) == 1:
+    return clauseelement, (tagged[0],), {}
+  return clauseelement, (tagged,), {}
+
+
+def _tag_rows(conn, cls, statement):
+  '''
+  Gives every row of a multi-row VALUES insert a fresh rev_id.
+  '''
+  rev_ids = []
+  rows = []
+  for row in statement.parameters:
+    rev_id = str(cls.__rev_id_generator__())
+    rev_ids.append(rev_id)
+    rows.append(dict(row, rev_id=rev_id))
+  statement = statement._generate()
+  statement.parameters = rows
+  conn.info.setdefault(_AFTER, []).append((statement, cls, rev_ids))
+  return statement
+
+
+def after_execute(conn, clauseelement, multiparams, params, result):
+  '''
+  Engine `after_execute` handler copying tagged rows to the revision table.
+  '''
+  pending = conn.info.get(_AFTER)
+  if not pending or pending[-1][0] is not clauseelement:
+    return
+  clauseelement, cls, rev_ids = pending.pop()
+  live = cls.__mapper__.local_table
+  for offset in range(0, len(rev_ids), CHUNK):
+    _snapshot(conn, cls, live.c.rev_id.in_(rev_ids[offset:offset + CHUNK]),
+              keep_rev_id=True)
+
+
+def _snapshot(conn, cls, whereclause, values=None, delete=False,
+              keep_rev_id=False):
+  '''
+  Inserts a revision for every row of `cls`'s table matching `whereclause`,
+  with `values` (column name to SQL expression) overriding the current
+  ones. Returns the rev_created value used.
+  '''
+  live = cls.__mapper__.local_table
+  table = cls.Revision.__table__
+  kind = table.info.get('rev_created', 'float')
+  if 'rev_seq' in table.c:
+    # the transaction's clock, shared with the ORM revisions
+    created, seq = clock.tick(conn, kind)
+  else:
+    created, seq = clock.from_micros(kind, clock.now_micros()), None
+  primary_key = set(table.info['primary_key'])
+  content = table.info.get('dedup', {})
+  if content and not delete:
+    warnings.warn('deduplicated columns of %s are not audited'
+                  % live.name, UnauditedStatementWarning)
+  columns = []
+  for col in table.c:
+    if col.name == 'rev_id':
+      if keep_rev_id:
+        expr = live.c.rev_id
+      else:
+        expr = new_rev_id(cls.__rev_id_format__)
+    elif col.name == 'rev_created':
+      expr = sa.literal(created, col.type)
+    elif col.name == 'rev_seq':
+      expr = sa.literal(seq, col.type)
+    elif col.name == 'rev_isdelete':
+      expr = sa.literal(delete, col.type)
+    elif col.name in ('rev_changed', 'rev_txn_id'):
+      expr = sa.null()
+    elif (delete and col.name not in primary_key) or col.name in content:
+      expr = sa.null()
+    elif values and col.name in values:
+      expr = values[col.name]
+    else:
+      expr = live.c[col.name]
+    columns.append(expr.label(col.name))
+  select = sa.select(columns).select_from(live)
+  if whereclause is not None:
+    select = select.where(whereclause)
+  conn.execute(table.insert().from_select(list(table.c), select))
+  return created
+
+
+def _latest_rev_id(cls, created, values):
+  '''
+  Correlated subquery fetching the revision `_snapshot` just wrote, with
+  `values`, for the row being updated.
+  '''
+  live = cls.__mapper__.local_table
+  table = cls.Revision.__table__
+  rev = table.alias('rev')
+  # the SET clause sees the old row, so match an updated primary key on the
+  # expression the snapshot stored
+  return sa.select([rev.c.rev_id]).where(sa.and_(
+    rev.c.rev_created == created,
+    *[rev.c[col.name] == values.get(col.name, live.c[col.name])
+      for col in history.primary_key_columns(table)])
+  ).as_scalar()
+
+
+def _distill(multiparams, params):
+  '''
+  Returns the parameter sets of an execute() call as a list of dicts, or
+  None for positional parameters.
+  '''
+  if params:
+    paramsets = [params]
+  elif not multiparams:
+    paramsets = [{}]
+  elif len(multiparams) == 1 and isinstance(multiparams[0], (list, tuple)):
+    paramsets = list(multiparams[0]) or [{}]
+  else:
+    paramsets = list(multiparams)
+  if not all(isinstance(paramset, dict) for paramset in paramsets):
+    return None
+  return paramsets
+
+
+def _set_values(statement, paramset):
+  '''
+  Returns the columns UPDATE `statement` sets with `paramset`, as a dict of
+  column name to SQL expression.
+  '''
+  live = statement.table
+  values = dict((key, value) for key, value in paramset.items()
+                if key in live.c)
+  values.update(_parameters(statement))
+  return dict(
+    (live.c[_column_key(key)].name,
+     _expression(live.c[_column_key(key)], value))
+    for key, value in values.items())
+
+
+def _parameters(statement):
+  parameters = statement.parameters or {}
+  if isinstance(parameters, list):
+    parameters = dict(parameters)
+  return parameters
+
+
+def _column_key(key):
+  if isinstance(key, sa.Column):
+    return key.key
+  return key
+
+
+def _expression(column, value):
+  if isinstance(value, sa.sql.ClauseElement):
+    return value
+  return sa.literal(value, column.type)
+
+
+def _where(statement, paramset):
+  whereclause = statement._whereclause
+  if whereclause is not None and paramset:
+    whereclause = whereclause.params(paramset)
+  return whereclause
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+'''
+Content-addressed storage of large column values in revisions.
+
+A versioned class lists its large columns (documents, blobs, JSON) in
+``__audit_dedup__``:
+
+  class Document(Versioned, Base):
+    __tablename__ = 'documents'
+    __audit_dedup__ = ('body',)
+    id = sa.Column(sa.Integer, primary_key=True)
+    title = sa.Column(sa.String)
+    body = sa.Column(sa.Text)
+
+The ``body`` column of ``documents_rev`` then holds the SHA-256 hex digest
+of the value, and every distinct value is stored once in a side table
+``documents_rev_body`` (``hash``, ``value``). On the revision class,
+``DocumentRev.body`` loads the value on access and ``DocumentRev.body_hash``
+is the stored digest; Core readers (`history.iter_history`, exports) see the
+digest.
+
+An update that does not change ``body`` reuses the digest of the object's
+previous revision, looked up with one query per flush, so the value is
+neither loaded nor written again. New values are written once per flush,
+skipping digests already stored, before the revisions that point at them;
+the insert ignores digests stored concurrently by another transaction
+(``ON CONFLICT DO NOTHING``, ``INSERT OR IGNORE`` or ``INSERT IGNORE``).
+Side table rows are never deleted, even when compaction drops the last
+revision referring to them.
+
+Writes audited by `core.audit_statements` leave deduplicated columns NULL
+(with an `core.UnauditedStatementWarning`), and trigger mode is not
+supported.
+'''
+import collections
+import hashlib
+import json
+
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+PENDING_CONTENT = 'sqlalchemy_audit.pending_content'
+
+# hash IN (...) lists are chunked to stay below bind parameter limits
+CHUNK = 500
+
+
+class Carry(collections.namedtuple(
+    'Carry', ('rev_id', 'target', 'key', 'name'))):
+  '''
+  Placeholder revision value: the digest of attribute `key` is unchanged
+  since revision `rev_id` of `target`.
+  '''
+
+
+def content_hash(value):
+  '''
+  Returns the SHA-256 hex digest identifying `value`, None for NULL.
+  '''
+  if value is None:
+    return None
+  if isinstance(value, str):
+    value = value.encode('utf-8')
+  elif not isinstance(value, (bytes, bytearray, memoryview)):
+    # e.g. JSON documents
+    value = json.dumps(value, sort_keys=True, separators=(',', ':'),
+                       default=str).encode('utf-8')
+  return hashlib.sha256(value).hexdigest()
+
+
+def content_table(table, column):
+  '''
+  Defines the side table of revision `table` holding the values of live
+  `column`.
+  '''
+  value = column.copy()
+  value.name = value.key = 'value'
+  value.nullable = False
+  value.primary_key = value.unique = value.index = False
+  value.foreign_keys = []
+  value.default = value.server_default = None
+  return sa.Table(
+    '%s_%s' % (table.name, column.name), table.metadata,
+    sa.Column('hash', sa.String(64), primary_key=True),
+    value,
+    schema=table.schema)
+
+
+def reference_column(column):
+  '''
+  Returns the revision table column holding the digests of live `column`.
+  '''
+  return sa.Column(column.name, sa.String(64), nullable=True)
+
+
+def properties(table, plan):
+  '''
+  Returns the revision class properties of deduplicated columns: the value
+  (deferred, loaded from the side table) under the attribute key and the
+  digest under ``<key>_hash``.
+  '''
+  props = {}
+  for key, name in plan:
+    side = table.info['dedup'][name]
+    props[key + '_hash'] = table.c[name]
+    props[key] = sa.orm.deferred(
+      sa.select([side.c.value])
+      .where(side.c.hash == table.c[name])
+      .correlate_except(side)
+      .as_scalar())
+  return props
+
+
+def collect(session, table, name, mapper, value):
+  '''
+  Queues `value` of deduplicated column `name` of revision `table` for
+  writing and returns its digest.
+  '''
+  digest = content_hash(value)
+  if digest is not None:
+    pending = session.info.setdefault(
+      PENDING_CONTENT, collections.OrderedDict())
+    side = table.info['dedup'][name]
+    if side not in pending:
+      pending[side] = (mapper, {})
+    pending[side][1][digest] = value
+  return digest
+
+
+def write_pending(session, pending):
+  '''
+  Resolves carried-over digests of `pending` revision rows (revision table
+  to (mapper, rows)) and writes the new side table values of the flush.
+  '''
+  for table, (mapper, rows) in pending.items():
+    if 'dedup' in table.info:
+      _resolve_carries(session, table, mapper, rows)
+  content = session.info.pop(PENDING_CONTENT, None)
+  if not content:
+    return
+  for side, (mapper, values) in content.items():
+    connection = session.connection(mapper=mapper)
+    digests = list(values)
+    for offset in range(0, len(digests), CHUNK):
+      chunk = digests[offset:offset + CHUNK]
+      stored = set(row[0] for row in connection.execute(
+        sa.select([side.c.hash]).where(side.c.hash.in_(chunk))))
+      missing = [{'hash': digest, 'value': values[digest]}
+                 for digest in chunk if digest not in stored]
+      if missing:
+        _insert_missing(connection, side, missing)
+
+
+def _insert_missing(connection, side, rows):
+  # a concurrent transaction may have stored some digests since the lookup
+  name = connection.dialect.name
+  if name == 'postgresql':
+    connection.execute(
+      postgresql.insert(side).on_conflict_do_nothing(), rows)
+  elif name == 'sqlite':
+    connection.execute(side.insert().prefix_with('OR IGNORE'), rows)
+  elif name == 'mysql':
+    connection.execute(side.insert().prefix_with('IGNORE'), rows)
+  else:
+    # one savepoint per row, so a duplicate does not abort the transaction
+    for row in rows:
+      savepoint = connection.begin_nested()
+      try:
+        connection.execute(side.insert(), row)
+      except sa.exc.IntegrityError:
+        savepoint.rollback()
+      else:
+        savepoint.commit()
+
+
+def _resolve_carries(session, table, mapper, rows):
+  carries = [(row, name, value) for row in rows
+             for name, value in row.items() if isinstance(value, Carry)]
+  if not carries:
+    return
+  connection = session.connection(mapper=mapper)
+  names = list(table.info['dedup'])
+  previous = {}
+  rev_ids = list(set(carry.rev_id for row, name, carry in carries))
+  for offset in range(0, len(rev_ids), CHUNK):
+    for prev in connection.execute(
+        sa.select([table.c.rev_id] + [table.c[name] for name in names])
+        .where(table.c.rev_id.in_(rev_ids[offset:offset + CHUNK]))):
+      previous[prev.rev_id] = prev
+  for row, name, carry in carries:
+    prev = previous.get(carry.rev_id)
+    if prev is not None and prev[name] is not None:
+      row[name] = prev[name]
+    else:
+      # previous revision not written (yet), a delta or written by
+      # `core.audit_statements`: NULL is unknown, read the value
+      row[name] = collect(session, table, name, mapper,
+                          getattr(carry.target, carry.key))
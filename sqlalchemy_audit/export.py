@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+'''
+Columnar export of revision history.
+
+Usage
+-----
+  # Arrow record batches (requires pyarrow)
+  for batch in Reservation.export(engine, since=t0, format='arrow'):
+    ...
+
+  # a Parquet file (requires pyarrow), or CSV without any dependency
+  Reservation.export(engine, 'reservations.parquet', since=t0)
+  Reservation.export(engine, 'reservations.csv', ident=42)
+
+Revisions are read with the same keyset-paginated Core SELECTs as
+`history.iter_history`, `chunk_size` rows at a time, and every chunk becomes
+one record batch, row group or block of CSV lines, so memory stays bounded
+by the chunk size. Arrow columns are typed after the revision table's
+column types.
+'''
+import csv
+import datetime
+import decimal
+import importlib.util
+import json
+
+import sqlalchemy as sa
+
+from . import history, revid
+
+
+FORMATS = ('arrow', 'parquet', 'csv')
+
+
+def export(connectable, table, dest=None, format=None, ident=None,
+           since=None, until=None, isdelete=None, chunk_size=10000):
+  '''
+  Exports revision `table` to `dest` (a path or, for CSV, a text file
+  object) as 'parquet' or 'csv', or returns an iterator of Arrow record
+  batches for 'arrow'. The format defaults to the extension of `dest`
+  ('.csv' or '.parquet', which requires pyarrow), then to parquet when
+  pyarrow is installed and CSV otherwise. Returns the number of exported
+  revisions for files.
+  '''
+  if format is None:
+    name = getattr(dest, 'name', dest)
+    if isinstance(name, str) and name.endswith('.csv'):
+      format = 'csv'
+    elif isinstance(name, str) and name.endswith('.parquet'):
+      # never silently write CSV into a .parquet file
+      format = 'parquet'
+    elif dest is None:
+      format = 'arrow'
+    else:
+      format = 'parquet' if has_pyarrow() else 'csv'
+  chunks = history.iter_chunks(
+    connectable, table, ident, since, until, isdelete, chunk_size)
+  if format == 'arrow':
+    return record_batches(table, chunks)
+  if format == 'parquet':
+    return write_parquet(table, chunks, dest)
+  if format == 'csv':
+    return write_csv(table, chunks, dest)
+  raise ValueError('unknown export format %r, expected one of %r'
+                   % (format, FORMATS))
+
+
+def has_pyarrow():
+  '''
+  Whether pyarrow is installed, without importing it.
+  '''
+  try:
+    return importlib.util.find_spec('pyarrow') is not None
+  except ImportError: # pragma: no cover
+    return False
+
+
+def _pyarrow():
+  # imported on first use: pyarrow is slow to import and optional
+  try:
+    import pyarrow
+    import pyarrow.parquet
+  except ImportError:
+    raise ImportError('Arrow and Parquet export require pyarrow')
+  return pyarrow
+
+
+def arrow_schema(table):
+  '''
+  Returns the Arrow schema matching the columns of revision `table`.
+  '''
+  pyarrow = _pyarrow()
+  return pyarrow.schema([
+    pyarrow.field(col.name, arrow_type(col.type), nullable=col.nullable)
+    for col in table.c])
+
+
+def arrow_type(type_):
+  pyarrow = _pyarrow()
+  if isinstance(type_, revid.RevId):
+    return pyarrow.string()
+  if isinstance(type_, sa.Boolean):
+    return pyarrow.bool_()
+  if isinstance(type_, sa.Integer):
+    return pyarrow.int64()
+  if isinstance(type_, sa.Float):
+    return pyarrow.float64()
+  if isinstance(type_, sa.Numeric):
+    return pyarrow.float64() if type_.asdecimal is False else pyarrow.string()
+  if isinstance(type_, sa.DateTime):
+    return pyarrow.timestamp('us')
+  if isinstance(type_, sa.Date):
+    return pyarrow.date32()
+  if isinstance(type_, sa.Time):
+    return pyarrow.time64('us')
+  if isinstance(type_, sa.LargeBinary):
+    return pyarrow.binary()
+  return pyarrow.string()
+
+
+def record_batches(table, chunks):
+  '''
+  Converts row `chunks` of revision `table` into Arrow record batches.
+  '''
+  pyarrow = _pyarrow()
+  schema = arrow_schema(table)
+  converters = [_arrow_converter(field.type) for field in schema]
+  for chunk in chunks:
+    columns = zip(*chunk)
+    yield pyarrow.RecordBatch.from_arrays(
+      [pyarrow.array(convert(column), type=field.type)
+       for column, field, convert in zip(columns, schema, converters)],
+      schema=schema)
+
+
+def _arrow_converter(arrow):
+  if arrow == _pyarrow().string():
+    # e.g. Numeric, JSON and unknown types: keep their text form
+    return lambda column: [_text(value) for value in column]
+  return list
+
+
+def write_parquet(table, chunks, path):
+  '''
+  Writes row `chunks` of revision `table` to Parquet file `path`, one row
+  group per chunk.
+  '''
+  pyarrow = _pyarrow()
+  count = 0
+  with pyarrow.parquet.ParquetWriter(path, arrow_schema(table)) as writer:
+    for batch in record_batches(table, chunks):
+      writer.write_batch(batch)
+      count += batch.num_rows
+  return count
+
+
+def write_csv(table, chunks, dest):
+  '''
+  Writes row `chunks` of revision `table` as CSV with a header line to
+  `dest`, a path or text file object. NULLs are written as empty fields,
+  dates and times in ISO format and JSON values as JSON.
+  '''
+  if isinstance(dest, str):
+    with open(dest, 'w', newline='') as fileobj:
+      return write_csv(table, chunks, fileobj)
+  writer = csv.writer(dest)
+  writer.writerow([col.name for col in table.c])
+  count = 0
+  for chunk in chunks:
+    writer.writerows([_csv_value(value) for value in row] for row in chunk)
+    count += len(chunk)
+  return count
+
+
+def _csv_value(value):
+  if isinstance(value, (datetime.date, datetime.time)):
+    return value.isoformat()
+  if isinstance(value, (decimal.Decimal, dict, list)):
+    return _text(value)
+  return value
+
+
+def _text(value):
+  if value is None or isinstance(value, str):
+    return value
+  if isinstance(value, (dict, list)):
+    # JSON columns
+    return json.dumps(value, sort_keys=True)
+  return str(value)
@@ -0,0 +1,474 @@
+# -*- coding: utf-8 -*-
+'''
+Read helpers for revision tables.
+'''
+import collections
+
+import sqlalchemy as sa
+
+from . import clock, context
+
+
+def primary_key_columns(table):
+  '''
+  Returns the revision columns copied from the versioned table's primary key.
+  '''
+  return [table.c[name] for name in table.info['primary_key']]
+
+
+def timeline_columns(table):
+  '''
+  Returns the columns ordering the revisions of one row: rev_created, plus
+  rev_seq for tables with a per-transaction clock.
+  '''
+  if 'rev_seq' in table.c:
+    return [table.c.rev_created, table.c.rev_seq]
+  return [table.c.rev_created]
+
+
+def ident_criteria(table, ident):
+  '''
+  Returns the criteria selecting primary key `ident` (a scalar or a tuple
+  for composite keys) in revision `table`.
+  '''
+  primary_key = primary_key_columns(table)
+  if not isinstance(ident, (tuple, list)):
+    ident = (ident,)
+  if len(ident) != len(primary_key):
+    raise ValueError('expected %d primary key values, got %r'
+                     % (len(primary_key), ident))
+  return sa.and_(*[col == value for col, value in zip(primary_key, ident)])
+
+
+def idents_criteria(table, idents):
+  '''
+  Returns the criteria selecting any of the primary keys `idents` (see
+  `ident_criteria`) in revision `table`.
+  '''
+  primary_key = primary_key_columns(table)
+  idents = list(idents)
+  if len(primary_key) == 1 and not any(
+      isinstance(ident, (tuple, list)) for ident in idents):
+    return primary_key[0].in_(idents)
+  return sa.or_(*[ident_criteria(table, ident) for ident in idents])
+
+
+def data_columns(table):
+  '''
+  Returns the revision columns copied from the versioned table, except the
+  primary key.
+  '''
+  primary_key = table.info['primary_key']
+  return [col for col in table.c
+          if not col.name.startswith('rev_') and col.name not in primary_key]
+
+
+def keyset_after(columns, values):
+  '''
+  Returns the criteria for rows sorting strictly after `values` on
+  `columns`, spelled out as nested comparisons so that any backend can seek
+  on a matching index (row-value comparisons are not portable).
+  '''
+  return _keyset(columns, values, lambda col, value: col > value)
+
+
+def keyset_before(columns, values):
+  '''
+  Returns the criteria for rows sorting strictly before `values` on
+  `columns`; see `keyset_after`.
+  '''
+  return _keyset(columns, values, lambda col, value: col < value)
+
+
+def _keyset(columns, values, compare):
+  criteria = []
+  for idx, col in enumerate(columns):
+    criteria.append(sa.and_(
+      *[prev == value for prev, value in zip(columns[:idx], values)]
+      + [compare(col, values[idx])]))
+  return sa.or_(*criteria)
+
+
+def record_class(table):
+  '''
+  Returns the immutable record type (a namedtuple, so slotted) of revision
+  `table`'s rows, with one field per column name.
+  '''
+  record = table.info.get('record')
+  if record is None:
+    record = table.info['record'] = collections.namedtuple(
+      '%sRecord' % ''.join(
+        part.capitalize() for part in table.name.split('_')),
+      [col.name for col in table.c], rename=True)
+  return record
+
+
+def iter_history(connectable, table, ident=None, since=None, until=None,
+                 isdelete=None, batch_size=1000):
+  '''
+  Yields the rows of revision `table` in (primary key, timeline) order as
+  immutable records (see `record_class`), reading `batch_size` rows at a
+  time with keyset pagination so memory stays flat however long the history
+  is.
+
+  `ident` restricts it to one primary key, `since`/`until` to an inclusive
+  rev_created range (seconds since the epoch or datetimes) and `isdelete`
+  to (non-)delete revisions.
+  '''
+  make = record_class(table)._make
+  for chunk in iter_chunks(connectable, table, ident, since, until, isdelete,
+                           batch_size):
+    for row in chunk:
+      yield make(row)
+
+
+def iter_chunks(connectable, table, ident=None, since=None, until=None,
+                isdelete=None, chunk_size=1000, criteria=()):
+  '''
+  Yields the rows `iter_history` selects as lists of at most `chunk_size`
+  result rows, one keyset-paginated SELECT each. `criteria` are further
+  WHERE clauses.
+  '''
+  order = (primary_key_columns(table) + timeline_columns(table)
+           + [table.c.rev_id])
+  criteria = list(criteria)
+  if ident is not None:
+    criteria.append(ident_criteria(table, ident))
+  if since is not None:
+    criteria.append(table.c.rev_created >= clock.to_column(table, since))
+  if until is not None:
+    criteria.append(table.c.rev_created <= clock.to_column(table, until))
+  if isdelete is not None:
+    criteria.append(table.c.rev_isdelete == bool(isdelete))
+
+  last = None
+  while True:
+    query = sa.select([table]).where(sa.and_(*criteria))
+    if last is not None:
+      query = query.where(keyset_after(order, last))
+    chunk = connectable.execute(
+      query.order_by(*order).limit(chunk_size)).fetchall()
+    if chunk:
+      yield chunk
+    if len(chunk) < chunk_size:
+      return
+    last = [chunk[-1][col.name] for col in order]
+
+
+class RevisionReader(object):
+  '''
+  Read API mixed into every generated revision class.
+  '''
+
+  @classmethod
+  def iter_history(cls, connectable, ident=None, since=None, until=None,
+                   isdelete=None, batch_size=1000):
+    '''
+    Streams this class's revisions without loading ORM objects; see
+    `iter_history`. `connectable` is a session, connection or engine.
+    '''
+    return iter_history(connectable, cls.__table__, ident, since, until,
+                        isdelete, batch_size)
+
+  @classmethod
+  def as_of_records(cls, connectable, timestamp, ident=None, idents=None):
+    '''
+    Yields the revisions `as_of` would return as immutable records instead
+    of ORM objects.
+    '''
+    return as_of_records(connectable, cls.__table__, timestamp, ident,
+                         idents)
+
+  @classmethod
+  def in_context(cls, session, **criteria):
+    '''
+    Returns a query of the revisions written under a matching audit context
+    (e.g. ``user='alice', request_id='r-1'``); see `context.revisions`.
+    '''
+    return context.revisions(session, cls, **criteria)
+
+  @classmethod
+  def diff(cls, connectable, ident=None, idents=None, since=None, until=None,
+           windowed=None, chunk_size=1000):
+    '''
+    Yields the changes of each revision against the previous one of its
+    row; see `diff`.
+    '''
+    return diff(connectable, cls.__table__, ident, idents, since, until,
+                windowed, chunk_size)
+
+  @classmethod
+  def diff_as_of(cls, connectable, before, after, ident=None, idents=None):
+    '''
+    Yields the changes of each row between two points in time; see
+    `diff_as_of`.
+    '''
+    return diff_as_of(connectable, cls.__table__, before, after, ident,
+                      idents)
+
+
+def as_of(session, rev_cls, timestamp, ident=None):
+  '''
+  Returns a query of the latest revision of each row of `rev_cls` as of
+  `timestamp`, excluding rows whose latest revision is a delete.
+
+  The per-key MAX(rev_created) is resolved on the (primary key...,
+  rev_created[, rev_seq]) index that `create_rev_class` adds to every
+  revision table; revisions of one transaction sharing that timestamp are
+  told apart by rev_seq with a seek on the same index.
+  '''
+  joined, criteria = _as_of(rev_cls.__table__, timestamp, ident)
+  return session.query(rev_cls).select_from(joined).filter(*criteria)
+
+
+def as_of_records(connectable, table, timestamp, ident=None, idents=None):
+  '''
+  Yields the rows `as_of` selects from revision `table` as immutable
+  records. `idents` narrows it down to a list of primary keys.
+  '''
+  joined, criteria = _as_of(table, timestamp, ident, idents)
+  make = record_class(table)._make
+  result = connectable.execute(
+    sa.select([table]).select_from(joined).where(sa.and_(*criteria)))
+  for row in result:
+    yield make(row)
+
+
+def _as_of(table, timestamp, ident, idents=None):
+  primary_key = primary_key_columns(table)
+  timestamp = clock.to_column(table, timestamp)
+  latest = sa.select(
+    primary_key + [sa.func.max(table.c.rev_created).label('rev_created')]
+  ).where(table.c.rev_created <= timestamp)
+  if ident is not None:
+    latest = latest.where(ident_criteria(table, ident))
+  if idents is not None:
+    latest = latest.where(idents_criteria(table, idents))
+  latest = latest.group_by(*primary_key).alias('latest')
+  joined = table.join(
+    latest,
+    sa.and_(table.c.rev_created == latest.c.rev_created,
+            *[col == latest.c[col.name] for col in primary_key]))
+  criteria = [table.c.rev_isdelete == sa.false()]
+  if 'rev_seq' in table.c:
+    later = table.alias('later')
+    criteria.append(~sa.exists().where(sa.and_(
+      later.c.rev_created == table.c.rev_created,
+      later.c.rev_seq > table.c.rev_seq,
+      *[later.c[col.name] == col for col in primary_key])))
+  return joined, criteria
+
+
+def revision_state(session, table, rev_id):
+  '''
+  Returns the full state of revision `rev_id` of revision `table` as a dict
+  keyed by column name, or None if there is no such revision.
+
+  Delta revisions (see ``__audit_delta__``) only carry the columns listed in
+  ``rev_changed``; the rest is filled in from earlier revisions of the same
+  row, walking back until a full snapshot.
+  '''
+  row = session.execute(
+    sa.select([table]).where(table.c.rev_id == rev_id)).first()
+  if row is None:
+    return None
+  state = dict(row)
+  if 'rev_changed' not in table.c or row.rev_changed is None:
+    return state
+
+  primary_key = primary_key_columns(table)
+  missing = set(
+    col.name for col in table.c
+    if not col.name.startswith('rev_') and col not in primary_key)
+  missing.difference_update(row.rev_changed.split(','))
+  timeline = timeline_columns(table)
+  earlier = session.execute(
+    sa.select([table])
+    .where(sa.and_(*[col == row[col.name] for col in primary_key]))
+    .where(keyset_before(timeline, [row[col.name] for col in timeline]))
+    .order_by(*[col.desc() for col in timeline]))
+  try:
+    for prev in earlier:
+      if prev.rev_changed is None:
+        names = set(missing)
+      else:
+        names = missing.intersection(prev.rev_changed.split(','))
+      for name in names:
+        state[name] = prev[name]
+      missing.difference_update(names)
+      if not missing:
+        break
+  finally:
+    earlier.close()
+  return state
+
+
+class Diff(collections.namedtuple(
+    'Diff', ('key', 'rev_id', 'rev_created', 'rev_isdelete', 'changes'))):
+  '''
+  Changes of one row: `key` is its primary key tuple, `changes` an ordered
+  dict mapping column names to (old, new) value pairs. The revision fields
+  are those of the newer side (None for rows deleted between two points in
+  time).
+  '''
+  __slots__ = ()
+
+
+def diff(connectable, table, ident=None, idents=None, since=None, until=None,
+         windowed=None, chunk_size=1000):
+  '''
+  Yields a `Diff` per revision of revision `table` against the previous
+  revision of the same row, in (primary key, timeline) order. Inserts show
+  every non-NULL value as new and deletes every non-NULL value as gone.
+
+  `ident` or `idents` restrict it to one or a batch of primary keys and
+  `since`/`until` to an inclusive rev_created range of the newer revision.
+
+  Where the backend has window functions (PostgreSQL, MySQL 8, SQLite 3.25)
+  this is a single ``LAG() OVER (PARTITION BY <primary key> ORDER BY
+  rev_created)`` query, read `chunk_size` rows at a time. Delta tables, other
+  backends and ``windowed=False`` use a streaming comparison in Python,
+  which reads each row's history from its start up to `until`.
+  '''
+  if windowed is None:
+    windowed = ('rev_changed' not in table.c
+                and supports_window(_dialect(connectable)))
+  elif windowed and 'rev_changed' in table.c:
+    raise ValueError('delta revisions cannot be compared in SQL')
+  criteria = []
+  if ident is not None:
+    criteria.append(ident_criteria(table, ident))
+  if idents is not None:
+    criteria.append(idents_criteria(table, idents))
+  if windowed:
+    return _diff_windowed(connectable, table, criteria, since, until,
+                          chunk_size)
+  return _diff_streamed(connectable, table, criteria, since, until,
+                        chunk_size)
+
+
+def diff_as_of(connectable, table, before, after, ident=None, idents=None):
+  '''
+  Yields a `Diff` per row whose state differs between timestamps `before`
+  and `after` (see `as_of`): rows created, changed or deleted in between.
+  `ident` or `idents` restrict it to one or a batch of primary keys.
+  '''
+  names = [col.name for col in table.c]
+  primary_key = table.info['primary_key']
+  data = [col.name for col in data_columns(table)]
+
+  def state(record):
+    row = dict(zip(names, record))
+    if row.get('rev_changed') is not None:
+      row = revision_state(connectable, table, row['rev_id'])
+    return row
+
+  old = collections.OrderedDict()
+  for record in as_of_records(connectable, table, before, ident, idents):
+    row = state(record)
+    old[tuple(row[name] for name in primary_key)] = row
+  for record in as_of_records(connectable, table, after, ident, idents):
+    row = state(record)
+    key = tuple(row[name] for name in primary_key)
+    changes = _changes(data, old.pop(key, None), row)
+    if changes:
+      yield Diff(key, row['rev_id'], row['rev_created'], False, changes)
+  for key, row in old.items():
+    yield Diff(key, None, None, True, _changes(data, row, None))
+
+
+def supports_window(dialect):
+  '''
+  Whether `dialect` has the window functions `diff` relies on.
+  '''
+  if dialect.name == 'postgresql':
+    return True
+  if dialect.name == 'sqlite':
+    return getattr(dialect.dbapi, 'sqlite_version_info', (0,)) >= (3, 25)
+  if dialect.name == 'mysql':
+    # MariaDB reports 10.2+ with window functions
+    return (dialect.server_version_info or (0,)) >= (8,)
+  return False
+
+
+def _dialect(connectable):
+  dialect = getattr(connectable, 'dialect', None)
+  if dialect is None:
+    # a session
+    dialect = connectable.get_bind().dialect
+  return dialect
+
+
+def _changes(names, old, new):
+  changes = collections.OrderedDict()
+  for name in names:
+    before = None if old is None else old[name]
+    after = None if new is None else new[name]
+    if before != after:
+      changes[name] = (before, after)
+  return changes
+
+
+def _diff_windowed(connectable, table, criteria, since, until, chunk_size):
+  primary_key = primary_key_columns(table)
+  timeline = timeline_columns(table)
+  data = data_columns(table)
+  order = timeline + [table.c.rev_id]
+  # labels that cannot clash with column names
+  previous = [
+    sa.func.lag(col).over(partition_by=primary_key, order_by=order)
+    .label('_prev_%d' % idx) for idx, col in enumerate(data)]
+  windowed = sa.select(
+    [table.c.rev_id, table.c.rev_isdelete] + timeline + primary_key + data
+    + previous).where(sa.and_(*criteria)).alias('windowed')
+  query = sa.select([windowed])
+  created = windowed.c.rev_created
+  if since is not None:
+    query = query.where(created >= clock.to_column(table, since))
+  if until is not None:
+    query = query.where(created <= clock.to_column(table, until))
+  query = query.order_by(
+    *[windowed.c[col.name] for col in primary_key + order])
+  result = connectable.execute(query.execution_options(stream_results=True))
+  names = [col.name for col in data]
+  try:
+    while True:
+      rows = result.fetchmany(chunk_size)
+      if not rows:
+        return
+      for row in rows:
+        old = dict(
+          (name, row['_prev_%d' % idx]) for idx, name in enumerate(names))
+        yield Diff(tuple(row[col.name] for col in primary_key), row.rev_id,
+                   row.rev_created, row.rev_isdelete,
+                   _changes(names, old, row))
+  finally:
+    result.close()
+
+
+def _diff_streamed(connectable, table, criteria, since, until, chunk_size):
+  primary_key = table.info['primary_key']
+  names = [col.name for col in data_columns(table)]
+  since = None if since is None else clock.to_column(table, since)
+  delta = 'rev_changed' in table.c
+  key = state = None
+  for chunk in iter_chunks(connectable, table, None, None, until, None,
+                           chunk_size, criteria):
+    for row in chunk:
+      row_key = tuple(row[name] for name in primary_key)
+      if row_key != key:
+        key, state = row_key, None
+      old = state
+      if delta and row.rev_changed is not None:
+        if state is None:
+          # history starts with a delta (e.g. compacted): read it back
+          state = revision_state(connectable, table, row.rev_id)
+        else:
+          state = dict(state)
+          for name in row.rev_changed.split(','):
+            state[name] = row[name]
+      else:
+        state = dict(row)
+      if since is None or row.rev_created >= since:
+        yield Diff(key, row.rev_id, row.rev_created, row.rev_isdelete,
+                   _changes(names, old, state))
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+'''
+Instrumentation of revision writes.
+
+Usage
+-----
+  metrics = Counters()
+  Versioned.versioned_session(metrics=metrics)
+  ...
+  metrics.counts[(Reservation, 'update')]
+
+The mapper handlers and flush hooks report to the configured `Metrics`
+object:
+
+  - `revision`: a revision was built for a model ('insert', 'update' or
+    'delete'), with the seconds the handler took;
+  - `skipped`: an update of a model changed no audited value, so no revision
+    was written;
+  - `written`: revision rows of a table were written (or handed to the async
+    writer) at the end of a flush, with their approximate size in bytes;
+  - `queue_depth`: the async writer's queue length after a commit.
+
+Subclass `Metrics` to forward these to StatsD, Prometheus and the like;
+`Counters` aggregates them in memory. Without a metrics object (the
+default), the handlers only pay for one attribute check.
+'''
+import collections
+import threading
+
+
+class Metrics(object):
+  '''
+  Metrics interface; every method is a no-op by default.
+  '''
+
+  def revision(self, model, action, seconds):
+    pass
+
+  def skipped(self, model):
+    pass
+
+  def written(self, table, rows, size):
+    pass
+
+  def queue_depth(self, depth):
+    pass
+
+
+# upper bounds (seconds) of the handler timing histogram buckets
+BUCKETS = (1e-5, 1e-4, 1e-3, 1e-2, 1e-1, float('inf'))
+
+
+class Counters(Metrics):
+  '''
+  Thread-safe in-memory aggregation of the metrics.
+
+  `counts` maps (model, action) to the number of revisions, 'skipped'
+  being an action too. `seconds` maps (model, action) to the total handler
+  time and `histogram` to a list of counts per `BUCKETS` bound. `rows` and
+  `bytes` map revision table names to the rows and bytes written, and
+  `max_queue_depth` is the deepest async writer queue seen.
+  '''
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.counts = collections.Counter()
+    self.seconds = collections.Counter()
+    self.histogram = collections.defaultdict(lambda: [0] * len(BUCKETS))
+    self.rows = collections.Counter()
+    self.bytes = collections.Counter()
+    self.max_queue_depth = 0
+
+  def revision(self, model, action, seconds):
+    with self.lock:
+      self.counts[(model, action)] += 1
+      self.seconds[(model, action)] += seconds
+      buckets = self.histogram[(model, action)]
+      for idx, bound in enumerate(BUCKETS):
+        if seconds <= bound:
+          buckets[idx] += 1
+          break
+
+  def skipped(self, model):
+    with self.lock:
+      self.counts[(model, 'skipped')] += 1
+
+  def written(self, table, rows, size):
+    with self.lock:
+      self.rows[table.name] += rows
+      self.bytes[table.name] += size
+
+  def queue_depth(self, depth):
+    with self.lock:
+      self.max_queue_depth = max(self.max_queue_depth, depth)
+
+
+def row_size(row):
+  '''
+  Returns the approximate size in bytes of revision `row` (a dict): the
+  length of text and binary values, 8 bytes for anything else.
+  '''
+  size = 0
+  for value in row.values():
+    if value is None:
+      continue
+    if isinstance(value, (str, bytes, bytearray)):
+      size += len(value)
+    else:
+      size += 8
+  return size
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+'''
+Time-range partitioning of revision tables.
+
+A versioned class opts in with ``__audit_partition__`` set to 'day', 'month'
+or 'year':
+
+  class Reservation(Versioned, Base):
+    __tablename__ = 'reservations'
+    __audit_partition__ = 'month'
+    ...
+
+On PostgreSQL the revision table is then declared ``PARTITION BY RANGE
+(rev_created)`` (its primary key becomes ``(rev_id, rev_created)``, as
+partitioning requires) and created with a default partition plus one
+partition per period, named ``reservations_rev_p202604`` and so on.
+
+Other dialects fall back to a table per period: the revision table holds
+the current period, and `maintain_partitions` moves the revisions of every
+period that is over to ``reservations_rev_p<period>``, keeping the latest
+revision of every live row (as a full snapshot) so that point-in-time reads
+of the present keep working. Revisions older than that carry-over are only
+found in the period tables.
+
+Run `maintain_partitions` regularly (e.g. daily): it creates upcoming
+partitions and detaches (and optionally drops) expired ones, so retention
+drops whole tables instead of deleting rows.
+'''
+import datetime
+
+import sqlalchemy as sa
+
+from . import clock, history
+
+
+PERIODS = ('day', 'month', 'year')
+TABLE_KWARGS = {'postgresql_partition_by': 'RANGE (rev_created)'}
+_SUFFIX = {'day': '%Y%m%d', 'month': '%Y%m', 'year': '%Y'}
+
+
+def check_period(period):
+  if period not in PERIODS:
+    raise ValueError('unknown partition period %r, expected one of %r'
+                     % (period, PERIODS))
+  return period
+
+
+def period_start(period, moment):
+  '''
+  Returns the start of the `period` containing datetime `moment`.
+  '''
+  if period == 'day':
+    return datetime.datetime(moment.year, moment.month, moment.day)
+  if period == 'month':
+    return datetime.datetime(moment.year, moment.month, 1)
+  return datetime.datetime(moment.year, 1, 1)
+
+
+def shift(period, start, count):
+  '''
+  Returns the start of the period `count` periods after (or before, if
+  negative) the one starting at `start`.
+  '''
+  if period == 'day':
+    return start + datetime.timedelta(days=count)
+  if period == 'month':
+    months = start.year * 12 + start.month - 1 + count
+    return datetime.datetime(months // 12, months % 12 + 1, 1)
+  return datetime.datetime(start.year + count, 1, 1)
+
+
+def partition_name(table, start):
+  return '%s_p%s' % (
+    table.name, start.strftime(_SUFFIX[table.info['partition']]))
+
+
+def install(table):
+  '''
+  Sets up the partitions of revision `table` when it is created. The table
+  itself is declared with `TABLE_KWARGS`.
+  '''
+  sa.event.listen(table, 'after_create', _after_create)
+
+
+def _after_create(table, connection, **kw):
+  if connection.dialect.name == 'postgresql':
+    connection.execute(
+      'CREATE TABLE IF NOT EXISTS %s PARTITION OF %s DEFAULT'
+      % (_quote(connection, table, table.name + '_default'),
+         _quote(connection, table, table.name)))
+    maintain_partitions(connection, table)
+
+
+def maintain_partitions(connection, target, ahead=2, keep=None, drop=False,
+                        now=None):
+  '''
+  Creates the partitions of the current and `ahead` upcoming periods and,
+  with `keep`, detaches the partitions of periods that ended before the
+  last `keep` periods (counting the current one); `drop` drops them as well.
+  Returns the names of the expired partitions.
+
+  `target` is a versioned class or its revision table. `now` (a naive UTC
+  datetime) defaults to the current time.
+  '''
+  table = getattr(getattr(target, 'Revision', target), '__table__', target)
+  period = table.info['partition']
+  current = period_start(period, now or datetime.datetime.utcnow())
+  if connection.dialect.name == 'postgresql':
+    for count in range(ahead + 1):
+      start = shift(period, current, count)
+      connection.execute(
+        'CREATE TABLE IF NOT EXISTS %s PARTITION OF %s '
+        'FOR VALUES FROM (%s) TO (%s)' % (
+          _quote(connection, table, partition_name(table, start)),
+          _quote(connection, table, table.name),
+          _bound(table, start), _bound(table, shift(period, start, 1))))
+  else:
+    _rotate(connection, table, current)
+  if keep is None:
+    return []
+  cutoff = shift(period, current, 1 - keep)
+  expired = [
+    name for name, start in _partitions(connection, table)
+    if shift(period, start, 1) <= cutoff]
+  for name in expired:
+    if connection.dialect.name == 'postgresql':
+      connection.execute('ALTER TABLE %s DETACH PARTITION %s' % (
+        _quote(connection, table, table.name),
+        _quote(connection, table, name)))
+    if drop:
+      connection.execute('DROP TABLE %s' % _quote(connection, table, name))
+  return expired
+
+
+def _partitions(connection, table):
+  '''
+  Returns (name, period start) pairs of `table`'s partitions (attached ones
+  on PostgreSQL, period tables elsewhere), oldest first.
+  '''
+  if connection.dialect.name == 'postgresql':
+    names = [row[0] for row in connection.execute(sa.text(
+      'SELECT child.relname FROM pg_inherits '
+      'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+      'WHERE pg_inherits.inhparent = CAST(:parent AS regclass)'),
+      parent=_quote(connection, table, table.name))]
+  else:
+    names = sa.inspect(connection).get_table_names(schema=table.schema)
+  prefix = table.name + '_p'
+  partitions = []
+  for name in names:
+    if name.startswith(prefix):
+      try:
+        start = datetime.datetime.strptime(
+          name[len(prefix):], _SUFFIX[table.info['partition']])
+      except ValueError:
+        continue
+      partitions.append((name, start))
+  return sorted(partitions, key=lambda partition: partition[1])
+
+
+def _rotate(connection, table, current):
+  '''
+  Table-per-period fallback: moves the revisions of `table` from periods
+  before `current` that are not archived yet to their period tables.
+  '''
+  period = table.info['partition']
+  partitions = _partitions(connection, table)
+  end = _value(table, current)
+  # carried-over revisions predate the end of the latest period table
+  criteria = [table.c.rev_created < end]
+  if partitions:
+    criteria.append(table.c.rev_created >= _value(
+      table, shift(period, partitions[-1][1], 1)))
+  oldest = connection.execute(
+    sa.select([sa.func.min(table.c.rev_created)])
+    .where(sa.and_(*criteria))).scalar()
+  if oldest is None:
+    return
+
+  start = period_start(period, clock.to_datetime(table, oldest))
+  while start < current:
+    following = shift(period, start, 1)
+    within = sa.and_(table.c.rev_created >= _value(table, start),
+                     table.c.rev_created < _value(table, following))
+    if connection.execute(sa.select([sa.exists().where(within)])).scalar():
+      name = partition_name(table, start)
+      archived = table.tometadata(sa.MetaData(), name=name)
+      # index names may be global (SQLite, PostgreSQL)
+      for index in archived.indexes:
+        index.name = index.name.replace(table.name, name, 1)
+      archived.create(connection)
+      connection.execute(archived.insert().from_select(
+        [col.name for col in table.c], sa.select([table]).where(within)))
+    start = following
+  _carry_over(connection, table, end)
+
+
+def _carry_over(connection, table, end):
+  '''
+  Deletes the revisions of `table` created before `end`, except the latest
+  one of every live row, which becomes a full snapshot.
+  '''
+  primary_key = history.primary_key_columns(table)
+  later = table.alias('later')
+  past = table.c.rev_created < end
+  latest = sa.select([table.c.rev_id]).where(sa.and_(
+    past,
+    table.c.rev_isdelete == sa.false(),
+    ~sa.exists().where(sa.and_(
+      later.c.rev_created < end,
+      history.keyset_after(
+        history.timeline_columns(later),
+        history.timeline_columns(table)),
+      *[later.c[col.name] == col for col in primary_key]))))
+  states = []
+  if 'rev_changed' in table.c:
+    # resolve deltas before the revisions they build on are deleted
+    states = [
+      history.revision_state(connection, table, row.rev_id)
+      for row in connection.execute(
+        latest.where(table.c.rev_changed != sa.null())).fetchall()]
+  # a derived table, as MySQL cannot select from the table it deletes from
+  kept = latest.alias('kept')
+  connection.execute(table.delete().where(sa.and_(
+    past, ~table.c.rev_id.in_(sa.select([kept.c.rev_id])))))
+  for state in states:
+    state['rev_changed'] = None
+    connection.execute(
+      table.update().where(table.c.rev_id == state['rev_id']).values(state))
+
+
+def _value(table, moment):
+  return clock.from_micros(
+    table.info.get('rev_created', 'float'), clock.to_micros(moment))
+
+
+def _bound(table, moment):
+  value = _value(table, moment)
+  if isinstance(value, datetime.datetime):
+    return "'%s'" % value.isoformat(' ')
+  return repr(value)
+
+
+def _quote(connection, table, name):
+  preparer = connection.dialect.identifier_preparer
+  if table.schema:
+    return '%s.%s' % (preparer.quote_schema(table.schema),
+                      preparer.quote(name))
+  return preparer.quote(name)
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+'''
+Retention and compaction of revision history.
+
+A versioned class declares its retention policy as tiers of (minimum age,
+granularity), age being a `datetime.timedelta` or seconds:
+
+  class Reservation(Versioned, Base):
+    __audit_retention__ = (
+      # everything younger than 30 days is kept; then one revision per day
+      (datetime.timedelta(days=30), 'day'),
+      # after a year, only the latest revision of each row
+      (datetime.timedelta(days=365), None),
+    )
+
+`compact` then thins the history: within a tier, a revision is kept only if
+it is the last one of its row in its period ('day', 'month' or 'year'; None
+for the whole tier), so the row state at every period boundary survives.
+Delete revisions are always kept, and so is the latest revision of every
+row. Kept delta revisions (see ``__audit_delta__``) whose predecessor goes
+away are rewritten as full snapshots first.
+
+The table is read in keyset order in batches of `batch_size` rows and each
+batch is compacted in its own short transaction, so it can run online
+against large revision tables.
+'''
+import datetime
+
+import sqlalchemy as sa
+
+from . import clock, history, partition
+
+
+def check_policy(policy):
+  '''
+  Returns retention `policy` as a list of (age in seconds, granularity)
+  tiers, youngest first.
+  '''
+  tiers = []
+  for age, granularity in policy:
+    if isinstance(age, datetime.timedelta):
+      age = age.total_seconds()
+    if granularity is not None:
+      partition.check_period(granularity)
+    tiers.append((float(age), granularity))
+  if not tiers:
+    raise ValueError('empty retention policy')
+  return sorted(tiers, key=lambda tier: tier[0])
+
+
+def compact(engine, target, policy=None, now=None, batch_size=1000):
+  '''
+  Applies retention `policy` (by default the ``__audit_retention__`` of
+  versioned class `target`) to its revision table and returns counts of the
+  'scanned', 'deleted' and 'snapshotted' revisions. `now` (a naive UTC
+  datetime) defaults to the current time.
+  '''
+  if policy is None:
+    policy = getattr(target, '__audit_retention__', None)
+  if not policy:
+    raise ValueError('no retention policy for %r' % (target,))
+  table = getattr(target, 'Revision', target).__table__
+  compaction = _Compaction(
+    table, check_policy(policy), now or datetime.datetime.utcnow())
+  order = (history.primary_key_columns(table)
+           + history.timeline_columns(table) + [table.c.rev_id])
+  cutoff = clock.to_column(table, compaction.boundary)
+
+  last = None
+  while True:
+    with engine.begin() as connection:
+      query = sa.select([table]).where(table.c.rev_created < cutoff)
+      if last is not None:
+        query = query.where(history.keyset_after(order, last))
+      rows = connection.execute(
+        query.order_by(*order).limit(batch_size)).fetchall()
+      for row in rows:
+        compaction.feed(row)
+      if len(rows) < batch_size:
+        compaction.finish()
+      compaction.write(connection)
+    if len(rows) < batch_size:
+      return compaction.stats
+    last = [rows[-1][col.name] for col in order]
+
+
+class _Compaction(object):
+  '''
+  Streaming keep/delete decisions over revisions in (primary key, timeline)
+  order. Each revision is decided once its successor has been seen.
+  '''
+
+  def __init__(self, table, tiers, now):
+    self.table = table
+    self.tiers = tiers
+    self.now = now
+    self.boundary = now - datetime.timedelta(seconds=tiers[0][0])
+    self.primary_key = table.info['primary_key']
+    self.data = [col.name for col in table.c
+                 if not col.name.startswith('rev_')
+                 and col.name not in self.primary_key]
+    self.delta = 'rev_changed' in table.c
+    self.stats = {'scanned': 0, 'deleted': 0, 'snapshotted': 0}
+    self.pending = None
+    self.key = None
+    self.state = None
+    self.dropped = False
+    self.deletes = []
+    self.snapshots = []
+
+  def feed(self, row):
+    self.stats['scanned'] += 1
+    if self.pending is not None:
+      self.decide(self.pending, row)
+    self.pending = row
+
+  def finish(self):
+    if self.pending is not None:
+      self.decide(self.pending, None)
+      self.pending = None
+
+  def decide(self, row, successor):
+    key = tuple(row[name] for name in self.primary_key)
+    if key != self.key:
+      self.key, self.state, self.dropped = key, None, False
+    # replay the full row state, so kept deltas can be re-snapshotted
+    if self.delta and row.rev_changed is not None:
+      if self.state is not None:
+        for name in row.rev_changed.split(','):
+          self.state[name] = row[name]
+    else:
+      self.state = dict(row)
+
+    keep = (row.rev_isdelete or successor is None
+            or tuple(successor[name] for name in self.primary_key) != key
+            or self.bucket(row) != self.bucket(successor))
+    if not keep:
+      self.deletes.append(row.rev_id)
+      self.dropped = True
+      return
+    if self.dropped and self.delta and row.rev_changed is not None:
+      # None: state unknown (delta at the start of a scan), read it back
+      self.snapshots.append((row.rev_id, self.state and dict(self.state)))
+    self.dropped = False
+
+  def bucket(self, row):
+    created = clock.to_datetime(self.table, row.rev_created)
+    age = (self.now - created).total_seconds()
+    for idx in range(len(self.tiers) - 1, -1, -1):
+      if age >= self.tiers[idx][0]:
+        granularity = self.tiers[idx][1]
+        if granularity is None:
+          return idx, None
+        return idx, partition.period_start(granularity, created)
+    return None
+
+  def write(self, connection):
+    table = self.table
+    if self.snapshots:
+      params = []
+      for rev_id, state in self.snapshots:
+        if state is None:
+          state = history.revision_state(connection, table, rev_id)
+        params.append(dict(
+          [('_rev_id', rev_id)]
+          + [('_' + name, state[name]) for name in self.data]))
+      connection.execute(
+        table.update()
+        .where(table.c.rev_id == sa.bindparam('_rev_id'))
+        .values(dict(
+          [('rev_changed', None)]
+          + [(name, sa.bindparam('_' + name)) for name in self.data])),
+        params)
+      self.stats['snapshotted'] += len(params)
+      self.snapshots = []
+    if self.deletes:
+      connection.execute(
+        table.delete().where(table.c.rev_id.in_(self.deletes)))
+      self.stats['deleted'] += len(self.deletes)
+      self.deletes = []
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+'''
+Revision id generators and column types.
+
+A versioned class picks its generator and storage format with two class
+attributes::
+
+  class Reservation(Versioned, Base):
+    __rev_id_generator__ = staticmethod(uuid7)
+    __rev_id_format__ = 'binary'
+    ...
+
+Generators return a `uuid.UUID`; on the Python side `rev_id` is always its
+canonical 36-character string, whatever the storage format.
+'''
+import os
+import time
+import uuid
+
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql, postgresql
+
+
+FORMATS = ('text', 'binary', 'native')
+
+
+def uuid4():
+  '''
+  Random (version 4) UUID, the historical default.
+  '''
+  return uuid.uuid4()
+
+
+def uuid7():
+  '''
+  Time-ordered (version 7) UUID: a 48-bit millisecond timestamp followed by
+  12 bits of sub-millisecond time and 62 random bits. Consecutive ids sort
+  (nearly) in creation order, so they append to the right edge of a B-tree
+  index instead of splitting random pages.
+  '''
+  millis, fraction = divmod(_time_ns(), 1000000)
+  rand = uuid.UUID(bytes=os.urandom(16)).int & 0x3fffffffffffffff
+  value = (millis & 0xffffffffffff) << 80
+  value |= 0x7 << 76
+  value |= (fraction * 4096 // 1000000) << 64
+  value |= 0x2 << 62
+  value |= rand
+  return uuid.UUID(int=value)
+
+
+def _time_ns():
+  if hasattr(time, 'time_ns'):
+    return time.time_ns()
+  return int(time.time() * 1e9)
+
+
+class RevId(sa.types.TypeDecorator):
+  '''
+  Stores a canonical UUID string as 16 raw bytes, or as the backend's native
+  UUID type when `native` is set and the dialect has one (PostgreSQL).
+  '''
+  impl = sa.LargeBinary
+
+  def __init__(self, native=False):
+    super(RevId, self).__init__()
+    self.native = native
+
+  def load_dialect_impl(self, dialect):
+    if self.native and dialect.name == 'postgresql':
+      return dialect.type_descriptor(postgresql.UUID())
+    if dialect.name == 'mysql':
+      return dialect.type_descriptor(mysql.BINARY(16))
+    return dialect.type_descriptor(sa.LargeBinary(16))
+
+  def process_bind_param(self, value, dialect):
+    if value is None or (self.native and dialect.name == 'postgresql'):
+      return value
+    return uuid.UUID(str(value)).bytes
+
+  def process_result_value(self, value, dialect):
+    if value is None:
+      return value
+    if self.native and dialect.name == 'postgresql':
+      return str(value)
+    return str(uuid.UUID(bytes=bytes(value)))
+
+  def __repr__(self):
+    return 'RevId(native=%r)' % (self.native,)
+
+
+def rev_id_type(format):
+  '''
+  Returns the column type for the rev_id storage `format`.
+  '''
+  if format == 'text':
+    return sa.String(36)
+  if format in ('binary', 'native'):
+    return RevId(native=format == 'native')
+  raise ValueError('unknown rev_id format %r, expected one of %r'
+                   % (format, FORMATS))
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import sqlalchemy as sa
+
+from . import DbTestCase
+from ..context import audit_context, transaction_table
+from ..versioned import Versioned
+
+
+class TestContext(DbTestCase):
+
+  def make_note(self):
+    class Note(Versioned, self.Base):
+      __tablename__ = 'notes'
+      __audit_context__ = True
+      # explicit ids: the revision is taken before autoincrement runs
+      id = sa.Column(sa.Integer, primary_key=True, autoincrement=False)
+      text = sa.Column(sa.String)
+    self.create_tables()
+    return Note
+
+
+  def test_context(self):
+    Note = self.make_note()
+    audit_context(self.session, user='alice', request_id='r-1',
+                  reason='import', ticket=12)
+    self.session.add_all([Note(id=1, text='a'), Note(id=2, text='b')])
+    self.session.flush()
+    self.session.add(Note(id=3, text='c'))
+    self.session.commit()
+
+    # one context row for the whole transaction
+    contexts = self.session.execute(
+      sa.select([transaction_table(self.Base.metadata)])).fetchall()
+    self.assertEqual(
+      [(row.user, row.request_id, row.reason, row.data) for row in contexts],
+      [('alice', 'r-1', 'import', {'ticket': 12})])
+    self.assertEqual(
+      set(rev.rev_txn_id for rev in self.session.query(Note.Revision)),
+      set([contexts[0].id]))
+
+    # the context ends with its transaction
+    note = self.session.query(Note).filter_by(text='a').one()
+    note.text = 'A'
+    self.session.commit()
+    self.assertEqual(
+      [rev.rev_txn_id for rev in self.session.query(Note.Revision)
+       .filter_by(text='A')],
+      [None])
+
+
+  def test_in_context(self):
+    Note = self.make_note()
+    audit_context(self.session, user='alice', request_id='r-1')
+    note = Note(id=1, text='a')
+    self.session.add(note)
+    self.session.commit()
+    audit_context(self.session, user='bob', request_id='r-2')
+    note.text = 'b'
+    self.session.add(Note(id=3, text='c'))
+    self.session.commit()
+    audit_context(self.session, user='bob', request_id='r-3')
+    self.session.delete(note)
+    self.session.commit()
+
+    def changes(**criteria):
+      return [(rev.id, rev.text, rev.rev_isdelete)
+              for rev in Note.Revision.in_context(self.session, **criteria)]
+
+    self.assertEqual(changes(user='alice'), [(1, 'a', False)])
+    self.assertEqual(
+      sorted(changes(user='bob'), key=lambda change: (change[2], change[0])),
+      [(1, 'b', False), (3, 'c', False), (1, None, True)])
+    self.assertEqual(changes(user='bob', request_id='r-3'), [(1, None, True)])
+    self.assertEqual(changes(user='carol'), [])
+
+
+
+  def test_savepoints(self):
+    Note = self.make_note()
+    table = transaction_table(self.Base.metadata)
+    audit_context(self.session, user='alice')
+    savepoint = self.session.begin_nested()
+    self.session.add(Note(id=1, text='a'))
+    self.session.flush()
+    # the context row goes away with the savepoint
+    savepoint.rollback()
+    savepoint = self.session.begin_nested()
+    self.session.add(Note(id=2, text='b'))
+    savepoint.commit()
+    self.session.add(Note(id=3, text='c'))
+    self.session.commit()
+
+    contexts = self.session.execute(sa.select([table])).fetchall()
+    self.assertEqual([row.user for row in contexts], ['alice'])
+    self.assertEqual(
+      [(rev.id, rev.rev_txn_id) for rev in
+       self.session.query(Note.Revision).order_by(Note.Revision.id)],
+      [(2, contexts[0].id), (3, contexts[0].id)])
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+import time
+import warnings
+
+import sqlalchemy as sa
+
+from . import DbTestCase
+from ..core import UnauditedStatementWarning, audit_statements
+from ..versioned import Versioned
+
+
+class TestAuditStatements(DbTestCase):
+
+  def setUp(self):
+    super(TestAuditStatements, self).setUp()
+    # statement hooks are per engine; keep them off the shared one
+    self.engine = sa.create_engine('sqlite://')
+    self.addCleanup(self.engine.dispose)
+    audit_statements(self.engine)
+    self.session.close()
+    self.session = sa.orm.Session(self.engine)
+
+
+  def create_tables(self):
+    self.Base.metadata.create_all(self.engine)
+
+
+  def revisions(self, Reservation):
+    table = Reservation.Revision.__table__
+    return [(row.id, row.name, row.party, row.rev_isdelete)
+            for row in self.session.execute(
+              sa.select([table]).order_by(table.c.id, table.c.rev_created))]
+
+
+  def assertCurrent(self, Reservation):
+    # every live row points at its latest revision, which matches it
+    for obj in self.session.query(Reservation):
+      rev = self.session.query(Reservation.Revision).get(obj.rev_id)
+      self.assertEqual((rev.id, rev.name, rev.party),
+                       (obj.id, obj.name, obj.party))
+
+
+  def test_bulk_mappings(self):
+    Reservation = self.make_reservation()
+    self.session.bulk_insert_mappings(Reservation, [
+      dict(id='a', created=1, name='Me', party=2),
+      dict(id='b', created=1, name='You', party=4)])
+    self.session.bulk_update_mappings(Reservation, [
+      dict(id='a', party=3), dict(id='b', party=5)])
+    self.session.commit()
+
+    self.assertEqual(
+      self.revisions(Reservation),
+      [('a', 'Me', 2, False), ('a', 'Me', 3, False),
+       ('b', 'You', 4, False), ('b', 'You', 5, False)])
+    self.assertCurrent(Reservation)
+
+
+
+  def test_query_update_delete(self):
+    Reservation = self.make_reservation()
+    self.session.add_all([Reservation(id='a', name='Me', party=2),
+                          Reservation(id='b', name='You', party=4)])
+    self.session.commit()
+    self.session.query(Reservation).filter_by(name='Me').update(
+      {'party': Reservation.party + 1}, synchronize_session=False)
+    self.session.query(Reservation).filter_by(id='b').delete(
+      synchronize_session=False)
+    self.session.commit()
+
+    self.assertEqual(
+      self.revisions(Reservation),
+      [('a', 'Me', 2, False), ('a', 'Me', 3, False),
+       ('b', 'You', 4, False), ('b', None, None, True)])
+    self.assertCurrent(Reservation)
+    # ORM flushes are still recorded once, by the mapper handlers
+    me = self.session.query(Reservation).get('a')
+    me.party = 4
+    self.session.commit()
+    self.assertEqual(len(self.revisions(Reservation)), 5)
+    self.assertCurrent(Reservation)
+
+
+
+  def test_core_statements(self):
+    Reservation = self.make_reservation()
+    table = Reservation.__table__
+    with self.engine.begin() as conn:
+      conn.execute(table.insert(), id='a', created=1, name='Me', party=2)
+      conn.execute(
+        table.update().where(table.c.id == sa.bindparam('b_id')),
+        b_id='a', name='Us')
+      conn.execute(table.update().values(party=6).where(table.c.id == 'a'))
+      conn.execute(table.delete().where(table.c.id == 'a'))
+      conn.execute(table.insert().values([
+        dict(id='b', created=1, name='You'),
+        dict(id='c', created=1, name='Them')]))
+      with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        conn.execute(table.insert().from_select(
+          ['id', 'created', 'rev_id'],
+          sa.select([sa.literal('d'), table.c.created, sa.literal('x')])
+          .where(table.c.id == 'b')))
+    self.assertEqual(
+      [warning.category for warning in caught], [UnauditedStatementWarning])
+
+    self.assertEqual(
+      self.revisions(Reservation),
+      [('a', 'Me', 2, False), ('a', 'Us', 2, False), ('a', 'Us', 6, False),
+       ('a', None, None, True), ('b', 'You', None, False),
+       ('c', 'Them', None, False)])
+    self.assertEqual(
+      len(set(row.rev_id for row in self.engine.execute(
+        sa.select([Reservation.Revision.__table__])))),
+      6)
+    self.assertEqual(
+      self.session.query(Reservation.Revision.id)
+      .join(Reservation, Reservation.rev_id == Reservation.Revision.rev_id)
+      .order_by(Reservation.id).all(),
+      [('b',), ('c',)])
+
+
+
+  def test_primary_key_update(self):
+    Reservation = self.make_reservation()
+    table = Reservation.__table__
+    with self.engine.begin() as conn:
+      conn.execute(table.insert(), id='a', created=1, name='Me', party=2)
+      conn.execute(table.update().values(id='z').where(table.c.id == 'a'))
+    self.assertEqual(
+      self.revisions(Reservation),
+      [('a', 'Me', 2, False), ('z', 'Me', 2, False)])
+    self.assertIsNotNone(self.session.query(Reservation).get('z').rev_id)
+    self.assertCurrent(Reservation)
+
+
+
+  def test_excluded_columns(self):
+    class Document(Versioned, self.Base):
+      __tablename__ = 'documents'
+      __audit_exclude__ = ('views',)
+      id = sa.Column(sa.String, primary_key=True)
+      title = sa.Column(sa.String)
+      views = sa.Column(sa.Integer)
+    self.create_tables()
+    table = Document.__table__
+    with self.engine.begin() as conn:
+      conn.execute(table.insert(), [
+        dict(id='x', title='Hi', views=0), dict(id='y', title='Yo', views=0)])
+      rev_ids = sorted(row.rev_id for row in conn.execute(table.select()))
+      update = table.update().where(table.c.id == sa.bindparam('b_id'))
+      # only excluded columns: no revision, single or executemany
+      conn.execute(update, b_id='x', views=1)
+      conn.execute(update, [dict(b_id='x', views=2), dict(b_id='y', views=1)])
+      self.assertEqual(
+        sorted(row.rev_id for row in conn.execute(table.select())), rev_ids)
+      conn.execute(update, [dict(b_id='x', title='Hello'),
+                            dict(b_id='y', title='Yes')])
+    self.assertEqual(
+      sorted(rev.title for rev in self.session.query(Document.Revision)),
+      ['Hello', 'Hi', 'Yes', 'Yo'])
+
+
+
+  def test_orm_and_core_clock(self):
+    class Reservation(Versioned, self.Base):
+      __tablename__ = 'reservations'
+      __rev_created_type__ = 'integer'
+      id = sa.Column(sa.String, primary_key=True)
+      party = sa.Column(sa.Integer)
+    self.create_tables()
+    me = Reservation(id='a', party=1)
+    self.session.add(me)
+    self.session.flush()
+    self.session.query(Reservation).update(
+      {'party': 2}, synchronize_session=False)
+    me.party = 3
+    self.session.commit()
+
+    # one timeline per transaction: the ORM update comes last
+    table = Reservation.Revision.__table__
+    self.assertEqual(
+      [(row.rev_seq, row.party) for row in self.session.execute(
+        sa.select([table]).order_by(table.c.rev_created, table.c.rev_seq))],
+      [(1, 1), (2, 2), (3, 3)])
+    self.assertEqual(
+      [(rev.rev_id, rev.party)
+       for rev in Reservation.as_of(self.session, time.time())],
+      [(me.rev_id, 3)])
+
+
+
+  def test_failed_flush_in_savepoint(self):
+    Reservation = self.make_reservation()
+    self.session.add(Reservation(id='a', name='Me', party=2))
+    self.session.commit()
+    self.session.begin_nested()
+    self.session.add(Reservation(created=None, name='Broken'))
+    self.assertRaises(sa.exc.DBAPIError, self.session.flush)
+    self.session.rollback()
+    # later statements of the transaction are audited again
+    self.session.query(Reservation).update(
+      {'party': 9}, synchronize_session=False)
+    self.session.commit()
+
+    self.assertEqual(
+      self.revisions(Reservation),
+      [('a', 'Me', 2, False), ('a', 'Me', 9, False)])
+    self.assertCurrent(Reservation)
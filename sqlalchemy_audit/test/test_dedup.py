@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import warnings
+
+import sqlalchemy as sa
+
+from . import DbTestCase
+from .. import dedup
+from ..core import UnauditedStatementWarning, audit_statements
+from ..dedup import content_hash
+from ..versioned import Versioned
+
+
+class TestDedup(DbTestCase):
+
+  def make_document(self, **attrs):
+    attrs.update(
+      __tablename__='documents',
+      __audit_dedup__=('body',),
+      id=sa.Column(sa.String, primary_key=True),
+      title=sa.Column(sa.String),
+      body=sa.orm.deferred(sa.Column(sa.Text)))
+    Document = type('Document', (Versioned, self.Base), attrs)
+    self.create_tables()
+    return Document
+
+
+  def contents(self, Document):
+    side = Document.Revision.__table__.info['dedup']['body']
+    return sorted(row.value for row in self.session.execute(
+      sa.select([side])))
+
+
+  def write_history(self, Document):
+    doc = Document(id='x', title='Draft', body='Lorem ipsum')
+    self.session.add_all([doc, Document(id='y', title='Copy',
+                                        body='Lorem ipsum')])
+    self.session.commit()
+    self.session.expunge_all()
+
+    statements = []
+    def record(conn, cursor, statement, *args):
+      if 'documents.body' in statement:
+        statements.append(statement)
+    sa.event.listen(self.session.bind, 'before_cursor_execute', record)
+    self.addCleanup(sa.event.remove, self.session.bind,
+                    'before_cursor_execute', record)
+    doc = self.session.query(Document).get('x')
+    doc.title = 'Final'
+    self.session.commit()
+    # the unchanged body was neither loaded nor copied again
+    self.assertEqual(statements, [])
+    doc.body = 'Dolor sit amet'
+    self.session.commit()
+    self.session.delete(doc)
+    self.session.commit()
+
+    self.assertEqual(self.contents(Document),
+                     ['Dolor sit amet', 'Lorem ipsum'])
+    return (self.session.query(Document.Revision)
+            .filter_by(id='x').order_by('rev_created').all())
+
+
+
+  def test_dedup(self):
+    revs = self.write_history(self.make_document())
+    self.assertEqual(
+      [(rev.title, rev.body_hash) for rev in revs],
+      [('Draft', content_hash('Lorem ipsum')),
+       ('Final', content_hash('Lorem ipsum')),
+       ('Final', content_hash('Dolor sit amet')),
+       (None, None)])
+    self.assertEqual([rev.body for rev in revs],
+                     ['Lorem ipsum', 'Lorem ipsum', 'Dolor sit amet', None])
+
+
+
+  def test_dedup_delta(self):
+    Document = self.make_document(__audit_delta__=10 ** 9)
+    revs = self.write_history(Document)
+    self.assertEqual([rev.rev_changed for rev in revs],
+                     [None, 'title', 'body', None])
+    self.assertEqual(
+      [Document.revision_state(self.session, rev.rev_id)['body']
+       for rev in revs],
+      [content_hash('Lorem ipsum'), content_hash('Lorem ipsum'),
+       content_hash('Dolor sit amet'), None])
+
+
+
+  def test_stored_concurrently(self):
+    Document = self.make_document()
+    side = Document.Revision.__table__.info['dedup']['body']
+    tmp = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, tmp)
+    engine = sa.create_engine('sqlite:///' + os.path.join(tmp, 'audit.db'))
+    self.addCleanup(engine.dispose)
+    self.Base.metadata.create_all(engine)
+    session = sa.orm.Session(engine)
+    self.addCleanup(session.close)
+    connection = session.connection()
+    connection.execute(sa.select([side.c.hash]))
+    # another transaction stores a digest after this one looked it up
+    with engine.connect() as other:
+      other.execute(side.insert(), hash=content_hash('Lorem ipsum'),
+                    value='Lorem ipsum')
+    dedup._insert_missing(connection, side, [
+      {'hash': content_hash('Lorem ipsum'), 'value': 'Lorem ipsum'},
+      {'hash': content_hash('Dolor sit amet'), 'value': 'Dolor sit amet'}])
+    session.commit()
+    self.assertEqual(
+      sorted(row.value for row in engine.execute(sa.select([side]))),
+      ['Dolor sit amet', 'Lorem ipsum'])
+
+
+
+  def test_after_statement(self):
+    Document = self.make_document()
+    # statement hooks are per engine; keep them off the shared one
+    engine = sa.create_engine('sqlite://')
+    self.addCleanup(engine.dispose)
+    audit_statements(engine)
+    self.Base.metadata.create_all(engine)
+    self.session.close()
+    self.session = sa.orm.Session(engine)
+    self.session.add(Document(id='x', title='Draft', body='Lorem ipsum'))
+    self.session.commit()
+    with warnings.catch_warnings():
+      warnings.simplefilter('ignore', UnauditedStatementWarning)
+      self.session.query(Document).update(
+        {'title': 'Edit'}, synchronize_session=False)
+    self.session.commit()
+    doc = self.session.query(Document).get('x')
+    doc.title = 'Final'
+    self.session.commit()
+
+    # the statement's NULL digest is not carried over as the value
+    self.assertEqual(
+      [(rev.title, rev.body_hash) for rev in self.session.query(
+        Document.Revision).order_by('rev_created')],
+      [('Draft', content_hash('Lorem ipsum')), ('Edit', None),
+       ('Final', content_hash('Lorem ipsum'))])
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+import csv
+import datetime
+import io
+import os
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import sqlalchemy as sa
+
+from . import DbTestCase
+from .. import export
+from ..versioned import Versioned
+
+try:
+  import pyarrow
+  import pyarrow.parquet
+except ImportError:
+  pyarrow = None
+
+
+class TestExport(DbTestCase):
+
+  def make_history(self):
+    Reservation = self.make_reservation()
+    me = Reservation(name='Me', date=datetime.date(2026, 4, 1),
+                     time=datetime.time(19, 30), party=2)
+    you = Reservation(name='You', party=4)
+    self.session.add_all([me, you])
+    self.session.commit()
+    me.party = 3
+    self.session.delete(you)
+    self.session.commit()
+    return Reservation
+
+
+  def test_csv(self):
+    Reservation = self.make_history()
+    out = io.StringIO()
+    self.assertEqual(
+      Reservation.export(self.session, out, format='csv', chunk_size=2), 4)
+    rows = list(csv.DictReader(io.StringIO(out.getvalue())))
+    self.assertEqual(
+      sorted((row['name'], row['party'], row['rev_isdelete']) for row in rows),
+      [('', '', 'True'), ('Me', '2', 'False'), ('Me', '3', 'False'),
+       ('You', '4', 'False')])
+    self.assertEqual(
+      set((row['date'], row['time']) for row in rows if row['name'] == 'Me'),
+      set([('2026-04-01', '19:30:00')]))
+    self.assertEqual(
+      list(rows[0].keys()),
+      [col.name for col in Reservation.Revision.__table__.c])
+
+
+  def test_csv_json(self):
+    class Setting(Versioned, self.Base):
+      __tablename__ = 'settings'
+      id = sa.Column(sa.String, primary_key=True)
+      value = sa.Column(sa.JSON)
+    self.create_tables()
+    self.session.add(Setting(id='x', value={'on': True, 'tags': ['a']}))
+    self.session.commit()
+    out = io.StringIO()
+    Setting.export(self.session, out, format='csv')
+    row = next(csv.DictReader(io.StringIO(out.getvalue())))
+    self.assertEqual(json.loads(row['value']), {'on': True, 'tags': ['a']})
+
+
+
+  def test_lazy_pyarrow(self):
+    # importing the package must not pay for pyarrow
+    code = ('import sys, sqlalchemy_audit.versioned; '
+            'print("pyarrow" in sys.modules)')
+    output = subprocess.check_output(
+      [sys.executable, '-c', code],
+      cwd=os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__)))))
+    self.assertEqual(output.strip(), b'False')
+
+
+
+  def test_parquet_without_pyarrow(self):
+    Reservation = self.make_history()
+    tmp = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, tmp)
+    path = os.path.join(tmp, 'reservations.parquet')
+    def missing():
+      raise ImportError('Arrow and Parquet export require pyarrow')
+    with mock.patch.object(export, 'has_pyarrow', lambda: False), \
+         mock.patch.object(export, '_pyarrow', missing):
+      self.assertRaises(ImportError, Reservation.export, self.session, path)
+    self.assertFalse(os.path.exists(path))
+
+
+
+  @unittest.skipIf(pyarrow is None, 'requires pyarrow')
+  def test_arrow(self):
+    Reservation = self.make_history()
+    batches = list(Reservation.export(
+      self.session, format='arrow', isdelete=False, chunk_size=2))
+    self.assertEqual([batch.num_rows for batch in batches], [2, 1])
+    table = pyarrow.Table.from_batches(batches)
+    self.assertEqual(table.schema.field('party').type, pyarrow.int64())
+    self.assertEqual(table.schema.field('date').type, pyarrow.date32())
+    self.assertEqual(table.schema.field('rev_id').type, pyarrow.string())
+    self.assertEqual(
+      sorted(zip(table.column('name').to_pylist(),
+                 table.column('party').to_pylist())),
+      [('Me', 2), ('Me', 3), ('You', 4)])
+
+
+  @unittest.skipIf(pyarrow is None, 'requires pyarrow')
+  def test_parquet(self):
+    Reservation = self.make_history()
+    tmpdir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, tmpdir)
+    path = os.path.join(tmpdir, 'reservations.parquet')
+    self.assertEqual(Reservation.export(self.session, path, chunk_size=3), 4)
+    parquet = pyarrow.parquet.ParquetFile(path)
+    self.assertEqual(parquet.num_row_groups, 2)
+    self.assertEqual(
+      parquet.read().column('rev_isdelete').to_pylist().count(True), 1)
+    self.assertRaises(
+      ValueError, export.export, self.session,
+      Reservation.Revision.__table__, path, 'xml')
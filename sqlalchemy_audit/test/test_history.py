@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+import time
+
+import sqlalchemy as sa
+
+from . import DbTestCase
+from ..versioned import Versioned
+
+
+class TestHistory(DbTestCase):
+
+  def test_as_of(self):
+    Reservation = self.make_reservation()
+    me = Reservation(name='Me', party=2)
+    you = Reservation(name='You', party=4)
+    self.session.add_all([me, you])
+    self.session.commit()
+    t1 = time.time()
+    me.party = 3
+    self.session.delete(you)
+    self.session.commit()
+    t2 = time.time()
+    them = Reservation(name='Them', party=6)
+    self.session.add(them)
+    self.session.commit()
+    t3 = time.time()
+
+    def as_of(timestamp, ident=None):
+      return sorted(
+        (rev.name, rev.party)
+        for rev in Reservation.as_of(self.session, timestamp, ident))
+
+    self.assertEqual(as_of(0), [])
+    self.assertEqual(as_of(t1), [('Me', 2), ('You', 4)])
+    self.assertEqual(as_of(t2), [('Me', 3)])
+    self.assertEqual(as_of(t3), [('Me', 3), ('Them', 6)])
+    self.assertEqual(as_of(t1, me.id), [('Me', 2)])
+    self.assertEqual(as_of(t1, (you.id,)), [('You', 4)])
+    self.assertEqual(as_of(t2, you.id), [])
+    self.assertRaises(ValueError, as_of, t1, (me.id, you.id))
+
+
+  def test_as_of_composite_key(self):
+    User, UserRev, Keyword, KeywordRev, UserKeyword, UserKeywordRev = self.make_user_keyword()
+    steve = User(name='steve')
+    boo = Keyword(word='boo')
+    hoo = Keyword(word='hoo')
+    steve.keywords.append(boo)
+    steve.keywords.append(hoo)
+    self.session.add(steve)
+    self.session.commit()
+    t1 = time.time()
+    steve.keywords.remove(boo)
+    self.session.commit()
+
+    self.assertEqual(
+      sorted(rev.keyword_id for rev in UserKeyword.as_of(self.session, t1)),
+      sorted([boo.id, hoo.id]))
+    self.assertEqual(
+      [rev.keyword_id for rev in UserKeyword.as_of(self.session, time.time())],
+      [hoo.id])
+    self.assertEqual(
+      UserKeyword.as_of(self.session, t1, (steve.id, boo.id)).count(), 1)
+
+
+  def test_as_of_index(self):
+    Reservation = self.make_reservation()
+    table = Reservation.Revision.__table__
+    self.assertEqual(
+      [[col.name for col in index.columns] for index in table.indexes
+       if index.name == 'ix_reservations_rev_as_of'],
+      [['id', 'rev_created']])
+
+    query = Reservation.as_of(self.session, time.time(), 'x')
+    plan = ' '.join(
+      str(row[-1]) for row in self.session.execute(
+        'EXPLAIN QUERY PLAN ' + str(query.statement.compile(
+          compile_kwargs={'literal_binds': True}))))
+    self.assertIn('ix_reservations_rev_as_of', plan)
+    self.assertNotIn('SCAN reservations_rev', plan.replace('USING', ''))
+
+
+
+  def test_iter_history(self):
+    Reservation = self.make_reservation()
+    me = Reservation(id='a', name='Me', party=2)
+    you = Reservation(id='b', name='You', party=4)
+    self.session.add_all([me, you])
+    self.session.commit()
+    t1 = time.time()
+    me.party = 3
+    you.party = 5
+    self.session.commit()
+    self.session.delete(you)
+    self.session.commit()
+    rev_ids = [rev.rev_id for rev in self.session.query(Reservation.Revision)
+               .order_by('id', 'rev_created')]
+
+    def history(**kw):
+      return [(row.id, row.party, row.rev_isdelete)
+              for row in Reservation.Revision.iter_history(
+                self.session, batch_size=2, **kw)]
+
+    self.assertEqual(
+      history(),
+      [('a', 2, False), ('a', 3, False),
+       ('b', 4, False), ('b', 5, False), ('b', None, True)])
+    self.assertEqual(
+      [row.rev_id for row in Reservation.Revision.iter_history(
+        self.session.bind, batch_size=1)],
+      rev_ids)
+    self.assertEqual(history(ident='b', isdelete=False),
+                     [('b', 4, False), ('b', 5, False)])
+    self.assertEqual(history(until=t1), [('a', 2, False), ('b', 4, False)])
+    self.assertEqual(history(since=t1, isdelete=True), [('b', None, True)])
+    self.assertEqual(history(ident='c'), [])
+
+
+
+  def test_records(self):
+    Reservation = self.make_reservation()
+    me = Reservation(name='Me', party=2)
+    self.session.add(me)
+    self.session.commit()
+    me.party = 3
+    self.session.commit()
+
+    records = list(Reservation.Revision.iter_history(self.session))
+    self.assertEqual([(rec.name, rec.party) for rec in records],
+                     [('Me', 2), ('Me', 3)])
+    self.assertEqual(
+      records[0]._fields,
+      tuple(col.name for col in Reservation.Revision.__table__.c))
+    self.assertRaises(AttributeError, setattr, records[0], 'party', 4)
+    self.assertFalse(hasattr(records[0], '__dict__'))
+    self.assertEqual(
+      list(Reservation.Revision.as_of_records(self.session, time.time())),
+      [records[1]])
+    self.assertEqual(
+      list(Reservation.Revision.as_of_records(
+        self.session.bind, time.time(), 'x')),
+      [])
+
+
+
+  def test_transaction_clock(self):
+    for kind, type_ in (('integer', sa.BigInteger),
+                        ('timestamp', sa.DateTime)):
+      Base = sa.ext.declarative.declarative_base()
+      class A(Versioned, Base):
+        __tablename__ = 'a'
+        __rev_created_type__ = kind
+        __audit_delta__ = 2 ** 128
+        id = sa.Column(sa.Integer, primary_key=True)
+        name = sa.Column(sa.String)
+        party = sa.Column(sa.Integer)
+      A.broadcast_crud()
+      Base.metadata.create_all(self.session.bind)
+      table = A.Revision.__table__
+      self.assertIsInstance(table.c.rev_created.type, type_)
+
+      a = A(id=1, name='Me', party=2)
+      b = A(id=2, name='You', party=4)
+      self.session.add_all([a, b])
+      self.session.flush()
+      a.party = 3
+      self.session.flush()
+      a.name = 'Us'
+      self.session.commit()
+      t1 = time.time()
+      b.party = 5
+      self.session.commit()
+
+      revs = [(row.id, row.rev_seq, row.party)
+              for row in A.Revision.iter_history(self.session)]
+      self.assertEqual(
+        revs, [(1, 1, 2), (1, 3, 3), (1, 4, None), (2, 2, 4), (2, 1, 5)])
+      created = [row.rev_created
+                 for row in A.Revision.iter_history(self.session)]
+      self.assertEqual(len(set(created[:4])), 1)
+      self.assertTrue(created[4] > created[0])
+      # ties within a transaction are broken by rev_seq
+      self.assertEqual(
+        sorted((rev.id, rev.rev_seq)
+               for rev in A.as_of(self.session, t1)),
+        [(1, 4), (2, 2)])
+      self.assertEqual(
+        A.revision_state(self.session, a.rev_id),
+        dict(A.revision_state(self.session, a.rev_id),
+             id=1, name='Us', party=3))
+      self.assertEqual(
+        len(list(A.Revision.iter_history(self.session, since=t1))), 1)
+      self.session.close()
+      Base.metadata.drop_all(self.session.bind)
+      sa.orm.clear_mappers()
+
+
+
+  def test_diff(self):
+    for delta in (0, 10 ** 9):
+      Base = sa.ext.declarative.declarative_base()
+      class A(Versioned, Base):
+        __tablename__ = 'a'
+        __audit_delta__ = delta
+        id = sa.Column(sa.Integer, primary_key=True)
+        name = sa.Column(sa.String)
+        party = sa.Column(sa.Integer)
+      Base.metadata.create_all(self.session.bind)
+
+      a = A(id=1, name='Me', party=2)
+      b = A(id=2, name='You', party=4)
+      self.session.add_all([a, b])
+      self.session.commit()
+      t1 = time.time()
+      a.party = 3
+      self.session.commit()
+      a.name = 'Us'
+      self.session.delete(b)
+      self.session.commit()
+      t2 = time.time()
+
+      def diffs(**kw):
+        return [(change.key, change.rev_isdelete, dict(change.changes))
+                for change in A.Revision.diff(self.session, **kw)]
+
+      expected = [
+        ((1,), False, {'name': (None, 'Me'), 'party': (None, 2)}),
+        ((1,), False, {'party': (2, 3)}),
+        ((1,), False, {'name': ('Me', 'Us')}),
+        ((2,), False, {'name': (None, 'You'), 'party': (None, 4)}),
+        ((2,), True, {'name': ('You', None), 'party': (4, None)}),
+      ]
+      self.assertEqual(diffs(windowed=False, chunk_size=2), expected)
+      if not delta:
+        self.assertEqual(diffs(windowed=True, chunk_size=2), expected)
+      self.assertEqual(diffs(since=t1),
+                       [expected[1], expected[2], expected[4]])
+      self.assertEqual(diffs(idents=[2]), expected[3:])
+
+      self.assertEqual(
+        [(change.key, change.rev_isdelete, dict(change.changes))
+         for change in A.Revision.diff_as_of(self.session, t1, t2)],
+        [((1,), False, {'name': ('Me', 'Us'), 'party': (2, 3)}),
+         ((2,), True, {'name': ('You', None), 'party': (4, None)})])
+      self.assertEqual(
+        len(list(A.Revision.diff_as_of(self.session, 0, t1, ident=1))), 1)
+      self.session.close()
+      Base.metadata.drop_all(self.session.bind)
+      sa.orm.clear_mappers()
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from . import DbTestCase
+from ..metrics import Counters
+from ..versioned import Versioned
+
+
+class TestMetrics(DbTestCase):
+
+  def test_counters(self):
+    metrics = Counters()
+    Versioned.versioned_session(self.session, metrics=metrics)
+    self.addCleanup(Versioned.versioned_session, metrics=None)
+    Reservation = self.make_reservation()
+    me = Reservation(name='Me', party=2)
+    self.session.add_all([me, Reservation(name='You', party=4)])
+    self.session.commit()
+    me.party = 3
+    self.session.commit()
+    # dirty, but unchanged
+    me.party = me.party
+    self.session.flush()
+    self.session.delete(me)
+    self.session.commit()
+
+    self.assertEqual(
+      dict(metrics.counts),
+      {(Reservation, 'insert'): 2, (Reservation, 'update'): 1,
+       (Reservation, 'skipped'): 1, (Reservation, 'delete'): 1})
+    self.assertEqual(
+      sum(metrics.histogram[(Reservation, 'insert')]), 2)
+    self.assertGreater(metrics.seconds[(Reservation, 'update')], 0)
+    self.assertEqual(metrics.rows, {'reservations_rev': 4})
+    # at least the 36 characters of each rev_id and id
+    self.assertGreater(metrics.bytes['reservations_rev'], 4 * 72)
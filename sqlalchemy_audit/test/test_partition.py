@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+import calendar
+import datetime
+import time
+
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateTable
+
+from . import DbTestCase
+from ..partition import maintain_partitions, period_start, shift
+from ..versioned import Versioned
+
+
+class TestPartition(DbTestCase):
+
+  def make_reservation(self):
+    Versioned.__audit_partition__ = 'month'
+    self.addCleanup(setattr, Versioned, '__audit_partition__', None)
+    return super(TestPartition, self).make_reservation()
+
+
+  def test_periods(self):
+    moment = datetime.datetime(2024, 12, 31, 23, 59)
+    self.assertEqual(
+      period_start('month', moment), datetime.datetime(2024, 12, 1))
+    self.assertEqual(
+      shift('month', datetime.datetime(2024, 12, 1), 1),
+      datetime.datetime(2025, 1, 1))
+    self.assertEqual(
+      shift('month', datetime.datetime(2025, 1, 1), -13),
+      datetime.datetime(2023, 12, 1))
+    self.assertEqual(
+      shift('day', period_start('day', moment), 1),
+      datetime.datetime(2025, 1, 1))
+
+
+
+  def test_postgresql_table(self):
+    Reservation = self.make_reservation()
+    ddl = str(CreateTable(Reservation.Revision.__table__).compile(
+      dialect=postgresql.dialect()))
+    self.assertIn('PARTITION BY RANGE (rev_created)', ddl)
+    self.assertIn('PRIMARY KEY (rev_id, rev_created)', ddl)
+
+
+
+  def test_table_per_period(self):
+    Reservation = self.make_reservation()
+    me = Reservation(name='Me', party=2)
+    you = Reservation(name='You', party=4)
+    self.session.add_all([me, you])
+    self.session.commit()
+    me.party = 3
+    self.session.commit()
+    self.session.delete(you)
+    self.session.commit()
+
+    now = datetime.datetime.utcnow()
+    archive = 'reservations_rev_p' + now.strftime('%Y%m')
+    later = shift('month', period_start('month', now), 2)
+    conn = self.session.connection()
+    self.assertEqual(maintain_partitions(conn, Reservation, now=now), [])
+    self.assertEqual(len(self.session.query(Reservation.Revision).all()), 4)
+
+    # the period is archived, keeping the latest revision of live rows
+    self.assertEqual(
+      maintain_partitions(conn, Reservation, keep=3, now=later), [])
+    self.assertEqual(
+      conn.execute('SELECT COUNT(*) FROM %s' % archive).scalar(), 4)
+    self.assertEqual(
+      [(rev.rev_id, rev.party)
+       for rev in Reservation.as_of(self.session, time.time())],
+      [(me.rev_id, 3)])
+    self.assertEqual(maintain_partitions(conn, Reservation, now=later), [])
+    me.party = 4
+    self.session.commit()
+    self.assertEqual(len(self.session.query(Reservation.Revision).all()), 2)
+
+    conn = self.session.connection()
+    self.assertEqual(
+      maintain_partitions(
+        conn, Reservation, keep=1, drop=True, now=shift('month', later, 1)),
+      [archive])
+    self.assertNotIn(archive, sa.inspect(conn).get_table_names())
+    self.session.commit()
+
+
+
+  def test_rotate_after_boundary(self):
+    Reservation = self.make_reservation()
+    table = Reservation.Revision.__table__
+    me = Reservation(name='Me', party=2)
+    you = Reservation(name='You', party=4)
+    self.session.add_all([me, you])
+    self.session.commit()
+    me.party = 3
+    self.session.commit()
+    # move these revisions to the second day of the previous month
+    now = datetime.datetime.utcnow()
+    current = period_start('month', now)
+    previous = shift('month', current, -1)
+    offset = time.time() - calendar.timegm(
+      (previous + datetime.timedelta(days=1)).utctimetuple())
+    conn = self.session.connection()
+    conn.execute(table.update().values(
+      rev_created=table.c.rev_created - offset))
+    me.party = 4
+    self.session.commit()
+
+    conn = self.session.connection()
+    self.assertEqual(maintain_partitions(conn, Reservation, now=now), [])
+    archive = 'reservations_rev_p' + previous.strftime('%Y%m')
+    self.assertEqual(
+      sorted(row.party for row in conn.execute(
+        'SELECT party FROM %s' % archive)), [2, 3, 4])
+    self.assertNotIn('reservations_rev_p' + current.strftime('%Y%m'),
+                     sa.inspect(conn).get_table_names())
+    # the current revision stays, with the previous ones carried over
+    self.assertEqual(
+      sorted(rev.party for rev in self.session.query(Reservation.Revision)),
+      [3, 4, 4])
+    self.assertEqual(
+      sorted(rev.party
+             for rev in Reservation.as_of(self.session, time.time())),
+      [4, 4])
+    self.assertEqual(
+      sorted(rev.party for rev in Reservation.as_of(
+        self.session, time.time() - offset)),
+      [3, 4])
+    # nothing left to archive
+    self.assertEqual(
+      maintain_partitions(conn, Reservation, keep=1, drop=True, now=now),
+      [archive])
+    self.assertEqual(len(self.session.query(Reservation.Revision).all()), 3)
+    self.session.commit()
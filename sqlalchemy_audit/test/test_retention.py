@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import datetime
+
+import sqlalchemy as sa
+
+from . import DbTestCase
+from ..retention import check_policy, compact
+from ..versioned import Versioned
+
+
+DAY = 86400
+
+class TestRetention(DbTestCase):
+
+  def make_item(self, **attrs):
+    attrs.update(
+      __tablename__='items',
+      __rev_created_type__='integer',
+      __audit_retention__=(
+        (datetime.timedelta(days=30), 'day'), (365 * DAY, None)),
+      id=sa.Column(sa.Integer, primary_key=True),
+      name=sa.Column(sa.String),
+      party=sa.Column(sa.Integer))
+    Item = type('Item', (Versioned, self.Base), attrs)
+    Item.broadcast_crud()
+    self.create_tables()
+    return Item
+
+
+  def history(self, Item):
+    return [(row.id, row.party, row.rev_isdelete)
+            for row in Item.Revision.iter_history(self.session)]
+
+
+  def test_check_policy(self):
+    self.assertEqual(
+      check_policy([(DAY * 365, None), (datetime.timedelta(days=1), 'day')]),
+      [(DAY, 'day'), (DAY * 365, None)])
+    self.assertRaises(ValueError, check_policy, [(DAY, 'fortnight')])
+    self.assertRaises(ValueError, check_policy, [])
+
+
+
+  def test_tiers(self):
+    Item = self.make_item()
+    table = Item.Revision.__table__
+    now = datetime.datetime(2024, 6, 1)
+    def micros(days, hours=0):
+      moment = now - datetime.timedelta(days=days, hours=hours)
+      return int((moment - datetime.datetime(1970, 1, 1)).total_seconds()
+                 * 1000000)
+    rows = [
+      # over a year old: only the latest survives
+      (1, micros(400), 1), (1, micros(399), 2),
+      # 30 days to a year old: the last one per day
+      (1, micros(40, 5), 3), (1, micros(40, 1), 4), (1, micros(39), 5),
+      # recent: all kept
+      (1, micros(2, 5), 6), (1, micros(2, 1), 7),
+      (2, micros(40, 5), 1), (2, micros(40, 1), None)]
+    self.session.execute(table.insert(), [
+      dict(rev_id=str(idx), id=id, rev_created=created, rev_seq=1,
+           rev_isdelete=party is None, name='x', party=party)
+      for idx, (id, created, party) in enumerate(rows)])
+    self.session.commit()
+
+    stats = compact(self.session.bind, Item, now=now, batch_size=2)
+    self.assertEqual(stats, {'scanned': 7, 'deleted': 3, 'snapshotted': 0})
+    self.assertEqual(
+      self.history(Item),
+      [(1, 2, False), (1, 4, False), (1, 5, False), (1, 6, False),
+       (1, 7, False), (2, None, True)])
+    self.assertEqual(
+      compact(self.session.bind, Item, now=now)['deleted'], 0)
+
+
+
+  def test_delta_snapshot(self):
+    Item = self.make_item(__audit_delta__=2 ** 128)
+    item = Item(id=1, name='Me', party=2)
+    self.session.add(item)
+    self.session.commit()
+    item.name = 'Us'
+    self.session.commit()
+    item.party = 3
+    self.session.commit()
+    state = Item.revision_state(self.session, item.rev_id)
+
+    stats = compact(
+      self.session.bind, Item,
+      now=datetime.datetime.utcnow() + datetime.timedelta(days=31))
+    self.assertEqual(stats, {'scanned': 3, 'deleted': 2, 'snapshotted': 1})
+    self.assertEqual(self.history(Item), [(1, 3, False)])
+    self.assertEqual(Item.revision_state(self.session, item.rev_id),
+                     dict(state, rev_changed=None))
+    self.assertEqual(
+      self.session.query(Item.Revision).one().rev_changed, None)
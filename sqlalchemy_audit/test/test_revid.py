@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import time
+import uuid
+
+import sqlalchemy as sa
+
+from . import DbTestCase
+from .. import revid
+from ..versioned import Versioned
+
+
+class TestRevId(DbTestCase):
+
+  def test_uuid7(self):
+    before = int(time.time() * 1000)
+    ids = [revid.uuid7() for i in range(1000)]
+    after = int(time.time() * 1000)
+
+    self.assertEqual(set(i.version for i in ids), set([7]))
+    self.assertEqual(set(i.variant for i in ids), set([uuid.RFC_4122]))
+    self.assertEqual(len(set(ids)), 1000)
+    self.assertTrue(before <= ids[0].int >> 80 <= ids[-1].int >> 80 <= after)
+    self.assertEqual(ids, sorted(ids))
+
+
+  def test_rev_id_type(self):
+    self.assertEqual(repr(revid.rev_id_type('text')), repr(sa.String(36)))
+    self.assertEqual(revid.rev_id_type('binary').native, False)
+    self.assertEqual(revid.rev_id_type('native').native, True)
+    self.assertRaises(ValueError, revid.rev_id_type, 'uuid')
+
+
+  def test_binary_uuid7(self):
+    class A(Versioned, self.Base):
+      __tablename__ = 'a'
+      __rev_id_generator__ = staticmethod(revid.uuid7)
+      __rev_id_format__ = 'binary'
+      id = sa.Column(sa.Integer, primary_key=True)
+      name = sa.Column(sa.String)
+
+    A.broadcast_crud()
+    self.create_tables()
+
+    a = A(id=1, name='a')
+    self.session.add(a)
+    self.session.commit()
+    rev_id_1 = a.rev_id
+    a.name = 'b'
+    self.session.commit()
+    rev_id_2 = a.rev_id
+
+    self.assertEqual(uuid.UUID(rev_id_1).version, 7)
+    self.assertTrue(rev_id_1 < rev_id_2)
+    self.assertSeqEqual(
+      self.session.query(A.Revision).order_by(A.Revision.rev_id).all(),
+      [ { 'rev_id': rev_id_1, 'name': 'a' },
+        { 'rev_id': rev_id_2, 'name': 'b' } ],
+      pick=('rev_id', 'name')
+    )
+    self.assertEqual(
+      self.session.query(A).filter_by(rev_id=rev_id_2).one(), a)
+    # stored as 16 raw bytes
+    self.assertEqual(
+      self.session.query(sa.func.length(A.Revision.rev_id)).distinct().all(),
+      [(16,)])
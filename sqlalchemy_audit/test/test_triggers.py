@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import datetime
+
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from . import DbTestCase
+from ..history import timeline_columns
+from ..triggers import create_ddl
+from ..versioned import Versioned
+
+
+class TestTriggers(DbTestCase):
+
+  def make_counter(self, **attrs):
+    attrs.update(
+      __tablename__='counters',
+      __audit_triggers__=True,
+      id=sa.Column(sa.Integer, primary_key=True),
+      name=sa.Column(sa.String),
+      hits=sa.Column(sa.Integer, server_default='0'))
+    Counter = type('Counter', (Versioned, self.Base), attrs)
+    Counter.broadcast_crud()
+    self.create_tables()
+    return Counter
+
+
+  def revisions(self, Counter):
+    table = Counter.Revision.__table__
+    return [(row.id, row.name, row.hits, row.rev_isdelete)
+            for row in self.session.execute(
+              sa.select([table]).order_by(
+                table.c.id, *timeline_columns(table)))]
+
+
+  def test_orm(self):
+    # SQLite's clock only has milliseconds: rev_seq orders quick writes
+    Counter = self.make_counter(__rev_created_type__='integer')
+    counter = Counter(name='Me')
+    self.session.add(counter)
+    self.session.commit()
+    first = counter.rev_id
+    counter.hits = 1
+    self.session.commit()
+    self.assertNotEqual(counter.rev_id, first)
+    self.session.delete(counter)
+    self.session.commit()
+
+    # server defaults and autoincrement values are captured
+    self.assertEqual(
+      self.revisions(Counter),
+      [(1, 'Me', 0, False), (1, 'Me', 1, False), (1, None, None, True)])
+    self.assertEqual(
+      [rev.rev_id for rev in self.session.query(Counter.Revision)
+       .order_by('rev_created', 'rev_seq')][:2],
+      [first, counter.rev_id])
+
+
+
+  def test_raw_sql(self):
+    Counter = self.make_counter(__rev_created_type__='timestamp')
+    self.session.execute("INSERT INTO counters (name) VALUES ('Me')")
+    self.session.execute("UPDATE counters SET hits = hits + 1")
+    self.session.execute("UPDATE counters SET hits = hits + 1")
+    self.session.commit()
+
+    self.assertEqual(
+      self.revisions(Counter),
+      [(1, 'Me', 0, False), (1, 'Me', 1, False), (1, 'Me', 2, False)])
+    self.assertEqual(
+      [rev.hits for rev in Counter.as_of(
+         self.session, datetime.datetime.utcnow())],
+      [2])
+    live = self.session.query(Counter).one()
+    self.assertEqual(
+      self.session.query(Counter.Revision).get(live.rev_id).hits, 2)
+    self.assertEqual(
+      len(set(rev.rev_id for rev in self.session.query(Counter.Revision))),
+      3)
+
+
+
+  def test_postgresql_ddl(self):
+    Counter = self.make_counter()
+    function, trigger = create_ddl(Counter, postgresql.dialect())
+    self.assertIn('NEW.rev_id := CAST(CAST(md5(', function)
+    self.assertIn('extract(epoch from clock_timestamp())', function)
+    self.assertEqual(
+      trigger,
+      'CREATE TRIGGER counters_rev_capture BEFORE INSERT OR UPDATE OR DELETE '
+      'ON counters FOR EACH ROW EXECUTE PROCEDURE counters_rev_capture()')
@@ -3,6 +3,7 @@ import datetime
 import time
 import unittest
 import uuid
+import warnings
 
 import sqlalchemy as sa
 
@@ -61,6 +62,93 @@ class TestVersioned(DbTestCase):
 
 
 
+  def test_rev_plan(self):
+    class A(Versioned, self.Base):
+      __tablename__ = 'a'
+      id = sa.Column(sa.String, primary_key=True)
+      full_name = sa.Column('name', sa.String)
+      party = sa.Column(sa.Integer)
+
+    A.broadcast_crud()
+    self.create_tables()
+
+    plan = A._rev_plan
+    self.assertEqual(plan.primary_key, (('id', 'id'),))
+    self.assertEqual(plan.columns, (('full_name', 'name'), ('party', 'party')))
+    self.assertEqual(plan.get_primary_key(A(id='x')), ('x',))
+    self.assertEqual(plan.get_columns(A(full_name='Me', party=2)), ('Me', 2))
+    self.assertRaises(AttributeError, setattr, plan, 'columns', ())
+
+
+
+  def test_auto_register(self):
+    class A(Versioned, self.Base):
+      __tablename__ = 'a'
+      id = sa.Column(sa.String, primary_key=True)
+      type = sa.Column(sa.String)
+      __mapper_args__ = {'polymorphic_on': type, 'polymorphic_identity': 'a'}
+    class B(A):
+      __mapper_args__ = {'polymorphic_identity': 'b'}
+    self.create_tables()
+    self.session.add_all([A(id='x'), B(id='y')])
+    self.session.commit()
+
+    self.assertEqual(
+      sorted((rev.id, rev.type) for rev in self.session.query(A.Revision)),
+      [('x', 'a'), ('y', 'b')])
+    self.assertIs(B.Revision, A.Revision)
+    self.assertIsNone(A.Revision._rev_plan)
+    self.assertEqual(len(self.Base.metadata.tables), 2)
+
+
+
+  def test_single_table_child_columns(self):
+    class A(Versioned, self.Base):
+      __tablename__ = 'a'
+      id = sa.Column(sa.String, primary_key=True)
+      type = sa.Column(sa.String)
+      __mapper_args__ = {'polymorphic_on': type, 'polymorphic_identity': 'a'}
+    class B(A):
+      __mapper_args__ = {'polymorphic_identity': 'b'}
+      extra = sa.Column('b_extra', sa.String)
+    self.create_tables()
+    b = B(id='y', extra='one')
+    self.session.add_all([A(id='x'), b])
+    self.session.commit()
+    b.extra = 'two'
+    self.session.commit()
+
+    self.assertEqual(
+      sorted((rev.id, rev.b_extra) for rev in self.session.query(A.Revision)),
+      [('x', None), ('y', 'one'), ('y', 'two')])
+    self.assertIs(B.Revision, A.Revision)
+
+
+
+  def test_lazy_rev_class(self):
+    class A(Versioned, self.Base):
+      __tablename__ = 'a'
+      id = sa.Column(sa.String, primary_key=True)
+    class B(Versioned, self.Base):
+      __tablename__ = 'b'
+      id = sa.Column(sa.String, primary_key=True)
+    A.broadcast_crud()
+    B.broadcast_crud()
+    A.broadcast_crud()
+    self.assertNotIn('Revision', A.__dict__)
+    self.assertNotIn('a_rev', self.Base.metadata.tables)
+
+    # create_all still creates revision tables built after it started
+    self.create_tables()
+    self.assertEqual(self.session.query(A.Revision).count(), 0)
+    self.assertIn('Revision', A.__dict__)
+    self.assertIn('b_rev', self.Base.metadata.tables)
+    self.assertEqual(len(A.__mapper__.dispatch.before_insert), 1)
+    Versioned.configure_revisions()
+    self.assertIs(B.Revision.__table__, self.Base.metadata.tables['b_rev'])
+
+
+
   def test_insert(self):
     Reservation = self.make_reservation()
     # insert
@@ -171,6 +259,78 @@ class TestVersioned(DbTestCase):
 
 
 
+  def test_update_unchanged(self):
+    Reservation = self.make_reservation()
+    reservation = Reservation(name='Me', party=10)
+    self.session.add(reservation)
+    self.session.commit()
+    rev_id_1 = reservation.rev_id
+    # dirty, but with the same values
+    reservation.name = 'Me'
+    reservation.party = 10
+    self.session.commit()
+
+    self.assertEqual(reservation.rev_id, rev_id_1)
+    self.assertEqual(self.session.query(Reservation.Revision).count(), 1)
+    reservation.party = 11
+    self.session.commit()
+    self.assertNotEqual(reservation.rev_id, rev_id_1)
+    self.assertEqual(self.session.query(Reservation.Revision).count(), 2)
+
+
+
+  def test_audit_exclude(self):
+    class Document(Versioned, self.Base):
+      __tablename__ = 'documents'
+      __audit_exclude__ = ('body', 'views')
+      id = sa.Column(sa.String, primary_key=True)
+      title = sa.Column(sa.String)
+      body = sa.Column(sa.Text)
+      views = sa.Column('view_count', sa.Integer)
+    self.create_tables()
+
+    self.assertEqual(
+      [col.name for col in Document.Revision.__table__.c
+       if not col.name.startswith('rev_')],
+      ['id', 'title'])
+    doc = Document(id='x', title='Hi', body='...', views=0)
+    self.session.add(doc)
+    self.session.commit()
+    rev_id_1 = doc.rev_id
+    # only excluded columns changed: no revision
+    doc.body = '......'
+    doc.views = 1
+    self.session.commit()
+    self.assertEqual(doc.rev_id, rev_id_1)
+    doc.title = 'Hello'
+    self.session.commit()
+    self.assertEqual(
+      [rev.title for rev in self.session.query(Document.Revision)
+       .order_by('rev_created')],
+      ['Hi', 'Hello'])
+
+
+
+  def test_audit_include(self):
+    class Document(Versioned, self.Base):
+      __tablename__ = 'documents'
+      __audit_include__ = ('title',)
+      id = sa.Column(sa.String, primary_key=True)
+      title = sa.Column(sa.String)
+      body = sa.Column(sa.Text)
+    self.assertEqual(
+      [col.name for col in Document.Revision.__table__.c
+       if not col.name.startswith('rev_')],
+      ['id', 'title'])
+
+    class Bad(Versioned, self.Base):
+      __tablename__ = 'bad'
+      __audit_exclude__ = ('nope',)
+      id = sa.Column(sa.String, primary_key=True)
+    self.assertRaises(ValueError, Versioned.create_rev_class, Bad)
+
+
+
   def test_delete(self):
     Reservation = self.make_reservation()
     # insert
@@ -784,3 +944,241 @@ class TestVersioned(DbTestCase):
     rev = self.session.query(Reservation.Revision).filter_by(id=reservation.id).one()
     self.session.delete(rev)
     self.assertRaises(DeleteForbidden, self.session.commit)
+
+
+
+  def test_bulk(self):
+    Reservation = self.make_reservation()
+    statements = []
+    @sa.event.listens_for(self.session.bind, 'before_cursor_execute')
+    def count(conn, cursor, statement, parameters, context, executemany):
+      if statement.startswith('INSERT INTO reservations_rev'):
+        statements.append(len(parameters) if executemany else 1)
+    self.addCleanup(sa.event.remove, self.session.bind, 'before_cursor_execute', count)
+
+    res1 = Reservation(name='Me', party=2)
+    res2 = Reservation(name='You', party=4)
+    res3 = Reservation(name='Them', party=6)
+    self.session.add_all([res1, res2, res3])
+    self.session.flush()
+    res1.party = 3
+    self.session.delete(res2)
+    self.session.commit()
+
+    self.assertEqual(statements, [3, 2])
+    self.assertEqual(
+      [obj for obj in self.session.identity_map.values()
+       if isinstance(obj, Reservation.Revision)],
+      [])
+    self.assertSeqEqual(
+      self.session.query(Reservation.Revision).order_by('rev_created').all(),
+      [ { 'id': res1.id, 'name': 'Me', 'party': 2, 'rev_isdelete': False },
+        { 'id': res2.id, 'name': 'You', 'party': 4, 'rev_isdelete': False },
+        { 'id': res3.id, 'name': 'Them', 'party': 6, 'rev_isdelete': False },
+        { 'id': res1.id, 'name': 'Me', 'party': 3, 'rev_isdelete': False },
+        { 'id': res2.id, 'name': None, 'party': None, 'rev_isdelete': True },
+      ],
+      pick=('id', 'name', 'party', 'rev_isdelete')
+    )
+
+
+
+  def test_bulk_deprecated(self):
+    with warnings.catch_warnings(record=True) as caught:
+      warnings.simplefilter('always')
+      Versioned.versioned_session(bulk=True)
+    self.assertEqual(
+      [warning.category for warning in caught], [DeprecationWarning])
+    self.assertFalse(hasattr(Versioned, 'bulk'))
+
+
+
+  def test_bulk_rollback(self):
+    Reservation = self.make_reservation()
+    self.session.add(Reservation(name='Me', party=2))
+    self.session.add(Reservation(created=None, name='Broken'))
+    self.assertRaises(sa.exc.DBAPIError, self.session.flush)
+    self.session.rollback()
+    self.session.add(Reservation(name='You', party=4))
+    self.session.commit()
+
+    self.assertSeqEqual(
+      self.session.query(Reservation.Revision).all(),
+      [ { 'name': 'You', 'party': 4 } ],
+      pick=('name', 'party')
+    )
+
+
+
+  def test_session_per_engine(self):
+    Versioned.versioned_session(None)
+    Reservation = self.make_reservation()
+    sessions = []
+    for name in ('Me', 'You'):
+      other = sa.create_engine('sqlite://')
+      self.Base.metadata.create_all(other)
+      session = sa.orm.Session(other)
+      self.addCleanup(session.close)
+      session.add(Reservation(name=name, party=2))
+      session.commit()
+      sessions.append(session)
+
+    for name, session in zip(('Me', 'You'), sessions):
+      self.assertSeqEqual(
+        session.query(Reservation.Revision).all(),
+        [ { 'name': name, 'party': 2, 'rev_isdelete': False } ],
+        pick=('name', 'party', 'rev_isdelete')
+      )
+    self.assertEqual(self.session.query(Reservation.Revision).all(), [])
+
+
+
+  def test_delta(self):
+    class A(Versioned, self.Base):
+      __tablename__ = 'a'
+      # no snapshot but the first within this test
+      __audit_delta__ = 10
+      id = sa.Column(sa.Integer, primary_key=True)
+      name = sa.Column(sa.String)
+      party = sa.Column(sa.Integer)
+      note = sa.Column(sa.Text)
+
+    A.broadcast_crud()
+    self.create_tables()
+
+    a = A(id=1, name='Me', party=2, note='hi')
+    self.session.add(a)
+    self.session.commit()
+    rev_ids = [a.rev_id]
+    a.party = 3
+    self.session.commit()
+    rev_ids.append(a.rev_id)
+    a.name = 'You'
+    a.note = None
+    self.session.commit()
+    rev_ids.append(a.rev_id)
+    self.session.delete(a)
+    self.session.commit()
+
+    self.assertSeqEqual(
+      self.session.query(A.Revision).order_by('rev_created').all(),
+      [ { 'id': 1, 'name': 'Me', 'party': 2, 'note': 'hi',
+          'rev_changed': None, 'rev_isdelete': False },
+        { 'id': 1, 'name': None, 'party': 3, 'note': None,
+          'rev_changed': 'party', 'rev_isdelete': False },
+        { 'id': 1, 'name': 'You', 'party': None, 'note': None,
+          'rev_changed': 'name,note', 'rev_isdelete': False },
+        { 'id': 1, 'name': None, 'party': None, 'note': None,
+          'rev_changed': None, 'rev_isdelete': True },
+      ],
+      pick=('id', 'name', 'party', 'note', 'rev_changed', 'rev_isdelete')
+    )
+    self.assertSeqEqual(
+      [A.revision_state(self.session, rev_id) for rev_id in rev_ids],
+      [ { 'id': 1, 'name': 'Me', 'party': 2, 'note': 'hi' },
+        { 'id': 1, 'name': 'Me', 'party': 3, 'note': 'hi' },
+        { 'id': 1, 'name': 'You', 'party': 3, 'note': None },
+      ],
+      pick=('id', 'name', 'party', 'note')
+    )
+    self.assertEqual(A.revision_state(self.session, 'nope'), None)
+
+
+
+  def test_delta_interval(self):
+    class A(Versioned, self.Base):
+      __tablename__ = 'a'
+      # every third revision of a row is a snapshot
+      __audit_delta__ = 3
+      id = sa.Column(sa.Integer, primary_key=True, autoincrement=False)
+      name = sa.Column(sa.String)
+      party = sa.Column(sa.Integer)
+
+    A.broadcast_crud()
+    self.create_tables()
+
+    a = A(id=1, name='Me', party=0)
+    b = A(id=2, name='You', party=0)
+    self.session.add_all([a, b])
+    self.session.commit()
+    rev_ids = [a.rev_id]
+    for party in range(1, 7):
+      a.party = party
+      if party % 2:
+        b.party = party
+      self.session.commit()
+      rev_ids.append(a.rev_id)
+      # counted from the table, not from objects in memory
+      self.session.expunge_all()
+      a = self.session.query(A).get(1)
+      b = self.session.query(A).get(2)
+
+    revs = [self.session.query(A.Revision).get(rev_id) for rev_id in rev_ids]
+    self.assertEqual(
+      [rev.rev_changed for rev in revs],
+      [None, 'party', 'party', None, 'party', 'party', None])
+    self.assertEqual([rev.name for rev in revs],
+                     ['Me', None, None, 'Me', None, None, 'Me'])
+    self.assertEqual(
+      [A.revision_state(self.session, rev_id)['party']
+       for rev_id in rev_ids],
+      [0, 1, 2, 3, 4, 5, 6])
+    self.assertEqual(
+      [rev.rev_changed for rev in self.session.query(A.Revision)
+       .filter_by(id=2).order_by('rev_created')],
+      [None, 'party', 'party', None])
+
+
+
+  def test_delta_primary_key(self):
+    class A(Versioned, self.Base):
+      __tablename__ = 'a'
+      __audit_delta__ = 10
+      id = sa.Column(sa.Integer, primary_key=True, autoincrement=False)
+      name = sa.Column(sa.String)
+      party = sa.Column(sa.Integer)
+
+    A.broadcast_crud()
+    self.create_tables()
+
+    a = A(id=1, name='Me', party=2)
+    self.session.add(a)
+    self.session.commit()
+    # a new key has no history to build on: full snapshot
+    a.id = 2
+    a.party = 5
+    self.session.commit()
+    rev = self.session.query(A.Revision).get(a.rev_id)
+    self.assertEqual((rev.id, rev.name, rev.party, rev.rev_changed),
+                     (2, 'Me', 5, None))
+    self.assertEqual(
+      A.revision_state(self.session, a.rev_id)['name'], 'Me')
+
+
+
+  def test_delta_snapshot(self):
+    class A(Versioned, self.Base):
+      __tablename__ = 'a'
+      # every revision is a snapshot
+      __audit_delta__ = 1
+      id = sa.Column(sa.Integer, primary_key=True)
+      name = sa.Column(sa.String)
+      party = sa.Column(sa.Integer)
+
+    A.broadcast_crud()
+    self.create_tables()
+
+    a = A(id=1, name='Me', party=2)
+    self.session.add(a)
+    self.session.commit()
+    a.party = 3
+    self.session.commit()
+
+    self.assertSeqEqual(
+      self.session.query(A.Revision).order_by('rev_created').all(),
+      [ { 'name': 'Me', 'party': 2, 'rev_changed': None },
+        { 'name': 'Me', 'party': 3, 'rev_changed': None } ],
+      pick=('name', 'party', 'rev_changed')
+    )
+    self.assertEqual(
+      A.revision_state(self.session, a.rev_id)['name'], 'Me')
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import threading
+
+import sqlalchemy as sa
+
+from . import DbTestCase
+from ..metrics import Counters
+from ..versioned import Versioned
+from ..writer import AsyncRevisionWriter
+
+
+class TestAsyncRevisionWriter(DbTestCase):
+
+  def setUp(self):
+    super(TestAsyncRevisionWriter, self).setUp()
+    # the writer thread needs to see the same database
+    tmp = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, tmp)
+    self.engine = sa.create_engine(
+      'sqlite:///' + os.path.join(tmp, 'audit.db'))
+    self.addCleanup(self.engine.dispose)
+    self.session.close()
+    self.session = sa.orm.Session(self.engine)
+    self.writer = AsyncRevisionWriter(self.engine, maxsize=2).start()
+    self.addCleanup(self.writer.stop)
+    Versioned.versioned_session(writer=self.writer)
+    self.addCleanup(Versioned.versioned_session, writer=None)
+
+
+  def create_tables(self):
+    self.Base.metadata.create_all(self.engine)
+
+
+  def revisions(self, Reservation):
+    return sorted(
+      (row.name, row.party, row.rev_isdelete)
+      for row in self.engine.execute(
+        sa.select([Reservation.Revision.__table__])))
+
+
+  def test_write_on_commit(self):
+    Reservation = self.make_reservation()
+    me = Reservation(name='Me', party=2)
+    self.session.add(me)
+    self.session.flush()
+    me.party = 3
+    self.session.flush()
+    # nothing is written inside the transaction
+    self.assertEqual(
+      self.session.query(Reservation.Revision).count(), 0)
+    self.session.commit()
+    self.writer.flush()
+
+    self.assertEqual(
+      self.revisions(Reservation),
+      [('Me', 2, False), ('Me', 3, False)])
+    self.assertEqual(
+      self.session.query(Reservation).one().rev_id,
+      self.engine.execute(
+        sa.select([Reservation.Revision.__table__.c.rev_id])
+        .where(Reservation.Revision.__table__.c.party == 3)).scalar())
+
+
+  def test_discard_on_rollback(self):
+    Reservation = self.make_reservation()
+    self.session.add(Reservation(name='Me', party=2))
+    self.session.flush()
+    self.session.rollback()
+    self.session.add(Reservation(name='You', party=4))
+    self.session.commit()
+    savepoint = self.session.begin_nested()
+    self.session.add(Reservation(name='Them', party=6))
+    self.session.flush()
+    savepoint.rollback()
+    self.session.add(Reservation(name='Us', party=8))
+    self.session.commit()
+    self.writer.flush()
+
+    self.assertEqual(
+      self.revisions(Reservation),
+      [('Us', 8, False), ('You', 4, False)])
+
+
+  def test_backpressure(self):
+    Reservation = self.make_reservation()
+    self.writer.stop()
+    # a writer that never drains: once full, commits write synchronously
+    self.writer = AsyncRevisionWriter(self.engine, maxsize=1, timeout=0.01)
+    Versioned.versioned_session(writer=self.writer)
+    for name in ('Me', 'You', 'Them'):
+      self.session.add(Reservation(name=name, party=2))
+      self.session.commit()
+
+    self.assertEqual(self.writer.qsize(), 1)
+    self.assertEqual(
+      self.revisions(Reservation), [('Them', 2, False), ('You', 2, False)])
+    self.writer.start()
+    self.writer.stop()
+    self.assertEqual(self.writer.qsize(), 0)
+    self.assertEqual(len(self.revisions(Reservation)), 3)
+
+
+  def test_concurrent_sessions(self):
+    Reservation = self.make_reservation()
+    maker = sa.orm.sessionmaker(bind=self.engine)
+    lock = threading.Lock()
+    def work(name):
+      session = maker()
+      for party in range(5):
+        with lock:
+          session.add(Reservation(name=name, party=party))
+          session.commit()
+      session.close()
+    threads = [threading.Thread(target=work, args=(name,))
+               for name in ('Me', 'You', 'Them')]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.writer.stop()
+
+    self.assertEqual(len(self.revisions(Reservation)), 15)
+
+
+
+  def test_savepoint_release(self):
+    Reservation = self.make_reservation()
+    self.session.add(Reservation(name='Me', party=2))
+    self.session.flush()
+    savepoint = self.session.begin_nested()
+    self.session.add(Reservation(name='You', party=4))
+    savepoint.commit()
+    # nothing goes to the writer before the outer transaction commits
+    self.assertEqual(self.writer.qsize(), 0)
+    self.session.rollback()
+    self.writer.flush()
+
+    self.assertEqual(self.session.query(Reservation).count(), 0)
+    self.assertEqual(self.revisions(Reservation), [])
+
+
+
+  def test_savepoint_rollback(self):
+    Reservation = self.make_reservation()
+    self.session.add(Reservation(name='Me', party=2))
+    self.session.flush()
+    savepoint = self.session.begin_nested()
+    self.session.add(Reservation(name='You', party=4))
+    self.session.flush()
+    savepoint.rollback()
+    self.session.commit()
+    self.writer.flush()
+
+    # only the savepoint's revisions are dropped
+    self.assertEqual(self.revisions(Reservation), [('Me', 2, False)])
+
+
+
+  def test_metrics(self):
+    metrics = Counters()
+    # configuring metrics keeps the writer, and the other way around
+    Versioned.versioned_session(metrics=metrics)
+    self.addCleanup(Versioned.versioned_session, metrics=None)
+    self.assertIs(Versioned.writer, self.writer)
+    Versioned.versioned_session(writer=self.writer)
+    self.assertIs(Versioned.metrics, metrics)
+
+    Reservation = self.make_reservation()
+    self.session.add(Reservation(name='Me', party=2))
+    self.session.commit()
+    self.writer.flush()
+    self.assertEqual(self.revisions(Reservation), [('Me', 2, False)])
+    self.assertEqual(metrics.rows, {'reservations_rev': 1})
+    self.assertEqual(metrics.counts[(Reservation, 'insert')], 1)
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+'''
+Server-side revision capture.
+
+A versioned class with ``__audit_triggers__ = True`` records its revisions
+with database triggers instead of the Python mapper handlers:
+
+  class Reservation(Versioned, Base):
+    __tablename__ = 'reservations'
+    __audit_triggers__ = True
+    ...
+
+The triggers are created right after the revision table (`create_all`
+orders it after the live table) and dropped with it. Every INSERT, UPDATE and
+DELETE, including raw SQL, then writes its revision inside the database,
+with the real server defaults and sequence values. An UPDATE that does not
+set a new rev_id itself gets a random one, and the ORM refetches ``rev_id``
+after flushing.
+
+Supported dialects are SQLite and PostgreSQL. `create_ddl` and `drop_ddl`
+return the statements for use in migrations. Unlike the Python handlers,
+the triggers record every UPDATE, whether or not a value changed (though with
+``__audit_exclude__`` only those setting an audited column), and always
+store full snapshots. On SQLite, ``PRAGMA recursive_triggers`` must stay off
+(the default), and since its clock only has millisecond precision, tables
+there should use an 'integer' or 'timestamp' ``__rev_created_type__`` so
+that ``rev_seq`` orders revisions written within the same millisecond.
+'''
+import sqlalchemy as sa
+
+from . import core
+
+
+def install(cls):
+  '''
+  Creates and drops `cls`'s triggers along with its revision table.
+  '''
+  table = cls.Revision.__table__
+  table.add_is_dependent_on(cls.__mapper__.local_table)
+
+  def create(target, connection, **kw):
+    for statement in create_ddl(cls, connection.dialect):
+      connection.execute(_ddl(statement))
+
+  def drop(target, connection, **kw):
+    for statement in drop_ddl(cls, connection.dialect):
+      connection.execute(_ddl(statement))
+
+  sa.event.listen(table, 'after_create', create)
+  sa.event.listen(table, 'before_drop', drop)
+
+
+def create_ddl(cls, dialect):
+  '''
+  Returns the statements creating `cls`'s revision triggers on `dialect`.
+  '''
+  if dialect.name == 'sqlite':
+    return _sqlite_create(_Names(cls, dialect))
+  if dialect.name == 'postgresql':
+    return _postgresql_create(_Names(cls, dialect))
+  raise sa.exc.CompileError(
+    'revision triggers are not supported on dialect %r' % dialect.name)
+
+
+def drop_ddl(cls, dialect):
+  '''
+  Returns the statements dropping `cls`'s revision triggers on `dialect`.
+  '''
+  names = _Names(cls, dialect)
+  if dialect.name == 'sqlite':
+    return ['DROP TRIGGER IF EXISTS %s' % names.trigger(action)
+            for action in ('insert', 'update', 'delete')]
+  if dialect.name == 'postgresql':
+    return ['DROP FUNCTION IF EXISTS %s() CASCADE' % names.trigger('capture')]
+  raise sa.exc.CompileError(
+    'revision triggers are not supported on dialect %r' % dialect.name)
+
+
+def _ddl(statement):
+  # DDL() applies %-formatting to its text
+  return sa.DDL(statement.replace('%', '%%'))
+
+
+class _Names(object):
+  '''
+  Quoted names and SQL snippets shared by the dialect templates.
+  '''
+
+  def __init__(self, cls, dialect):
+    preparer = dialect.identifier_preparer
+    self.live = cls.__mapper__.local_table
+    self.table = cls.Revision.__table__
+    self.kind = self.table.info.get('rev_created', 'float')
+    self.quote = preparer.quote
+    self.live_name = preparer.format_table(self.live)
+    self.table_name = preparer.format_table(self.table)
+    self.schema = self.live.schema
+    self.primary_key = [
+      self.quote(name) for name in self.table.info['primary_key']]
+    self.new_rev_id = str(
+      core.new_rev_id(cls.__rev_id_format__).compile(dialect=dialect))
+
+  def trigger(self, action):
+    name = self.quote('%s_%s' % (self.table.name, action))
+    if self.schema:
+      return '%s.%s' % (self.quote(self.schema), name)
+    return name
+
+  def columns(self):
+    return ', '.join(self.quote(col.name) for col in self.table.c)
+
+  def update_of(self):
+    '''
+    The ``UPDATE`` trigger event, limited to the audited columns when some
+    are left out of the revisions.
+    '''
+    audited = [col.name for col in self.table.c
+               if not col.name.startswith('rev_')]
+    if len(audited) == len(
+        [col for col in self.live.c if not col.name.startswith('rev_')]):
+      return 'UPDATE'
+    return 'UPDATE OF %s' % ', '.join(self.quote(name) for name in audited)
+
+  def values(self, row, rev_id, created, delete, true, false):
+    '''
+    Expressions filling a revision row from trigger row `row`.
+    '''
+    values = []
+    for col in self.table.c:
+      if col.name == 'rev_id':
+        values.append(rev_id)
+      elif col.name == 'rev_created':
+        values.append(created)
+      elif col.name == 'rev_seq':
+        values.append(self.seq(row, created))
+      elif col.name == 'rev_isdelete':
+        values.append(true if delete else false)
+      elif col.name in ('rev_changed', 'rev_txn_id'):
+        values.append('NULL')
+      elif delete and self.quote(col.name) not in self.primary_key:
+        values.append('NULL')
+      else:
+        values.append('%s.%s' % (row, self.quote(col.name)))
+    return ', '.join(values)
+
+  def seq(self, row, created):
+    # numbers revisions of a key sharing one timestamp, like clock.tick
+    return (
+      '(SELECT coalesce(max(rev_seq), 0) + 1 FROM %s WHERE %s AND '
+      'rev_created = %s)' % (self.table_name, self.match(row), created))
+
+  def match(self, row, alias=None):
+    return ' AND '.join(
+      '%s%s = %s.%s' % (alias + '.' if alias else '', name, row, name)
+      for name in self.primary_key)
+
+
+_SQLITE_CREATED = {
+  'float': "((julianday('now') - 2440587.5) * 86400.0)",
+  'integer': ("CAST(round((julianday('now') - 2440587.5) * 86400000000.0) "
+              "AS INTEGER)"),
+  # SQLAlchemy reads back six fractional digits
+  'timestamp': "strftime('%Y-%m-%d %H:%M:%f000', 'now')",
+}
+
+def _sqlite_create(names):
+  created = _SQLITE_CREATED[names.kind]
+  insert = 'INSERT INTO %s (%s)' % (names.table_name, names.columns())
+  # NEW cannot be assigned to: new rows get rev_id from the column default,
+  # updated rows are given a fresh one and copied back from the live table
+  copy = '%s SELECT %s FROM %s AS live WHERE %s;' % (
+    insert,
+    names.values('live', 'live.rev_id', created, False, '1', '0'),
+    names.live_name, names.match('NEW', 'live'))
+  return [
+    'CREATE TRIGGER %s AFTER INSERT ON %s FOR EACH ROW BEGIN %s END' % (
+      names.trigger('insert'), names.live_name, copy),
+    'CREATE TRIGGER %s AFTER %s ON %s FOR EACH ROW BEGIN '
+    'UPDATE %s SET rev_id = %s WHERE %s AND NEW.rev_id IS OLD.rev_id; '
+    '%s END' % (
+      names.trigger('update'), names.update_of(), names.live_name,
+      names.live_name,
+      names.new_rev_id, names.match('NEW'), copy),
+    'CREATE TRIGGER %s AFTER DELETE ON %s FOR EACH ROW BEGIN '
+    '%s VALUES (%s); END' % (
+      names.trigger('delete'), names.live_name, insert,
+      names.values('OLD', names.new_rev_id, created, True, '1', '0')),
+  ]
+
+
+_POSTGRESQL_CREATED = {
+  'float': 'extract(epoch from clock_timestamp())',
+  # a single clock read per transaction, as with clock.tick
+  'integer': 'CAST(extract(epoch from transaction_timestamp()) * 1000000 '
+             'AS BIGINT)',
+  'timestamp': "transaction_timestamp() AT TIME ZONE 'UTC'",
+}
+
+def _postgresql_create(names):
+  created = _POSTGRESQL_CREATED[names.kind]
+  insert = 'INSERT INTO %s (%s)' % (names.table_name, names.columns())
+  function = names.trigger('capture')
+  return [
+    'CREATE OR REPLACE FUNCTION %s() RETURNS trigger AS $$\n'
+    'BEGIN\n'
+    '  IF TG_OP = \'DELETE\' THEN\n'
+    '    %s VALUES (%s);\n'
+    '    RETURN OLD;\n'
+    '  END IF;\n'
+    '  IF TG_OP = \'UPDATE\' AND NEW.rev_id IS NOT DISTINCT FROM OLD.rev_id '
+    'THEN\n'
+    '    NEW.rev_id := %s;\n'
+    '  END IF;\n'
+    '  %s VALUES (%s);\n'
+    '  RETURN NEW;\n'
+    'END\n'
+    '$$ LANGUAGE plpgsql' % (
+      function,
+      insert, names.values('OLD', names.new_rev_id, created, True,
+                           'true', 'false'),
+      names.new_rev_id,
+      insert, names.values('NEW', 'NEW.rev_id', created, False,
+                           'true', 'false')),
+    'CREATE TRIGGER %s BEFORE INSERT OR %s OR DELETE ON %s '
+    'FOR EACH ROW EXECUTE PROCEDURE %s()' % (
+      names.quote('%s_capture' % names.table.name), names.update_of(),
+      names.live_name, function),
+  ]
@@ -1,9 +1,121 @@
 # -*- coding: utf-8 -*-
+import collections
+import operator
 import time
-import uuid
+import warnings
+
+try:
+  from time import perf_counter as timer
+except ImportError: # pragma: no cover
+  from time import time as timer
 
-import aadict
 import sqlalchemy as sa
+from sqlalchemy.ext.declarative import declared_attr
+
+from . import (
+  clock, context, core, dedup, export, history, metrics, partition, revid,
+  triggers)
+
+
+class RevisionPlan(collections.namedtuple(
+    'RevisionPlan', ('primary_key', 'columns',
+                     'primary_key_names', 'column_names',
+                     'get_primary_key', 'get_columns', 'watched', 'delta',
+                     'clock', 'content'))):
+  '''
+  Immutable, per-class copy plan from a versioned object to its revision row.
+
+  `primary_key` and `columns` are ordered tuples of (attribute key, revision
+  column name) pairs; `get_primary_key` and `get_columns` fetch the matching
+  attribute values off an object as a tuple in one call. `watched` is the
+  frozenset of attribute keys whose changes warrant a new revision. `delta`
+  is the full-snapshot interval of delta-only storage (0 when disabled).
+  `clock` is the rev_created type when it comes from a per-transaction clock,
+  None for legacy per-object float timestamps. `content` holds the (key,
+  name) pairs of deduplicated columns, which are not part of `columns`.
+  `audited`, if given, is the set of column names to copy besides the
+  primary key, and `dedup` the set of those to deduplicate. Columns that
+  `mapper` does not map (those of single-table inheritance siblings) have
+  the key None and are copied as NULL.
+  '''
+
+  @classmethod
+  def build(cls, mapper, table, delta=0, rev_created='float', audited=None,
+            dedup=()):
+    primary_key = []
+    columns = []
+    content = []
+    for col in table.c:
+      key = _property_key(mapper, col)
+      if col.primary_key is True:
+        primary_key.append((key, col.name))
+      # skip namespaced fields (populated by the handler itself) and
+      # columns left out of the revisions
+      elif (col.name.startswith('rev_')
+            or (audited is not None and col.name not in audited)):
+        continue
+      elif key is None:
+        # a sibling's column: always NULL, even if deduplicated
+        columns.append((key, col.name))
+      elif col.name in dedup:
+        content.append((key, col.name))
+      else:
+        columns.append((key, col.name))
+    return cls(
+      tuple(primary_key),
+      tuple(columns),
+      tuple(name for key, name in primary_key),
+      tuple(name for key, name in columns),
+      _tuple_getter(key for key, name in primary_key),
+      _tuple_getter(key for key, name in columns),
+      frozenset(key for key, name in primary_key + columns + content
+                if key is not None),
+      delta or 0,
+      None if rev_created == 'float' else rev_created,
+      tuple(content),
+    )
+
+
+def _tuple_getter(keys):
+  '''
+  Returns a callable that fetches `keys` off an object, always as a tuple;
+  None keys fetch None.
+  '''
+  keys = tuple(keys)
+  if None in keys:
+    getters = [operator.attrgetter(key) if key is not None
+               else (lambda obj: None) for key in keys]
+    return lambda obj: tuple(getter(obj) for getter in getters)
+  if len(keys) == 1:
+    getter = operator.attrgetter(keys[0])
+    return lambda obj: (getter(obj),)
+  if not keys:
+    return lambda obj: ()
+  return operator.attrgetter(*keys)
+
+
+_MISSING = object()
+
+class _Lazy(object):
+  '''
+  Class attribute building the revision class of a versioned class on first
+  access, after which the real attribute shadows it. Classes that are not
+  registered (e.g. revision classes) get `default`.
+  '''
+
+  def __init__(self, name, default=_MISSING):
+    self.name = name
+    self.default = default
+
+  def __get__(self, obj, cls):
+    for base in cls.__mro__:
+      if base in _unconfigured:
+        Versioned.create_rev_class(base)
+        return getattr(cls, self.name)
+    if self.default is _MISSING:
+      raise AttributeError(self.name)
+    return self.default
+
 
 class Versioned(object):
   '''
@@ -12,85 +124,267 @@ class Versioned(object):
 
   Usage
   -----
-    # Set up DBSession
-    DBSession = ...
-    Versioned.versioned_session(DBSession)
-
-    # Class inherits Versioned and broadcast CRUD events
-    class MyClass(Versioned):
+    # Mapped classes inheriting Versioned are registered automatically
+    class MyClass(Versioned, Base):
       ...
 
-    MyClass.broadcast_crud()
+  Registration is cheap: the revision class, table and mapper are built in
+  bulk when mappers are configured, or on first access to
+  ``MyClass.Revision``. `MetaData.create_all` creates revision tables
+  either way; call `configure_revisions` first for anything else that needs
+  them in the metadata (e.g. migration autogenerate).
+
+  Revisions are written through the session that owns the changed object, so
+  scoped (per-thread) sessions and sessions bound to different engines each
+  record their own revisions.
+
+  Revisions are collected as plain rows on the owning session during the
+  flush (no `Revision` objects are created or tracked) and written with one
+  executemany INSERT per revision table on the flush connection before the
+  flush ends. ``Versioned.versioned_session(writer=...)`` hands them to an
+  `AsyncRevisionWriter` once the transaction commits instead.
+
+  The revision id generator and its storage are configurable per class with
+  ``__rev_id_generator__`` (e.g. ``staticmethod(revid.uuid7)`` for
+  time-ordered ids) and ``__rev_id_format__`` ('text', 'binary' or 'native');
+  see `sqlalchemy_audit.revid`.
+
+  Setting ``__audit_delta__ = N`` stores update revisions as deltas: only the
+  changed columns are filled in and listed in ``rev_changed``, while every
+  insert and delete, and every update following N - 1 deltas of the same
+  row, is a full snapshot (``rev_changed`` is NULL). `revision_state`
+  rebuilds full rows.
+
+  ``__rev_created_type__`` stores rev_created as 'float' seconds (default),
+  'integer' microseconds or a UTC 'timestamp'; see `sqlalchemy_audit.clock`.
+
+  ``__audit_partition__`` ('day', 'month' or 'year') partitions the revision
+  table by rev_created; see `sqlalchemy_audit.partition`.
+
+  ``__audit_retention__`` declares how `retention.compact` thins out old
+  history; see `sqlalchemy_audit.retention`.
+
+  ``__audit_exclude__`` (or ``__audit_include__``) lists the columns (or
+  attributes) left out of (or kept in) the revisions. Excluded columns are
+  neither stored nor read, and updates touching only excluded columns write
+  no revision. Primary key columns are always kept.
+
+  ``__audit_dedup__`` lists large columns whose revisions store a digest of
+  the value, kept once in a side table; see `sqlalchemy_audit.dedup`.
+
+  ``__audit_context__ = True`` links revisions to the transaction's
+  `context.audit_context` (user, request, reason) through ``rev_txn_id``;
+  see `sqlalchemy_audit.context`.
+
+  With ``__audit_triggers__ = True`` revisions are written by database
+  triggers instead of Python handlers; see `sqlalchemy_audit.triggers`.
+
+  ``Versioned.versioned_session(metrics=...)`` reports revision counts,
+  handler timings and written bytes; see `sqlalchemy_audit.metrics`.
+
+  Writes that bypass the unit of work (bulk mappings, ``Query.update()``,
+  Core statements) are audited once `core.audit_statements` is installed on
+  the engine.
   '''
   DBSession = None
+  writer = None
+  metrics = None
+
+  __rev_id_generator__ = staticmethod(revid.uuid4)
+  __rev_id_format__ = 'text'
+  __audit_delta__ = 0
+  __rev_created_type__ = 'float'
+  __audit_triggers__ = False
+  __audit_partition__ = None
+  __audit_retention__ = None
+  __audit_context__ = False
+  __audit_exclude__ = ()
+  __audit_include__ = None
+  __audit_dedup__ = ()
 
-  rev_id = sa.Column('rev_id', sa.String(36), nullable=False, unique=True)
+  Revision = _Lazy('Revision')
+  _rev_plan = _Lazy('_rev_plan', None)
+
+  @declared_attr
+  def rev_id(cls):
+    if cls.__audit_triggers__:
+      # filled in by the database; see `sqlalchemy_audit.triggers`
+      return sa.Column('rev_id', revid.rev_id_type(cls.__rev_id_format__),
+                       nullable=False, unique=True,
+                       server_default=core.new_rev_id(cls.__rev_id_format__),
+                       server_onupdate=sa.FetchedValue())
+    return sa.Column('rev_id', revid.rev_id_type(cls.__rev_id_format__),
+                     nullable=False, unique=True)
 
   # todo: switch to pub/sub or message broker instead of directly setting 
   #       the handler
   @staticmethod
   def before_insert(mapper, connection, target):
-    Versioned.before_db_change(mapper, connection, target, 'insert')
+    if target._rev_plan is None:
+      return
+    core.begin_flush(connection)
+    Versioned.record(mapper, connection, target, 'insert')
 
   @staticmethod
   def before_update(mapper, connection, target):
-    obj_changed = False
-    for col in target.__table__.columns:
-      prop = mapper.get_property_by_column(col)
-      if (prop.key != 'rev_id'
-          and sa.orm.attributes.get_history(target, prop.key).has_changes()):
-        obj_changed = True
-        break
-    if obj_changed:
-      Versioned.before_db_change(mapper, connection, target, 'update')
+    # only attributes recorded in committed_state were touched since the last
+    # flush; confirm those actually changed value
+    plan = target._rev_plan
+    if plan is None:
+      return
+    core.begin_flush(connection)
+    state = sa.orm.attributes.instance_state(target)
+    changed = set()
+    for key in plan.watched.intersection(state.committed_state):
+      if sa.orm.attributes.get_history(target, key).has_changes():
+        changed.add(key)
+        # deltas and deduplicated columns need every changed key, plain
+        # snapshots only need to know
+        if not plan.delta and not plan.content:
+          break
+    if changed:
+      Versioned.record(mapper, connection, target, 'update', changed)
+    elif Versioned.metrics is not None:
+      Versioned.metrics.skipped(mapper.class_)
 
   @staticmethod
   def before_delete(mapper, connection, target):
-    Versioned.before_db_change(mapper, connection, target, 'delete')
+    if target._rev_plan is None:
+      return
+    core.begin_flush(connection)
+    Versioned.record(mapper, connection, target, 'delete')
+
+  @staticmethod
+  def after_db_change(mapper, connection, target):
+    core.end_flush(connection)
 
   @staticmethod
-  def before_db_change(mapper, connection, target, action):
+  def record(mapper, connection, target, action, changed=None):
+    # timed only with metrics configured, see `sqlalchemy_audit.metrics`
+    if Versioned.metrics is None:
+      Versioned.before_db_change(mapper, connection, target, action, changed)
+      return
+    start = timer()
+    Versioned.before_db_change(mapper, connection, target, action, changed)
+    Versioned.metrics.revision(mapper.class_, action, timer() - start)
+
+  @staticmethod
+  def before_db_change(mapper, connection, target, action, changed=None):
+    previous = target.rev_id
     # target: re-roll the rev_id on change
     # this is needed for insert b/c we don't have init to populate its value
-    target.rev_id = str(uuid.uuid4())
+    target.rev_id = str(target.__rev_id_generator__())
 
     # revision
     # todo: should we handle the defaults in a constructor?
-    attr = aadict.aadict()
-    attr.rev_id = getattr(target, 'rev_id')
-    attr.rev_created = time.time()
-    attr.rev_isdelete = False
-    for k in target.__table__.primary_key:
-      prop = mapper.get_property_by_column(k).key
-      attr[k.name] = getattr(target, prop)
-
+    plan = target._rev_plan
+    session = sa.orm.object_session(target)
+    attr = dict(zip(plan.primary_key_names, plan.get_primary_key(target)))
+    attr['rev_id'] = target.rev_id
+    if plan.clock is None:
+      attr['rev_created'] = time.time()
+    else:
+      attr['rev_created'], attr['rev_seq'] = clock.tick(
+        connection, plan.clock)
+    if plan.delta:
+      attr['rev_changed'] = None
     if action == 'delete':
-      attr.rev_isdelete = True
+      attr['rev_isdelete'] = True
       # skips copying the rest of the fields (hence None)
+      attr.update(dict.fromkeys(plan.column_names))
+      attr.update((name, None) for key, name in plan.content)
+    elif (plan.delta > 1 and changed is not None
+          and not any(key in changed for key, name in plan.primary_key)):
+      # delta: only read and store what changed; `resolve_deltas` turns it
+      # into a snapshot once the row has enough deltas. A new primary key
+      # has no earlier revisions to build on, so it always gets a snapshot
+      attr['rev_isdelete'] = False
+      attr.update(dict.fromkeys(plan.column_names))
+      names = []
+      for key, name in plan.columns:
+        if key in changed:
+          attr[name] = getattr(target, key)
+          names.append(name)
+      for key, name in plan.content:
+        attr[name] = None
+        if key in changed:
+          attr[name] = dedup.collect(
+            session, target.Revision.__table__, name, mapper,
+            getattr(target, key))
+          names.append(name)
+      attr['rev_changed'] = Delta(','.join(names), target, changed, previous)
     else:
-      # todo: is there a better way to copy this?
-      for c in target.__table__.c:
-        # skip primary key and namespaced fields (already assigned)
-        if not (c.name.startswith('rev_') or c.primary_key is True):
-          prop = mapper.get_property_by_column(c).key
-          attr[c.name] = getattr(target, prop)
-    rev = target.Revision(**attr)
-    Versioned.DBSession.add(rev)
+      attr['rev_isdelete'] = False
+      attr.update(zip(plan.column_names, plan.get_columns(target)))
+      for key, name in plan.content:
+        if changed is not None and key not in changed:
+          # unchanged: neither load nor store the value again
+          attr[name] = dedup.Carry(previous, target, key, name)
+        else:
+          attr[name] = dedup.collect(
+            session, target.Revision.__table__, name, mapper,
+            getattr(target, key))
+    pending = session.info.setdefault(
+      PENDING_REVISIONS, collections.OrderedDict())
+    table = target.Revision.__table__
+    if table not in pending:
+      pending[table] = (mapper, [])
+    pending[table][1].append(attr)
 
 
   @classmethod
   def broadcast_crud(cls):
-    # create revision class
-    Versioned.create_rev_class(cls)
+    '''
+    Registers `cls` for versioning. Mapped subclasses are registered
+    automatically, so this is only kept for backwards compatibility; calling
+    it again is a no-op.
+    '''
+    Versioned.register(cls.__mapper__, cls)
+
+  @staticmethod
+  def register(mapper, cls):
+    '''
+    Mapper `instrument_class` handler registering every mapped subclass,
+    except generated revision classes and single-table inheritance children
+    (which share their parent's revisions).
+    '''
+    table = mapper.local_table
+    versioned = table.info.get('versioned')
+    if cls.__dict__.get('__audit_revision__'):
+      return
+    if versioned is not None:
+      if versioned is not cls and 'Revision' in versioned.__dict__:
+        # planned once its mapper is configured
+        _unplanned[cls] = versioned
+      return
+    # the revision class itself is built lazily, see `configure_revisions`
+    table.info['versioned'] = cls
+    _unconfigured[cls] = None
+    if cls.__audit_context__:
+      # defined upfront so that `create_all` creates it with the live tables
+      context.transaction_table(table.metadata)
+    sa.event.listen(table, 'after_create', create_revision_table)
 
-    # register listeners
-    sa.event.listen(cls, 'before_insert', cls.before_insert)
-    sa.event.listen(cls, 'before_update', cls.before_update)
-    sa.event.listen(cls, 'before_delete', cls.before_delete)
+
+  @classmethod
+  def configure_revisions(cls):
+    '''
+    Builds the revision class, table and mapper of every class registered
+    with `broadcast_crud` that does not have them yet. Runs automatically
+    when mappers are configured; call it before `MetaData.create_all` or
+    migrations autogenerate need to see the revision tables.
+    '''
+    for versioned in list(_unconfigured):
+      Versioned.create_rev_class(versioned)
+    for child, versioned in list(_unplanned.items()):
+      _plan(versioned, child.__mapper__)
 
 
   @staticmethod
   def create_rev_class(cls):
+    if 'Revision' in cls.__dict__:
+      return
+    _unconfigured.pop(cls, None)
     # todo: validate autogenerate capabilities with alembic for 
     #       indexes, unique constraints, and foreign keys
     def _col_copy(col):
@@ -112,39 +406,409 @@ class Versioned(object):
     properties = sa.util.OrderedDict()
     rev_cols = []
     rev_cols.append(
-      sa.Column('rev_id', sa.String(36), nullable=False, primary_key=True))
+      sa.Column('rev_id', revid.rev_id_type(cls.__rev_id_format__),
+                nullable=False, primary_key=True))
+    # partitioned tables need the partition key in their primary key
     rev_cols.append(
-      sa.Column('rev_created', sa.Float, nullable=False))
+      sa.Column('rev_created', clock.rev_created_type(cls.__rev_created_type__),
+                nullable=False, primary_key=bool(cls.__audit_partition__)))
+    if cls.__rev_created_type__ != 'float':
+      rev_cols.append(sa.Column('rev_seq', sa.Integer, nullable=False))
     rev_cols.append(
       sa.Column('rev_isdelete', sa.Boolean, nullable=False, default=False))
+    if cls.__audit_delta__:
+      rev_cols.append(sa.Column('rev_changed', sa.Text, nullable=True))
+    if cls.__audit_context__:
+      rev_cols.append(
+        context.context_column(cls.__mapper__.local_table.metadata))
+    audited = audited_columns(cls)
+    deduplicated = dedup_columns(cls, audited)
     for column in cls.__mapper__.local_table.c:
       # todo: ideally check to see if there are conflicts with the namespaced
       #       cols
-      if not column.name.startswith('rev_'):
+      if column.name in deduplicated:
+        rev_cols.append(dedup.reference_column(column))
+      elif not column.name.startswith('rev_') and column.name in audited:
         rev_cols.append(_col_copy(column))
 
+    info = {'primary_key': tuple(
+              col.name for col in cls.__mapper__.local_table.primary_key),
+            'rev_created': cls.__rev_created_type__}
+    kwargs = {}
+    if cls.__audit_partition__:
+      info['partition'] = partition.check_period(cls.__audit_partition__)
+      kwargs.update(partition.TABLE_KWARGS)
     table = sa.Table(
       cls.__mapper__.local_table.name + '_rev',
       cls.__mapper__.local_table.metadata,
       *rev_cols,
-      schema=cls.__mapper__.local_table.schema
+      schema=cls.__mapper__.local_table.schema,
+      info=info,
+      **kwargs
     )
+    if cls.__audit_partition__:
+      partition.install(table)
+    if deduplicated:
+      table.info['dedup'] = collections.OrderedDict(
+        (column.name, dedup.content_table(table, column))
+        for column in cls.__mapper__.local_table.c
+        if column.name in deduplicated)
+    # point-in-time lookups seek on (primary key..., rev_created[, rev_seq])
+    sa.Index(
+      'ix_%s_as_of' % table.name,
+      *(history.primary_key_columns(table) + history.timeline_columns(table)))
+    if deduplicated:
+      properties.update(dedup.properties(table, [
+        (_column_key(cls, column), column.name)
+        for column in cls.__mapper__.local_table.c
+        if column.name in deduplicated]))
     bases = cls.__mapper__.base_mapper.class_.__bases__
-    rev_cls = type.__new__(type, "%sRev" % cls.__name__, bases, {})  
+    rev_cls = type.__new__(
+      type, "%sRev" % cls.__name__, (history.RevisionReader,) + bases,
+      {'__audit_revision__': True})
     mapper = sa.orm.mapper(
       rev_cls,
       table,
-      properties=properties
+      properties=properties,
+      primary_key=[table.c.rev_id]
     )
     rev_cls.__table__ = table
     rev_cls.__mapper__ = mapper
     cls.Revision = rev_cls
+    for mapper in cls.__mapper__.self_and_descendants:
+      if mapper.local_table is cls.__mapper__.local_table:
+        _plan(cls, mapper, audited, deduplicated)
     sa.event.listen(rev_cls, 'before_update', raiseUpdateForbidden)
     sa.event.listen(rev_cls, 'before_delete', raiseDeleteForbidden)
+    if cls.__audit_triggers__:
+      triggers.install(cls)
+
+  @classmethod
+  def as_of(cls, session, timestamp, ident=None):
+    '''
+    Returns a query of the latest revision per primary key created at or
+    before `timestamp` (seconds since the epoch or a datetime), skipping rows
+    that were deleted by then. `ident` (a primary key value, or tuple of
+    values for composite keys) narrows it down to a single row.
+    '''
+    return history.as_of(session, cls.Revision, timestamp, ident)
+
+  @classmethod
+  def revision_state(cls, session, rev_id):
+    '''
+    Returns the full row state (a dict keyed by revision column name) as of
+    revision `rev_id`, rebuilding delta revisions from their predecessors.
+    Returns None if there is no such revision.
+    '''
+    return history.revision_state(session, cls.Revision.__table__, rev_id)
+
+  @classmethod
+  def export(cls, connectable, dest=None, format=None, ident=None,
+             since=None, until=None, isdelete=None, chunk_size=10000):
+    '''
+    Exports this class's revision history as Arrow record batches or to a
+    Parquet or CSV file `dest`; see `export.export`. `connectable` is a
+    session, connection or engine.
+    '''
+    return export.export(connectable, cls.Revision.__table__, dest, format,
+                         ident, since, until, isdelete, chunk_size)
 
   @classmethod
-  def versioned_session(cls, session):
-    cls.DBSession = session
+  def versioned_session(cls, session=_MISSING, bulk=_MISSING,
+                        writer=_MISSING, metrics=_MISSING):
+    '''
+    Configures how revisions are written; settings that are not passed are
+    left as they are, and None turns one off. `session` is no longer used
+    for writing (revisions go through each object's own session) and is
+    only kept for backwards compatibility. `bulk` is deprecated and ignored:
+    revisions are always batched per flush. `writer` writes revisions after
+    commit; see `sqlalchemy_audit.writer`. `metrics` receives
+    instrumentation events; see `sqlalchemy_audit.metrics`.
+    '''
+    if session is not _MISSING:
+      cls.DBSession = session
+    if bulk is not _MISSING:
+      warnings.warn('versioned_session(bulk=...) is deprecated and has no '
+                    'effect: revisions are always batched per flush',
+                    DeprecationWarning, stacklevel=2)
+    if writer is not _MISSING:
+      cls.writer = writer
+    if metrics is not _MISSING:
+      cls.metrics = metrics
+
+
+# versioned classes whose revision class is not built yet
+_unconfigured = collections.OrderedDict()
+# single-table inheritance children mapped after their parent's revision
+# class was built, mapped to that parent
+_unplanned = collections.OrderedDict()
+
+def _plan(cls, mapper, audited=None, deduplicated=None):
+  '''
+  Sets the revision plan of `mapper`, the one of versioned class `cls` or of
+  a single-table inheritance child sharing its revisions.
+  '''
+  _unplanned.pop(mapper.class_, None)
+  if cls.__audit_triggers__:
+    # None tells the handlers to skip trigger-mode classes
+    mapper.class_._rev_plan = None
+    return
+  if audited is None:
+    audited = audited_columns(cls)
+    deduplicated = dedup_columns(cls, audited)
+  # precompile the column-to-attribute copy once instead of per flush
+  mapper.class_._rev_plan = RevisionPlan.build(
+    mapper, mapper.local_table, cls.__audit_delta__,
+    cls.__rev_created_type__, audited, deduplicated)
+
+def create_revision_table(table, connection, **kw):
+  '''
+  Versioned table `after_create` handler creating a revision table that
+  was only built after `create_all` had collected its tables.
+  '''
+  cls = table.info['versioned']
+  if cls in _unconfigured:
+    Versioned.create_rev_class(cls)
+    cls.Revision.__table__.create(
+      connection, checkfirst=kw.get('checkfirst', False))
+    for side in cls.Revision.__table__.info.get('dedup', {}).values():
+      side.create(connection, checkfirst=kw.get('checkfirst', False))
+
+
+# one set of listeners for every versioned class, dispatched on _rev_plan
+sa.event.listen(Versioned, 'instrument_class', Versioned.register,
+                propagate=True)
+sa.event.listen(
+  sa.orm.mapper, 'after_configured', Versioned.configure_revisions)
+for _event, _handler in (('before_insert', Versioned.before_insert),
+                         ('before_update', Versioned.before_update),
+                         ('before_delete', Versioned.before_delete),
+                         ('after_insert', Versioned.after_db_change),
+                         ('after_update', Versioned.after_db_change),
+                         ('after_delete', Versioned.after_db_change)):
+  sa.event.listen(Versioned, _event, _handler, propagate=True)
+
+
+def audited_columns(cls):
+  '''
+  Returns the set of column names of versioned class `cls`'s table that its
+  revisions record, according to ``__audit_include__`` and
+  ``__audit_exclude__`` (column names or attribute keys).
+  '''
+  table = cls.__mapper__.local_table
+  include = cls.__audit_include__
+  exclude = cls.__audit_exclude__
+  if include is not None and exclude:
+    raise ValueError('%s sets both __audit_include__ and __audit_exclude__'
+                     % cls.__name__)
+  names = _columns_by_name(cls, tuple(include or ()) + tuple(exclude))
+  if include is not None:
+    audited = set(names[name].name for name in include)
+    audited.update(col.name for col in table.primary_key)
+    return audited
+  excluded = set(names[name].name for name in exclude)
+  for col in table.primary_key:
+    if col.name in excluded:
+      raise ValueError('%s cannot exclude primary key column %r'
+                       % (cls.__name__, col.name))
+  return set(col.name for col in table.c) - excluded
+
+
+def dedup_columns(cls, audited):
+  '''
+  Returns the set of `audited` column names of versioned class `cls` listed
+  in ``__audit_dedup__`` (column names or attribute keys).
+  '''
+  if not cls.__audit_dedup__:
+    return set()
+  if cls.__audit_triggers__:
+    raise ValueError('%s: __audit_dedup__ is not supported with triggers'
+                     % cls.__name__)
+  names = _columns_by_name(cls, cls.__audit_dedup__)
+  deduplicated = set()
+  for name in cls.__audit_dedup__:
+    col = names[name]
+    if col.primary_key or col.name not in audited:
+      raise ValueError('%s cannot deduplicate column %r'
+                       % (cls.__name__, col.name))
+    deduplicated.add(col.name)
+  return deduplicated
+
+
+def _columns_by_name(cls, names):
+  '''
+  Maps the column names and attribute keys of `cls`'s table to columns,
+  checking that all of `names` are among them. Columns of single-table
+  inheritance children are included.
+  '''
+  table = cls.__mapper__.local_table
+  columns = {}
+  for col in table.c:
+    columns[col.name] = col
+    columns[_column_key(cls, col)] = col
+  for name in names:
+    if name not in columns:
+      raise ValueError('%s has no column %r to audit' % (cls.__name__, name))
+  return columns
+
+
+def _property_key(mapper, column):
+  '''
+  Returns the attribute key `mapper` maps `column` to, None if unmapped.
+  '''
+  try:
+    return mapper.get_property_by_column(column).key
+  except sa.orm.exc.UnmappedColumnError:
+    return None
+
+
+def _column_key(cls, column):
+  '''
+  Returns the attribute key of `column` of versioned class `cls`'s table,
+  looking through single-table inheritance children that map it.
+  '''
+  for mapper in cls.__mapper__.self_and_descendants:
+    key = _property_key(mapper, column)
+    if key is not None:
+      return key
+  return column.name
+
+
+class Delta(collections.namedtuple(
+    'Delta', ('names', 'target', 'changed', 'previous'))):
+  '''
+  Placeholder rev_changed value of an update revision of `target` storing
+  only the `changed` attributes (`names` being their columns), unless it
+  completes the row's snapshot interval; `previous` is the prior rev_id.
+  '''
+
+
+def resolve_deltas(session, table, mapper, rows):
+  '''
+  Decides which pending delta `rows` of revision `table` are stored as full
+  snapshots: those following ``__audit_delta__ - 1`` deltas of their row
+  since its last snapshot, counted with one query per flush. Revisions
+  still waiting for the async writer are not counted.
+  '''
+  deltas = [row for row in rows if isinstance(row.get('rev_changed'), Delta)]
+  if not deltas:
+    return
+  primary_key = history.primary_key_columns(table)
+  def ident(row):
+    return tuple(row[col.name] for col in primary_key)
+  snapshot = table.alias('snapshot')
+  counts = {}
+  idents = list(set(ident(row) for row in deltas))
+  connection = session.connection(mapper=mapper)
+  for offset in range(0, len(idents), dedup.CHUNK):
+    query = sa.select(primary_key + [sa.func.count()]).where(sa.and_(
+      history.idents_criteria(table, idents[offset:offset + dedup.CHUNK]),
+      table.c.rev_changed != sa.null(),
+      ~sa.exists().where(sa.and_(
+        snapshot.c.rev_changed == sa.null(),
+        history.keyset_after(
+          history.timeline_columns(snapshot),
+          history.timeline_columns(table)),
+        *[snapshot.c[col.name] == col for col in primary_key]))))
+    for result in connection.execute(query.group_by(*primary_key)):
+      counts[tuple(result)[:-1]] = result[-1]
+  interval = mapper.class_.__audit_delta__
+  for row in deltas:
+    delta = row['rev_changed']
+    if counts.get(ident(row), 0) + 1 < interval:
+      row['rev_changed'] = delta.names
+      continue
+    row['rev_changed'] = None
+    plan = delta.target._rev_plan
+    row.update(zip(plan.column_names, plan.get_columns(delta.target)))
+    for key, name in plan.content:
+      if key not in delta.changed:
+        # unchanged: neither load nor store the value again
+        row[name] = dedup.Carry(delta.previous, delta.target, key, name)
+
+
+PENDING_REVISIONS = 'sqlalchemy_audit.pending'
+COMMITTED_REVISIONS = 'sqlalchemy_audit.committed'
+
+def write_pending_revisions(session, flush_context):
+  '''
+  Session `after_flush` handler that inserts the revision rows collected
+  during the flush, one executemany per revision table. With an async
+  writer configured, the rows are set aside until the transaction commits.
+  Delta revisions completing their row's snapshot interval become full
+  snapshots. Revisions recording the audit context get its id, writing the
+  context row on the transaction's first such flush. Deduplicated values are
+  always written synchronously, before the revisions referring to them.
+  '''
+  pending = session.info.pop(PENDING_REVISIONS, None)
+  if not pending:
+    return
+  for table, (mapper, rows) in pending.items():
+    if 'rev_changed' in table.c:
+      resolve_deltas(session, table, mapper, rows)
+  dedup.write_pending(session, pending)
+  for table, (mapper, rows) in pending.items():
+    if 'rev_txn_id' in table.c:
+      ident = context.context_id(
+        session, session.connection(mapper=mapper), table.metadata)
+      if ident is not None:
+        for row in rows:
+          row['rev_txn_id'] = ident
+  if Versioned.metrics is not None:
+    for table, (mapper, rows) in pending.items():
+      Versioned.metrics.written(
+        table, len(rows), sum(metrics.row_size(row) for row in rows))
+  if Versioned.writer is not None:
+    session.info.setdefault(COMMITTED_REVISIONS, []).append(
+      (core.real_transaction(session.transaction),
+       [(table, rows) for table, (mapper, rows) in pending.items()]))
+    return
+  for table, (mapper, rows) in pending.items():
+    session.connection(mapper=mapper).execute(table.insert(), rows)
+
+def discard_pending_revisions(session):
+  '''
+  Session `after_rollback` handler that drops revisions of a failed flush,
+  and those set aside for the async writer once the outermost transaction
+  rolls back (savepoints are handled by `discard_committed_revisions`).
+  '''
+  session.info.pop(PENDING_REVISIONS, None)
+  session.info.pop(dedup.PENDING_CONTENT, None)
+  if core.is_outermost(session):
+    session.info.pop(COMMITTED_REVISIONS, None)
+
+def submit_committed_revisions(session):
+  '''
+  Session `after_commit` handler passing the transaction's revisions to the
+  async writer once the outermost transaction commits; releasing a
+  savepoint keeps them waiting.
+  '''
+  if not core.is_outermost(session):
+    return
+  flushed = session.info.pop(COMMITTED_REVISIONS, None)
+  if flushed and Versioned.writer is not None:
+    Versioned.writer.submit(
+      [entry for transaction, pending in flushed for entry in pending])
+    if Versioned.metrics is not None:
+      Versioned.metrics.queue_depth(Versioned.writer.qsize())
+
+def discard_committed_revisions(session, previous_transaction):
+  '''
+  Session `after_soft_rollback` handler dropping the revisions flushed
+  within a rolled back savepoint (or transaction).
+  '''
+  flushed = session.info.get(COMMITTED_REVISIONS)
+  if flushed:
+    flushed[:] = [
+      (transaction, pending) for transaction, pending in flushed
+      if not core.within(transaction, previous_transaction)]
+
+
+sa.event.listen(sa.orm.Session, 'after_flush', write_pending_revisions)
+sa.event.listen(sa.orm.Session, 'after_rollback', discard_pending_revisions)
+sa.event.listen(sa.orm.Session, 'after_commit', submit_committed_revisions)
+sa.event.listen(
+  sa.orm.Session, 'after_soft_rollback', discard_committed_revisions)
 
 
 class DeleteForbidden(Exception): pass
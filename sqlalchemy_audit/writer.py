@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+'''
+Asynchronous revision writer.
+
+Usage
+-----
+  writer = AsyncRevisionWriter(engine, maxsize=1000)
+  writer.start()
+  Versioned.versioned_session(writer=writer)
+
+With a writer configured, the mapper handlers still build revision rows
+during the flush, but nothing is written inside the transaction. The rows
+of a transaction are handed to the writer once it commits (and dropped if
+it, or the savepoint they were flushed in, rolls back); a background thread
+then inserts them in batches on its own connections.
+'''
+import atexit
+import collections
+import logging
+import threading
+
+try:
+  import queue
+except ImportError: # pragma: no cover
+  import Queue as queue
+
+
+log = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class AsyncRevisionWriter(object):
+  '''
+  Background thread inserting committed revision rows into `engine`.
+
+  `maxsize` bounds the number of queued transactions. When the queue is
+  full, `submit` blocks the committing thread (backpressure); if `timeout`
+  seconds pass first, that thread writes its own revisions synchronously so
+  nothing is lost. Rows are grouped per revision table into executemany
+  INSERTs of up to `batch_size` rows. Failed batches are logged and passed
+  to `on_error(table, rows, exc)` if given.
+  '''
+
+  def __init__(self, engine, maxsize=1000, batch_size=1000, timeout=None,
+               on_error=None):
+    self.engine = engine
+    self.batch_size = batch_size
+    self.timeout = timeout
+    self.on_error = on_error
+    self.queue = queue.Queue(maxsize)
+    self.thread = None
+
+  def start(self):
+    if self.thread is None:
+      self.thread = threading.Thread(
+        target=self._run, name='sqlalchemy_audit.writer')
+      self.thread.daemon = True
+      self.thread.start()
+      atexit.register(self.stop)
+    return self
+
+  def submit(self, pending):
+    '''
+    Queues the revision rows of one committed transaction, a sequence of
+    (revision table, rows) pairs.
+    '''
+    try:
+      self.queue.put(pending, timeout=self.timeout)
+    except queue.Full:
+      log.warning('revision queue full, writing %d tables synchronously',
+                  len(pending))
+      self._write(pending)
+
+  def qsize(self):
+    return self.queue.qsize()
+
+  def flush(self):
+    '''
+    Blocks until every queued revision has been written.
+    '''
+    self.queue.join()
+
+  def stop(self):
+    '''
+    Writes whatever is still queued and stops the background thread.
+    '''
+    if self.thread is not None:
+      self.queue.put(_STOP)
+      self.thread.join()
+      self.thread = None
+
+  def _run(self):
+    while True:
+      item = self.queue.get()
+      batch = []
+      stop = item is _STOP
+      if not stop:
+        batch.append(item)
+      # drain what is already waiting into the same round of INSERTs
+      while not stop and len(batch) < self.batch_size:
+        try:
+          item = self.queue.get_nowait()
+        except queue.Empty:
+          break
+        if item is _STOP:
+          stop = True
+        else:
+          batch.append(item)
+      try:
+        self._write([entry for pending in batch for entry in pending])
+      finally:
+        for _ in range(len(batch) + (1 if stop else 0)):
+          self.queue.task_done()
+      if stop:
+        return
+
+  def _write(self, pending):
+    tables = collections.OrderedDict()
+    for table, rows in pending:
+      tables.setdefault(table, []).extend(rows)
+    for table, rows in tables.items():
+      for offset in range(0, len(rows), self.batch_size):
+        chunk = rows[offset:offset + self.batch_size]
+        try:
+          with self.engine.begin() as connection:
+            connection.execute(table.insert(), chunk)
+        except Exception as exc:
+          log.exception('failed to write %d revisions to %s',
+                        len(chunk), table.name)
+          if self.on_error is not None:
+            self.on_error(table, chunk, exc)